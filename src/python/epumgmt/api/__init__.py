@@ -39,6 +39,10 @@ class RunVM:
     # See the comment around the "service_type" variable below
     WORKER_SUFFIX = "-workervm"
 
+    # The fields persistence keeps for each VM
+    STORED_FIELDS = ("instanceid", "nodeid", "hostname", "service_type",
+                     "parent", "runlogdir", "vmlogdir")
+
     def __init__(self):
 
         # No IaaS awareness yet, assumes you start/stop with same conf.
@@ -69,6 +73,30 @@ class RunVM:
         # List of events that have parsed and recorded so far.
         self.events = []
 
+        # What persistence last read or wrote of this VM: the field values
+        # and the keys of the events.  None if it never did, see mark_stored()
+        self._stored_fields = None
+        self._stored_keys = set()
+
+    def mark_stored(self):
+        """Record that the VM, as it is now, matches what is persisted"""
+        self._stored_fields = self._get_fields()
+        self._stored_keys = set([e.key for e in self.events])
+
+    def is_stored(self):
+        return self._stored_fields is not None
+
+    def fields_changed(self):
+        """True if any field changed since mark_stored() (or it was never called)"""
+        return self._get_fields() != self._stored_fields
+
+    def get_new_events(self):
+        """The events added since mark_stored(), all of them if it was never called"""
+        return [e for e in self.events if e.key not in self._stored_keys]
+
+    def _get_fields(self):
+        return tuple([getattr(self, field) for field in self.STORED_FIELDS])
+
     def __repr__(self):
         repr = "RunVM: "
         repr += "instanceid: %s " % self.instanceid
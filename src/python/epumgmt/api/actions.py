@@ -1,5 +1,6 @@
 class ACTIONS:
 
+    COMPACT_EVENTS = "compact-events"
     EXECUTE_WORKLOAD_TEST = "execute-workload-test"
     FETCH_KILL = "fetchkill"
     FIND_VERSIONS = "find-versions"
@@ -1,117 +1,510 @@
-from datetime import datetime
+import errno
+import fcntl
+import heapq
 import os
+import select
 import signal
 import subprocess
-import sys
+import threading
 import time
+from collections import deque
 
-try:
-    from threading import Thread
-except ImportError:
-    from dummy_threading import Thread
+from epumgmt.api.exceptions import *
 
-def child(cmd, timeout=0.0):
+# How many children an Executor runs at the same time by default, see
+# [ssh] max_running
+DEFAULT_MAX_RUNNING = 20
+
+# Seconds between checks for children that exited while something they
+# started still holds their output open (otherwise the end of the output
+# is what tells a child is done)
+REAP_INTERVAL = 0.25
+
+# Seconds between checks for children that closed their output but have
+# not exited yet, usually they are about to
+EXIT_INTERVAL = 0.01
+
+READ_SIZE = 65536
+
+# Open files kept for everything else than the children's output, see
+# get_fd_budget()
+FD_RESERVE = 128
+
+def child(cmd, timeout=0.0, stdout_consumer=None):
     """Run a system program.
-    
+
     Required parameter:
-    
-    * cmd -- command to run, string
-    
+
+    * cmd -- command to run: a string for the shell, or a list (program
+    and its arguments) that is run as it is
+
     Keyword parameter:
-    
+
     * timeout -- how many seconds to wait before SIGKILL (int or float)
     Default is 0 seconds which means no killing.
-    
+
+    * stdout_consumer -- function called with each chunk of stdout as it
+    arrives, stdout is then not kept (returned as None)
+
     Return (was_killed, exitcode, stdout, stderr)
-    
+
     * was_killed -- boolean, true if it timed out and was killed
-    
+
     * exitcode -- integer exit code, only relevant if killed is False
     See:
     http://docs.python.org/library/subprocess.html#subprocess.Popen.returncode
-    
+
     * stdout -- stdout or None
-    
+
     * stderr -- stderr or None
-    
+
     """
-    
-    thr = RunThread(cmd)
-    
-    if timeout <= 0:
-        thr.start()
-        thr.join()
-        
-        # That is it.
-        return (False, thr.exit, thr.stdout, thr.stderr)
-        
-    # Timeout is requested
-    
-    start = datetime.now()
-    thr.start()
-    
-    killed = False
-    while True:
-        thr.join(0.1)
-        if not thr.isAlive():
-            break
-        
-        elapsed = (datetime.now() - start)
-        if elapsed.seconds > timeout:
+
+    executor = Executor(max_running=1)
+    result = executor.submit(cmd, timeout=timeout, stdout_consumer=stdout_consumer)
+    executor.run()
+    return result.as_tuple()
+
+def get_max_running(p):
+    """[ssh] max_running, how many commands to run at the same time"""
+    max_running = p.get_conf_or_none("ssh", "max_running")
+    if not max_running:
+        return DEFAULT_MAX_RUNNING
+    try:
+        max_running = int(max_running)
+        if max_running < 1:
+            raise ValueError()
+    except ValueError:
+        raise InvalidConfig("ssh->max_running must be a number > 0: '%s'" % max_running)
+    return max_running
+
+# max_running -> what get_fd_budget() made of it
+_fd_budgets = {}
+_fd_lock = threading.Lock()
+
+def get_fd_budget(max_running):
+    """How many children can run at the same time, at most max_running:
+    each has its stdout and stderr open here.
+
+    The soft limit on open files is only raised (up to the hard one) when
+    max_running needs more than it allows, and is then left raised for the
+    rest of the process.  Each max_running is only worked out once.
+    """
+    _fd_lock.acquire()
+    try:
+        if not _fd_budgets.has_key(max_running):
+            _fd_budgets[max_running] = _get_fd_budget(max_running)
+        return _fd_budgets[max_running]
+    finally:
+        _fd_lock.release()
+
+def _get_fd_budget(max_running):
+    try:
+        import resource
+    except ImportError:
+        return max_running
+    (soft, hard) = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        return max_running
+    needed = 2 * max_running + FD_RESERVE
+    if needed > soft:
+        if hard != resource.RLIM_INFINITY:
+            needed = min(needed, hard)
+        if needed > soft:
             try:
-                pid = thr.pid
-                if pid < 1:
-                    sys.stderr.write("Time elapsed but no PID to kill!\n")
-                    break
-                os.kill(thr.pid, signal.SIGKILL)
-                os.waitpid(-1, os.WNOHANG)
-            except OSError,e:
-                pass #sys.stderr.write("%s\n" % e)
-            killed = True
-            break
-    
-    return (killed, thr.exit, thr.stdout, thr.stderr)
+                resource.setrlimit(resource.RLIMIT_NOFILE, (needed, hard))
+                soft = needed
+            except (ValueError, resource.error):
+                pass
+    return max(1, min(max_running, (soft - FD_RESERVE) / 2))
+
+def _set_flags(fd):
+    """Non-blocking, and not inherited by the children started after"""
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
 
 
 # -------------------------------------------------------------------------
 
-    
-class RunThread(Thread):
-    
-    def __init__ (self, cmd):
-        """Populate the thread.
-        
-        Required parameters:
-        
-        * cmd -- command to run
-        
-        Properties available:
-        
-        * pid -- pid of the child, or -1
-        
-        * stdout -- stdout data or None
-        
-        * stderr -- stderr data or None
-        
-        * retcode -- exit of child process: 0, positive exit code, negative
-        exit means signal. See:
-        http://docs.python.org/library/subprocess.html#subprocess.Popen.returncode
-        """
-        
-        Thread.__init__(self)
+
+class ChildResult:
+    """What happened to one command of an Executor.
+
+    Properties available once it ran:
+
+    * killed -- True if it timed out, it was killed with its process group
+
+    * cancelled -- True if it was cancelled, see Executor.cancel().  It was
+    killed with its process group if it had started, exitcode is None if
+    it had not.
+
+    * exitcode -- exit of child process: 0, positive exit code, negative
+    exit means signal. See:
+    http://docs.python.org/library/subprocess.html#subprocess.Popen.returncode
+    127 if the program of a list command could not be started.
+
+    * stdout -- stdout data, None if there was a stdout_consumer
+
+    * stderr -- stderr data
+
+    * stdout_bytes, stderr_bytes -- how much output there was
+
+    * duration -- seconds from start to exit (or kill)
+    """
+
+    def __init__(self, cmd, timeout, stdout_consumer, key, callback):
         if not cmd:
             raise Exception("No command")
         self.cmd = cmd
-        self.exit = None
+        self.timeout = timeout
+        self.stdout_consumer = stdout_consumer
+        self.key = key
+        self.callback = callback
+
+        self.killed = False
+        self.cancelled = False
+        self.done = False
+        self.exitcode = None
         self.stdout = None
         self.stderr = None
-        self.pid = -1
-        
+        self.stdout_bytes = 0
+        self.stderr_bytes = 0
+        self.started = None
+        self.duration = None
+
+        # While running
+        self.process = None
+        self.open_fds = {}
+        self.chunks = {"stdout": [], "stderr": []}
+
+    def succeeded(self):
+        return not self.killed and not self.cancelled and self.exitcode == 0
+
+    def as_tuple(self):
+        """(was_killed, exitcode, stdout, stderr), see child()"""
+        return (self.killed, self.exitcode, self.stdout, self.stderr)
+
+    def __repr__(self):
+        return "ChildResult: '%s' killed=%s exitcode=%s duration=%s" % \
+               (self.cmd, self.killed, self.exitcode, self.duration)
+
+class Executor:
+    """Runs commands at the same time, at most max_running of them.
+
+    One loop, in the thread calling run(), reads the output of all of the
+    children as it arrives and reaps them: there is no thread per child.
+    Every child is the leader of a process group of its own, a child that
+    times out is killed with everything it started (the ssh or scp under
+    the shell for example).
+
+    submit() and cancel() can be called from callbacks and from other
+    threads while run() is going, run() returns once nothing is left.
+    """
+
+    def __init__(self, max_running=DEFAULT_MAX_RUNNING):
+        self.max_running = max_running
+        self.results = []
+        self.pending = deque()
+        self.running = set()
+        self.lock = threading.Lock()
+        self.to_cancel = []
+        self.cancel_everything = False
+
+        # While running
+        self.poller = None
+        self.fd_results = {}
+        self.wake_r = None
+        self.wake_w = None
+        # (deadline, sequence, ChildResult) of the running ones with a timeout
+        self.deadlines = []
+        self.sequence = 0
+        # Running ones that closed their output, they are about to exit
+        self.closing = set()
+        self.next_sweep = 0
+
+    def submit(self, cmd, timeout=0.0, stdout_consumer=None, key=None, callback=None):
+        """Queue a command, see child() for cmd, timeout and stdout_consumer.
+
+        * key -- anything, kept in the result for the caller
+
+        * callback -- function called with the ChildResult when the
+        command is done (or cancelled), in the thread calling run()
+
+        Returns the ChildResult, it is filled in by run()
+        """
+        result = ChildResult(cmd, timeout, stdout_consumer, key, callback)
+        self.lock.acquire()
+        try:
+            self.results.append(result)
+            self.pending.append(result)
+            self._wake()
+        finally:
+            self.lock.release()
+        return result
+
+    def cancel(self, result):
+        """Do not run a submitted command, or kill it if it is running"""
+        self.lock.acquire()
+        try:
+            self.to_cancel.append(result)
+            self._wake()
+        finally:
+            self.lock.release()
+
+    def cancel_all(self):
+        """cancel() everything that is not done yet, run() then returns"""
+        self.lock.acquire()
+        try:
+            self.cancel_everything = True
+            self._wake()
+        finally:
+            self.lock.release()
+
     def run(self):
-        process = subprocess.Popen(self.cmd, shell=True, 
-                                   executable="/bin/bash",
-                                   stdout=subprocess.PIPE,
-                                   stderr=subprocess.PIPE)
-        self.pid = process.pid
-        (self.stdout, self.stderr) = process.communicate()
-        self.exit = process.returncode
+        """Run everything submitted, return when all of it is done.
+
+        Returns the ChildResults, in the order the commands were submitted
+        """
+        max_running = get_fd_budget(self.max_running)
+        self.poller = _Poller()
+        (wake_r, wake_w) = os.pipe()
+        for fd in (wake_r, wake_w):
+            _set_flags(fd)
+        self.poller.register(wake_r)
+        self.lock.acquire()
+        self.wake_r = wake_r
+        self.wake_w = wake_w
+        self.lock.release()
+        self.next_sweep = time.time() + REAP_INTERVAL
+        try:
+            while True:
+                self._cancel()
+                self.lock.acquire()
+                try:
+                    if not self.pending and not self.running:
+                        break
+                    starting = []
+                    while self.pending and len(self.running) + len(starting) < max_running:
+                        starting.append(self.pending.popleft())
+                finally:
+                    self.lock.release()
+                for result in starting:
+                    self._start(result)
+                self._wait()
+        finally:
+            # Only left running if something (a callback) raised
+            for result in list(self.running):
+                result.cancelled = True
+                self._kill(result)
+                self._finish(result)
+            self.lock.acquire()
+            self.wake_r = None
+            self.wake_w = None
+            self.lock.release()
+            os.close(wake_r)
+            os.close(wake_w)
+            self.poller.close()
+            self.deadlines = []
+        return list(self.results)
+
+    def _wake(self):
+        """Interrupt the wait of run(), called with the lock held"""
+        if self.wake_w is None:
+            return
+        try:
+            os.write(self.wake_w, "x")
+        except OSError, e:
+            # Full: it is going to wake up anyway
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _cancel(self):
+        self.lock.acquire()
+        try:
+            if self.cancel_everything:
+                to_cancel = list(self.pending) + list(self.running)
+                self.cancel_everything = False
+            else:
+                to_cancel = self.to_cancel
+            self.to_cancel = []
+            for result in to_cancel:
+                if result in self.pending:
+                    self.pending.remove(result)
+        finally:
+            self.lock.release()
+        for result in to_cancel:
+            if result.done:
+                continue
+            result.cancelled = True
+            if result.process:
+                self._kill(result)
+            self._finish(result)
+
+    def _start(self, result):
+        result.started = time.time()
+        shell = isinstance(result.cmd, basestring)
+        executable = None
+        if shell:
+            executable = "/bin/bash"
+        try:
+            result.process = subprocess.Popen(result.cmd, shell=shell,
+                                              executable=executable,
+                                              stdout=subprocess.PIPE,
+                                              stderr=subprocess.PIPE,
+                                              preexec_fn=os.setpgrp)
+        except OSError, e:
+            # Like the shell does for a program it cannot run
+            result.exitcode = 127
+            result.chunks["stderr"].append("%s: %s\n" % (result.cmd[0], e.strerror))
+            self._finish(result)
+            return
+        self.running.add(result)
+        if result.timeout > 0:
+            self.sequence += 1
+            heapq.heappush(self.deadlines,
+                           (result.started + result.timeout, self.sequence, result))
+        for (name, f) in (("stdout", result.process.stdout),
+                          ("stderr", result.process.stderr)):
+            fd = f.fileno()
+            # The pipes are not closed on exec: without this the children
+            # started after this one would hold them open
+            _set_flags(fd)
+            result.open_fds[fd] = (name, f)
+            self.fd_results[fd] = result
+            self.poller.register(fd)
+
+    def _wait(self):
+        now = time.time()
+        wait = max(0, self.next_sweep - now)
+        if self.closing:
+            wait = min(wait, EXIT_INTERVAL)
+        while self.deadlines and self.deadlines[0][2].done:
+            heapq.heappop(self.deadlines)
+        if self.deadlines:
+            wait = min(wait, max(0, self.deadlines[0][0] - now))
+        for fd in self.poller.poll(wait):
+            if fd == self.wake_r:
+                self._drain_wake()
+            else:
+                self._read(self.fd_results[fd], fd)
+
+        for result in list(self.closing):
+            if result.process.poll() is not None:
+                self._finish(result)
+
+        now = time.time()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            result = heapq.heappop(self.deadlines)[2]
+            if not result.done:
+                result.killed = True
+                self._kill(result)
+                self._finish(result)
+
+        # Exited while something they started holds their output open
+        if now >= self.next_sweep:
+            for result in list(self.running):
+                if result.process.poll() is not None:
+                    self._finish(result)
+            self.next_sweep = now + REAP_INTERVAL
+
+    def _drain_wake(self):
+        try:
+            while os.read(self.wake_r, READ_SIZE):
+                pass
+        except OSError, e:
+            if e.errno not in (errno.EAGAIN, errno.EINTR):
+                raise
+
+    def _read(self, result, fd):
+        """Read what there is, returns False once the fd is closed"""
+        name = result.open_fds[fd][0]
+        while True:
+            try:
+                data = os.read(fd, READ_SIZE)
+            except OSError, e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    return True
+                raise
+            if not data:
+                self._close(result, fd)
+                return False
+            if name == "stdout":
+                result.stdout_bytes += len(data)
+                if result.stdout_consumer:
+                    result.stdout_consumer(data)
+                    continue
+            else:
+                result.stderr_bytes += len(data)
+            result.chunks[name].append(data)
+
+    def _close(self, result, fd):
+        self.poller.unregister(fd)
+        del self.fd_results[fd]
+        result.open_fds.pop(fd)[1].close()
+        if not result.open_fds and not result.done:
+            self.closing.add(result)
+
+    def _kill(self, result):
+        try:
+            os.killpg(result.process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        result.process.wait()
+
+    def _finish(self, result):
+        result.done = True
+        self.closing.discard(result)
+        self.running.discard(result)
+        # Output the child wrote before exiting is still in the pipes.
+        # Whatever it started may hold them open: no waiting for that.
+        for fd in result.open_fds.keys():
+            if self._read(result, fd):
+                self._close(result, fd)
+
+        if result.process:
+            result.exitcode = result.process.returncode
+        if result.started:
+            result.duration = time.time() - result.started
+        if not result.stdout_consumer:
+            result.stdout = "".join(result.chunks["stdout"])
+        result.stderr = "".join(result.chunks["stderr"])
+        result.chunks = {}
+        result.process = None
+        if result.callback:
+            result.callback(result)
+
+class _Poller:
+    """select.epoll where there is one (it does not look at every
+    descriptor on each call, unlike poll), select.poll otherwise"""
+
+    def __init__(self):
+        if hasattr(select, "epoll"):
+            self.impl = select.epoll()
+            self.events = select.EPOLLIN | select.EPOLLPRI
+            self.scale = 1
+        else:
+            self.impl = select.poll()
+            self.events = select.POLLIN | select.POLLPRI
+            self.scale = 1000
+
+    def register(self, fd):
+        self.impl.register(fd, self.events)
+
+    def unregister(self, fd):
+        self.impl.unregister(fd)
+
+    def poll(self, timeout):
+        """The fds with something to read (or closed), timeout in seconds"""
+        try:
+            events = self.impl.poll(timeout * self.scale)
+        except (IOError, select.error), e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return []
+        return [fd for (fd, event) in events]
+
+    def close(self):
+        if hasattr(self.impl, "close"):
+            self.impl.close()
@@ -1,30 +1,148 @@
-import cloudyvents.cyvents as cyvents
+import multiprocessing
 import os
 
 from epumgmt.api.exceptions import *
+from epumgmt.defaults import event_scanner
+from epumgmt.defaults.log_checkpoint import ManifestEntry, fingerprint
+
+def dirwalk(adir):
+    """walk a directory tree, using a generator,
+    http://code.activestate.com/recipes/105873-walk-a-directory-tree-using-a-generator/
+    Entries are visited in sorted order so that every gather of the same
+    directory returns its events in the same order.
+    """
+    names = os.listdir(adir)
+    names.sort()
+    for f in names:
+        fullpath = os.path.join(adir,f)
+        if os.path.isdir(fullpath) and not os.path.islink(fullpath):
+            for x in dirwalk(fullpath):  # recurse into subdir
+                yield x
+        else:
+            yield fullpath
+
+def _events_from_file(fullpath, entry):
+    """Return (events, manifest entry) for one file, entry is what the
+    manifest had for it (or None).  Unchanged files are not read at all and
+    files that only grew are parsed from where the last gather stopped.
+    """
+    f = open(fullpath, 'rb')
+    try:
+        st = os.fstat(f.fileno())
+        if entry and entry.is_unchanged(st):
+            return [], entry
+        start = 0
+        if entry and entry.is_grown(f, st):
+            start = entry.offset
+        events, end = event_scanner.events_from_open_file(f, st.st_size, start)
+        return events, ManifestEntry(fullpath, st.st_ino, st.st_size, st.st_mtime,
+                                     end, fingerprint(f, end))
+    finally:
+        f.close()
+
+def events_in_dir(logdir, manifest=None):
+    """Return (events, entries): the new events in all files under logdir
+    and the manifest entries describing those files now.  This is what the
+    process pool runs for each VM, so it needs to stay a module level
+    function.
+    """
+    if manifest is None:
+        manifest = {}
+    events = []
+    entries = {}
+    for fullpath in dirwalk(logdir):
+        found, entries[fullpath] = _events_from_file(fullpath, manifest.get(fullpath))
+        events.extend(found)
+    return events, entries
+
+def _events_in_dir_args(args):
+    return events_in_dir(*args)
 
 class DefaultEventGather:
         
     def __init__(self, params, common):
         self.p = params
         self.c = common
+        self.parallelism = 1
     
     def validate(self):
-        pass
+        parallelism = self.p.get_conf_or_none("events", "parallelism")
+        if parallelism:
+            try:
+                self.parallelism = int(parallelism)
+            except ValueError:
+                raise InvalidConfig("events->parallelism must be a number: '%s'" % parallelism)
+            if self.parallelism < 1:
+                raise InvalidConfig("events->parallelism must be 1 or more: '%s'" % parallelism)
     
     def populate_run_vms(self, m, run_name):
         self._populate_run_vms(m.persistence, run_name)
         
     def populate_one_vm(self, m, run_name, instanceid):
         self._populate_one_vm(m.persistence, run_name, instanceid)
-        
+
+    def _save_manifest(self, persistence, run_name, manifest, entries):
+        """Only called once the events are stored: a file in the manifest
+        is one whose events never need to be parsed again.
+        """
+        manifest = dict(manifest)
+        manifest.update(entries)
+        for fullpath in manifest.keys():
+            if not entries.has_key(fullpath) and not os.path.exists(fullpath):
+                del manifest[fullpath]
+        persistence.store_event_manifest(run_name, manifest)
+
     def _populate_run_vms(self, persistence, run_name):
         run_vms = persistence.get_run_vms_or_none(run_name)
         if not run_vms or len(run_vms) == 0:
             raise IncompatibleEnvironment("Cannot find any VMs associated with run '%s'" % run_name)
-        for vm in run_vms:
-            self._fill_one(vm)
+        manifest = persistence.get_event_manifest(run_name)
+        if self.parallelism > 1:
+            entries = self._fill_parallel(run_vms, manifest)
+        else:
+            entries = {}
+            for vm in run_vms:
+                entries.update(self._fill_one(vm, manifest))
         persistence.store_run_vms(run_name, run_vms)
+        self._save_manifest(persistence, run_name, manifest, entries)
+
+    def _fill_parallel(self, run_vms, manifest=None):
+        """Parse the runlogdir of every VM in a process pool.
+
+        Results come back in the order the VMs were handed out and are
+        merged into the VMs in that order, so the outcome is the same as
+        filling them one by one.  Returns the new manifest entries.
+        """
+        if manifest is None:
+            manifest = {}
+        vms = [vm for vm in run_vms if vm.runlogdir]
+        for vm in run_vms:
+            if not vm.runlogdir:
+                self.c.log.warn("Svc/VM has no runlogdir, so cannot parse events: %s" % vm.runlogdir)
+        if not vms:
+            return {}
+        args = []
+        for vm in vms:
+            prefix = os.path.join(vm.runlogdir, '')
+            vm_manifest = dict([(path, entry) for (path, entry) in manifest.iteritems()
+                                if path.startswith(prefix)])
+            args.append((vm.runlogdir, vm_manifest))
+        workers = min(self.parallelism, len(args))
+        self.c.log.debug("Getting events from %d runlog directories with %d processes" % (len(args), workers))
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = pool.map(_events_in_dir_args, args, 1)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        entries = {}
+        for vm, (events, vm_entries) in zip(vms, results):
+            self._merge_events(vm, events)
+            entries.update(vm_entries)
+        return entries
         
     def _populate_one_vm(self, persistence, run_name, instanceid):
         run_vms = persistence.get_run_vms_or_none(run_name)
@@ -38,14 +156,27 @@ class DefaultEventGather:
         if not vm:
             raise IncompatibleEnvironment("Cannot find a VM associated with run '%s' with the instance id '%s'" % (run_name, instanceid))
         
-        self._fill_one(vm)
+        manifest = persistence.get_event_manifest(run_name)
+        entries = self._fill_one(vm, manifest)
         persistence.store_run_vms(run_name, run_vms)
+        self._save_manifest(persistence, run_name, manifest, entries)
         
-    def _fill_one(self, vm):
+    def _fill_one(self, vm, manifest=None):
+        """Add the new events from the VM's runlogdir, files the manifest
+        shows as already parsed are skipped.  Returns the new manifest
+        entries.
+        """
         if not vm.runlogdir:
             self.c.log.warn("Svc/VM has no runlogdir, so cannot parse events: %s" % vm.runlogdir)
-            return
-        all_events = self._all_events_in_dir(vm.runlogdir)
+            return {}
+        all_events, entries = self._all_events_in_dir(vm.runlogdir, manifest)
+        self._merge_events(vm, all_events)
+        return entries
+
+    def _merge_events(self, vm, all_events):
+        # keys of the events the VM already has, checking membership here
+        # keeps re-gathering a VM with many events linear
+        seen_keys = set([curevent.key for curevent in vm.events])
         for event in all_events:
             skip = False
             if (event.name == 'job_sent') or \
@@ -53,14 +184,8 @@ class DefaultEventGather:
                (event.name == 'job_end'):
                 skip = True
             if not skip:
-                new = True
-                for curevent in vm.events:
-                    if event.key == curevent.key:
-                        seen = "seen event before, skipping (%s)" % event.key
-                        #self.c.log.debug(seen)
-                        new = False
-                        break
-                if new:
+                if event.key not in seen_keys:
+                    seen_keys.add(event.key)
                     event_txt = "New event: %s" % event.key
                     event_txt += "\n    source: %s, " % event.source
                     event_txt += "name: %s, " % event.name
@@ -69,21 +194,9 @@ class DefaultEventGather:
                     self.c.log.debug(event_txt)
                     vm.events.append(event)
     
-    def _all_events_in_dir(self, logdir):
+    def _all_events_in_dir(self, logdir, manifest=None):
         self.c.log.debug("Getting events from '%s'" % logdir)
-        events = []
-        for fullpath in self.dirwalk(logdir):
-            events.extend(cyvents.events_from_file(fullpath))
-        return events
+        return events_in_dir(logdir, manifest)
 
     def dirwalk(self, adir):
-        """walk a directory tree, using a generator,
-        http://code.activestate.com/recipes/105873-walk-a-directory-tree-using-a-generator/
-        """
-        for f in os.listdir(adir):
-            fullpath = os.path.join(adir,f)
-            if os.path.isdir(fullpath) and not os.path.islink(fullpath):
-                for x in self.dirwalk(fullpath):  # recurse into subdir
-                    yield x
-            else:
-                yield fullpath
+        return dirwalk(adir)
@@ -0,0 +1,112 @@
+import datetime
+import mmap
+import os
+import simplejson as json
+
+import cloudyvents.cyvents as cyvents
+
+# The mapped file is searched through str windows of about this size: the
+# search in str is a lot faster than mmap's own find and the window is the
+# only copy made, whatever the number of lines in it.
+WINDOW_BYTES = 16 * 1024 * 1024
+
+def _window_lines(window, markers):
+    spans = set()
+    for marker in markers:
+        pos = window.find(marker)
+        while pos >= 0:
+            line_start = window.rfind('\n', 0, pos) + 1
+            line_end = window.find('\n', pos)
+            if line_end < 0:
+                line_end = len(window)
+            else:
+                line_end += 1
+            spans.add((line_start, line_end))
+            pos = window.find(marker, line_end)
+    spans = list(spans)
+    spans.sort()
+    return [window[line_start:line_end] for (line_start, line_end) in spans]
+
+def event_lines(buf, markers, start=0, end=None):
+    """Return the lines of buf[start:end] that contain any of the markers.
+
+    buf is anything with str-like find/rfind and slicing, typically an mmap
+    of a whole log file.  Only the raw bytes are searched, the file is never
+    split into lines and only the matching lines are sliced out.  Lines are
+    returned in file order, each one once even if it holds several markers,
+    and include their trailing newline (the last line of the range may have
+    none).
+    """
+    if end is None:
+        end = len(buf)
+    lines = []
+    while start < end:
+        # cut windows at a newline so that no line spans two of them
+        window_end = end
+        if end - start > WINDOW_BYTES:
+            window_end = buf.rfind('\n', start, start + WINDOW_BYTES) + 1
+            if window_end <= start:
+                window_end = buf.find('\n', start + WINDOW_BYTES, end) + 1 or end
+        lines.extend(_window_lines(buf[start:window_end], markers))
+        start = window_end
+    return lines
+
+def map_file(f, size=None):
+    """Return a read-only mmap of the open file f, None if it is empty"""
+    if size is None:
+        size = os.fstat(f.fileno()).st_size
+    if not size:
+        return None
+    return mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+
+def event_from_line(line):
+    """Return the cloudyvents.cyvents.CYvent in a log line, None if there
+    is none.  Same parsing as cloudyvents.cyvents.events_from_file(): a line
+    with more than one separator holds no event.
+    """
+    parts = line.split(cyvents.CYVENT_SEPARATOR)
+    if len(parts) != 2:
+        return None
+    jsondict = json.loads(parts[1])
+    stamp = jsondict[cyvents.KEY_STAMP]
+    timestamp = datetime.datetime(stamp[cyvents.KEY_STAMP_YEAR],
+                                  stamp[cyvents.KEY_STAMP_MONTH],
+                                  stamp[cyvents.KEY_STAMP_DAY],
+                                  stamp[cyvents.KEY_STAMP_HOUR],
+                                  stamp[cyvents.KEY_STAMP_MINUTE],
+                                  stamp[cyvents.KEY_STAMP_SECOND],
+                                  stamp[cyvents.KEY_STAMP_MICROSECOND])
+    return cyvents.CYvent(jsondict[cyvents.KEY_SOURCE],
+                          jsondict[cyvents.KEY_NAME],
+                          jsondict[cyvents.KEY_UNIQUEKEY],
+                          timestamp,
+                          jsondict[cyvents.KEY_EXTRA])
+
+def events_from_open_file(f, size, start=0):
+    """Return (events, end) for the cloudyvents in f[start:size], end is the
+    offset just past the last complete line.  Only the lines holding an
+    event separator are decoded and parsed.
+    """
+    buf = map_file(f, size)
+    if not buf:
+        return [], 0
+    try:
+        lines = event_lines(buf, (cyvents.CYVENT_SEPARATOR,), start, size)
+        end = max(start, buf.rfind('\n', start, size) + 1)
+    finally:
+        buf.close()
+    events = []
+    for line in lines:
+        ev = event_from_line(line)
+        if ev:
+            events.append(ev)
+    return events, end
+
+def events_from_file(path):
+    """Same result as cloudyvents.cyvents.events_from_file(path)"""
+    f = open(path, 'rb')
+    try:
+        events, end = events_from_open_file(f, os.fstat(f.fileno()).st_size)
+    finally:
+        f.close()
+    return events
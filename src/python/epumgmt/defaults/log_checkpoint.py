@@ -0,0 +1,202 @@
+import cPickle
+import hashlib
+import os
+
+from epumgmt.defaults import event_scanner
+
+# Bump when the pickled LogCheckpoint layout changes, stale stores are
+# then ignored and every log is scanned again from the start.
+CHECKPOINT_VERSION = 2
+
+# Name of the checkpoint store kept in each run's runlog directory
+CHECKPOINT_FILENAME = '.event-checkpoints'
+
+# Bytes at the start and at the end of the scanned part of a log that are
+# hashed to notice a log that was rewritten in place
+FINGERPRINT_BYTES = 1024
+
+def fingerprint(f, end):
+    """Hash of the first and last FINGERPRINT_BYTES of f[:end], enough to
+    tell an appended-to file from one that was rewritten without reading
+    all of it.
+    """
+    h = hashlib.md5()
+    f.seek(0)
+    h.update(f.read(min(end, FINGERPRINT_BYTES)))
+    start = max(0, end - FINGERPRINT_BYTES)
+    f.seek(start)
+    h.update(f.read(end - start))
+    return h.hexdigest()
+
+class LogCheckpoint:
+    """How far one append-only log file has been scanned, and what was found.
+
+    offset is the end of the last complete line that was scanned, carry holds
+    the trailing partial line (if any).  Only the distinct keys of each event
+    are kept, and the first key seen (which decides the key field of the node
+    events), not every occurrence: the checkpoint is pickled after each
+    refresh and must not grow with the log.  The keys of the partial line are
+    recomputed each time so that a line still being written is reported but
+    never counted twice.
+    """
+
+    def __init__(self, path, events):
+        self.path = path
+        self.events = events
+        self.reset()
+
+    def reset(self):
+        self.inode = None
+        self.size = 0
+        self.mtime = None
+        self.offset = 0
+        self.carry = ''
+        self.fingerprint = None
+        self.keys = {}
+        self.first_keys = {}
+        self.tail_keys = {}
+        self.tail_first_keys = {}
+
+    def signature(self):
+        return (self.inode, self.size, self.mtime, self.offset)
+
+    def get_keys(self, event):
+        return self.keys.get(event, set()) | self.tail_keys.get(event, set())
+
+    def has_first_key(self, event):
+        return self.first_keys.has_key(event) or self.tail_first_keys.has_key(event)
+
+    def get_first_key(self, event):
+        if self.first_keys.has_key(event):
+            return self.first_keys[event]
+        return self.tail_first_keys[event]
+
+    def _scanned_end(self):
+        return self.offset + len(self.carry)
+
+    def _is_continuation(self, f, st):
+        """True if the file is the one scanned before, with bytes appended"""
+        if self.inode is None:
+            return False
+        if st.st_ino != self.inode:
+            # rotated: a new file was moved into place
+            return False
+        if st.st_size < self._scanned_end():
+            # truncated
+            return False
+        return fingerprint(f, self._scanned_end()) == self.fingerprint
+
+    def update(self, f, scan):
+        """Scan whatever was appended to the open file f since last time.
+
+        scan(lines) must return {event: [(datetime, key)]} for the given
+        lines, it is only handed the lines that mention one of the events.
+        Returns False if the file is unchanged and nothing was read.
+        """
+        st = os.fstat(f.fileno())
+        if (st.st_ino, st.st_size, st.st_mtime) == (self.inode, self.size, self.mtime):
+            return False
+
+        if not self._is_continuation(f, st):
+            self.reset()
+
+        # Only look up to the size we saw, a writer appending meanwhile
+        # is picked up next time.
+        buf = event_scanner.map_file(f, st.st_size)
+        if buf:
+            try:
+                complete_end = buf.rfind('\n', self.offset, st.st_size) + 1
+                if complete_end > self.offset:
+                    lines = event_scanner.event_lines(buf, self.events,
+                                                      self.offset, complete_end)
+                    self._add(self.keys, self.first_keys, scan(lines))
+                    self.offset = complete_end
+                self.carry = buf[self.offset:st.st_size]
+            finally:
+                buf.close()
+
+        self.tail_keys = {}
+        self.tail_first_keys = {}
+        if self.carry:
+            self._add(self.tail_keys, self.tail_first_keys, scan([self.carry]))
+
+        self.inode = st.st_ino
+        self.size = st.st_size
+        self.mtime = st.st_mtime
+        self.fingerprint = fingerprint(f, self._scanned_end())
+        return True
+
+    def _add(self, keys, first_keys, records):
+        for event, found in records.iteritems():
+            if not found:
+                continue
+            if not first_keys.has_key(event):
+                first_keys[event] = found[0][1]
+            keys.setdefault(event, set()).update([key for (event_time, key) in found])
+
+class ManifestEntry:
+    """What the event gather last parsed of one file.
+
+    Unlike a LogCheckpoint no events are kept: they were merged into the
+    VM and persisted, all the gather needs to know is whether the file
+    changed since and if it only grew, from where to continue.  The
+    entries are persisted with the events, see Persistence.
+    """
+
+    def __init__(self, path, inode, size, mtime, offset, digest):
+        self.path = path
+        self.inode = inode
+        self.size = size
+        self.mtime = mtime
+        # end of the last complete line parsed
+        self.offset = offset
+        # fingerprint() of the first offset bytes
+        self.fingerprint = digest
+
+    def is_unchanged(self, st):
+        return (st.st_ino, st.st_size, st.st_mtime) == (self.inode, self.size, self.mtime)
+
+    def is_grown(self, f, st):
+        """True if f is the parsed file with bytes appended"""
+        if st.st_ino != self.inode or st.st_size < self.size:
+            return False
+        return fingerprint(f, self.offset) == self.fingerprint
+
+def _load(path, what, log):
+    if not os.path.exists(path):
+        return {}
+    try:
+        f = open(path, 'rb')
+        try:
+            version, contents = cPickle.load(f)
+        finally:
+            f.close()
+    except Exception, e:
+        log.warn("Ignoring unreadable %s '%s': %s" % (what, path, e))
+        return {}
+    if version != CHECKPOINT_VERSION:
+        log.debug("Ignoring %s '%s' with version %s" % (what, path, version))
+        return {}
+    return contents
+
+def _save(path, contents, what, log):
+    tmppath = "%s.%d" % (path, os.getpid())
+    try:
+        f = open(tmppath, 'wb')
+        try:
+            cPickle.dump((CHECKPOINT_VERSION, contents), f, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(tmppath, path)
+    except (IOError, OSError), e:
+        log.warn("Could not save %s '%s': %s" % (what, path, e))
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+
+def load_checkpoints(path, log):
+    """Return {filename: LogCheckpoint} from the store at path, or {}"""
+    return _load(path, "event checkpoints", log)
+
+def save_checkpoints(path, checkpoints, log):
+    """Atomically replace the store at path, failures are only logged"""
+    _save(path, checkpoints, "event checkpoints", log)
@@ -1,6 +1,8 @@
 import datetime
 import json
 from epumgmt.api.exceptions import InvalidConfig
+from epumgmt.defaults import event_scanner
+from epumgmt.defaults import log_checkpoint
 import os
 
 # Torque times are reported using the local timezone, e.g. pacific if using
@@ -180,54 +182,367 @@ class TorqueEvents:
         self.c.log.debug("Event %s times: %s" % (orig_event, event_times))
         return event_times
 
+# The JSON events (NodeEvents, AmqpEvents) are all logged to container logs
+# that runlogs fetches into the run directory, the directory each log is
+# fetched into tells us which events it can hold.
+CONTAINER_LOG_NAME = 'ioncontainer.log'
+PRODUCER_DIR_MARKER = 'producer1-container'
+CONSUMER_DIR_MARKER = 'epuworker_container'
+PROVISIONER_DIR_MARKER = 'provisioner'
+
+PRODUCER_EVENTS = ('job_sent',)
+CONSUMER_EVENTS = ('job_begin', 'job_end')
+PROVISIONER_EVENTS = ('new_node', 'terminated_node', 'node_started', 'launch_ctx_done')
+VMKILL_EVENTS = ('fetch_killed',)
+
+# Events whose key is picked from the first matching line: iaas_id if that
+# line mentions one, node_id otherwise (see RunEventIndex._merge)
+NODE_KEY_EVENTS = ('new_node', 'terminated_node', 'node_started', 'fetch_killed')
+
+def _create_datetime(timestamp):
+    dateTime = datetime.datetime(timestamp['year'], \
+                                 timestamp['month'], \
+                                 timestamp['day'], \
+                                 timestamp['hour'], \
+                                 timestamp['minute'], \
+                                 timestamp['second'], \
+                                 timestamp['microsecond'])
+    return dateTime
+
+def get_run_basedir(p, c, run_name):
+    baseDir = p.get_conf_or_none("events", "runlogdir")
+    if not os.path.isabs(baseDir):
+        baseDir = c.resolve_var_dir(baseDir)
+    return os.path.join(baseDir, run_name)
+
+def _find_container_logs(baseDir, markers):
+    """Walk the run directory once and return {marker: [container logs]}
+    for every directory marker given, in os.walk order.
+    """
+    found = {}
+    for marker in markers:
+        found[marker] = []
+    for root, dirs, files in os.walk(baseDir):
+        if CONTAINER_LOG_NAME not in files:
+            continue
+        dirname = os.path.basename(root)
+        for marker in markers:
+            if marker in dirname:
+                found[marker].append(os.path.join(root, CONTAINER_LOG_NAME))
+    return found
+
+def find_vmkill_logs(p, c, run_name):
+    logName = '--' + run_name + '-fetchkill-'
+    filenames = []
+    baseDir = p.get_conf_or_none("logging", "logfiledir")
+    if not os.path.isabs(baseDir):
+        baseDir = c.resolve_var_dir(baseDir)
+    for root, dirs, files in os.walk(baseDir):
+        for fileName in files:
+            if logName in fileName:
+                filenames.append(os.path.join(root, fileName))
+    return filenames
+
+def _event_record(event, extra, line):
+    """Return the part of a parsed event line the index keeps for event.
+
+    Most events are keyed by a single field of 'extra'.  For the node events
+    the field depends on the first matching line of the whole run, so the
+    candidates are kept and the choice is made when merging.
+    """
+    if event in NODE_KEY_EVENTS:
+        return ('iaas_id' in line, extra.get('iaas_id'), extra.get('node_id'))
+    elif event == 'launch_ctx_done':
+        return extra['node_ids'][0]
+    else:
+        return extra['jobid']
+
+def scan_event_lines(lines, events, log):
+    """Check every line against all of the given events in a single pass.
+
+    Returns {event: [(datetime, key record)]} in line order, a line that
+    mentions several events is only parsed once.
+    """
+    records = {}
+    for event in events:
+        records[event] = []
+    for line in lines:
+        matched = [event for event in events if event in line]
+        if not matched:
+            continue
+        splitline = line.rpartition('JSON:')[2]
+        try:
+            jsonEvent = json.loads(splitline)
+            event_time = _create_datetime(jsonEvent['timestamp'])
+            extra = jsonEvent['extra']
+        except Exception:
+            log.exception("Problem parsing JSON: '%s'" % splitline)
+            continue
+        for event in matched:
+            try:
+                record = _event_record(event, extra, line)
+            except (KeyError, IndexError, TypeError):
+                log.error("No key for event %s in: '%s'" % (event, splitline))
+                continue
+            records[event].append((event_time, record))
+    return records
+
+class RunEventIndex:
+    """Index of the JSON events in the log files of one run.
+
+    Every log file is read once and each line is matched against all of the
+    events that can be in that file, instead of re-reading all files once
+    per requested event.  Logs are only ever appended to, so each file has a
+    LogCheckpoint and a refresh only reads the bytes appended since the last
+    one (a rotated or truncated log is scanned again from the start).  The
+    checkpoints are saved in the run's runlog directory and survive between
+    invocations.
+    """
+
+    def __init__(self, p, c, run_name):
+        self.p = p
+        self.c = c
+        self.run_name = run_name
+        self.workproducerlog_filenames = []
+        self.workconsumerlog_filenames = []
+        self.provisionerlog_filenames = []
+        self.vmkilllog_filenames = []
+        # filename -> LogCheckpoint, loaded on the first refresh
+        self._checkpoints = None
+        # event -> (source signatures, datetimes dict, datetimes list)
+        self._merged = {}
+        # event -> (source signatures, number of distinct keys)
+        self._counts = {}
+        # filename -> (checkpoint signature, {event: [(datetime, key)]})
+        self._records = {}
+
+    def _checkpoint_path(self):
+        return os.path.join(get_run_basedir(self.p, self.c, self.run_name),
+                            log_checkpoint.CHECKPOINT_FILENAME)
+
+    def _update_log_filenames(self, vmkill=False):
+        found = _find_container_logs(get_run_basedir(self.p, self.c, self.run_name),
+                                     (PRODUCER_DIR_MARKER,
+                                      CONSUMER_DIR_MARKER,
+                                      PROVISIONER_DIR_MARKER))
+        self.workproducerlog_filenames = found[PRODUCER_DIR_MARKER]
+        self.workconsumerlog_filenames = found[CONSUMER_DIR_MARKER]
+        self.provisionerlog_filenames = found[PROVISIONER_DIR_MARKER]
+        if vmkill:
+            self.vmkilllog_filenames = find_vmkill_logs(self.p, self.c, self.run_name)
+
+    def _sources(self):
+        """Return [(filename, events)] for every known log file"""
+        sources = []
+        events_by_filename = {}
+        for filenames, events in ((self.workproducerlog_filenames, PRODUCER_EVENTS),
+                                  (self.workconsumerlog_filenames, CONSUMER_EVENTS),
+                                  (self.provisionerlog_filenames, PROVISIONER_EVENTS),
+                                  (self.vmkilllog_filenames, VMKILL_EVENTS)):
+            for filename in filenames:
+                if not events_by_filename.has_key(filename):
+                    events_by_filename[filename] = ()
+                    sources.append(filename)
+                events_by_filename[filename] += events
+        return [(filename, events_by_filename[filename]) for filename in sources]
+
+    def _event_filenames(self, event):
+        if event in PRODUCER_EVENTS:
+            return self.workproducerlog_filenames
+        elif event in CONSUMER_EVENTS:
+            return self.workconsumerlog_filenames
+        elif event in PROVISIONER_EVENTS:
+            return self.provisionerlog_filenames
+        elif event in VMKILL_EVENTS:
+            return self.vmkilllog_filenames
+        return []
+
+    def _scan_file(self, filename, events):
+        """Returns True if the checkpoint of filename changed"""
+        checkpoint = self._checkpoints.get(filename)
+        if not checkpoint or checkpoint.events != events:
+            checkpoint = log_checkpoint.LogCheckpoint(filename, events)
+        scan = lambda lines: scan_event_lines(lines, events, self.c.log)
+        try:
+            event_file = open(filename, 'rb')
+            try:
+                changed = checkpoint.update(event_file, scan)
+            finally:
+                event_file.close()
+        except IOError:
+            self.c.log.error('Failed to open and read from file: ' + \
+                             '%s' % filename)
+            if self._checkpoints.has_key(filename):
+                del self._checkpoints[filename]
+                return True
+            return False
+        if changed:
+            self.c.log.debug("Scanned %s up to byte %d" % (filename, checkpoint.offset))
+        self._checkpoints[filename] = checkpoint
+        return changed
+
+    def refresh(self, vmkill=False):
+        """Pick up new log files and read what was appended to known ones.
+
+        The fetchkill logs live in the (shared) logging directory, they are
+        only looked for when vmkill is True.  Checkpoints of log files that
+        no longer exist are dropped.
+        """
+        if self._checkpoints is None:
+            self._checkpoints = log_checkpoint.load_checkpoints(self._checkpoint_path(),
+                                                                self.c.log)
+        self._update_log_filenames(vmkill)
+        sources = self._sources()
+        changed = False
+        for filename in self._checkpoints.keys():
+            if not os.path.exists(filename):
+                del self._checkpoints[filename]
+                changed = True
+        for filename, events in sources:
+            if self._scan_file(filename, events):
+                changed = True
+        if changed and os.path.isdir(get_run_basedir(self.p, self.c, self.run_name)):
+            log_checkpoint.save_checkpoints(self._checkpoint_path(),
+                                            self._checkpoints, self.c.log)
+
+    def _signatures(self, event):
+        filenames = [f for f in self._event_filenames(event) if self._checkpoints.has_key(f)]
+        return [(f, self._checkpoints[f].signature()) for f in filenames]
+
+    def _node_key(self, event, filename, key, jsonid):
+        """Pick the jsonid field out of a node event key, None if missing"""
+        has_iaas_id, iaas_id, node_id = key
+        if jsonid == 'iaas_id':
+            key = iaas_id
+        else:
+            key = node_id
+        if key is None:
+            self.c.log.error("Event %s in %s has no %s" % (event, filename, jsonid))
+        return key
+
+    def _node_jsonid(self, event, filenames):
+        """The node events are keyed by iaas_id if the first line of the
+        whole run mentions one, by node_id otherwise."""
+        for filename in filenames:
+            checkpoint = self._checkpoints[filename]
+            if checkpoint.has_first_key(event):
+                if checkpoint.get_first_key(event)[0]:
+                    return 'iaas_id'
+                return 'node_id'
+        return None
+
+    def get_event_count(self, event):
+        """Return the number of distinct keys of event, from the checkpoints
+        alone: no log is read again."""
+        signatures = self._signatures(event)
+        cached = self._counts.get(event)
+        if cached and cached[0] == signatures:
+            return cached[1]
+
+        filenames = [f for (f, signature) in signatures]
+        jsonid = None
+        if event in NODE_KEY_EVENTS:
+            jsonid = self._node_jsonid(event, filenames)
+        keys = set()
+        for filename in filenames:
+            for key in self._checkpoints[filename].get_keys(event):
+                if jsonid:
+                    key = self._node_key(event, filename, key, jsonid)
+                    if key is None:
+                        continue
+                keys.add(key)
+        self._counts[event] = (signatures, len(keys))
+        return len(keys)
+
+    def _get_records(self, filename):
+        """Return {event: [(datetime, key)]} for the part of filename its
+        checkpoint covers.  Only the key sets are checkpointed, the records
+        are read again when a file changed and only kept in memory.
+        """
+        checkpoint = self._checkpoints[filename]
+        cached = self._records.get(filename)
+        if cached and cached[0] == checkpoint.signature():
+            return cached[1]
+
+        records = {}
+        try:
+            event_file = open(filename, 'rb')
+            try:
+                size = min(checkpoint.size, os.fstat(event_file.fileno()).st_size)
+                buf = event_scanner.map_file(event_file, size)
+                if buf:
+                    try:
+                        lines = event_scanner.event_lines(buf, checkpoint.events, 0, size)
+                    finally:
+                        buf.close()
+                    records = scan_event_lines(lines, checkpoint.events, self.c.log)
+            finally:
+                event_file.close()
+        except IOError:
+            self.c.log.error('Failed to open and read from file: ' + \
+                             '%s' % filename)
+        self._records[filename] = (checkpoint.signature(), records)
+        return records
+
+    def _merge(self, event):
+        signatures = self._signatures(event)
+        cached = self._merged.get(event)
+        if cached and cached[0] == signatures:
+            return cached
+
+        # Files are merged in the order they were found and later lines win,
+        # which is what reading the files one after the other used to give.
+        filenames = [f for (f, signature) in signatures]
+        jsonid = None
+        if event in NODE_KEY_EVENTS:
+            jsonid = self._node_jsonid(event, filenames)
+        event_times = {}
+        event_list = []
+        for filename in filenames:
+            for event_time, key in self._get_records(filename).get(event, []):
+                if jsonid:
+                    key = self._node_key(event, filename, key, jsonid)
+                    if key is None:
+                        continue
+                event_times[key] = event_time
+                event_list.append(event_time)
+        self._merged[event] = (signatures, event_times, event_list)
+        return self._merged[event]
+
+    def get_event_datetimes_dict(self, event):
+        """Return {key: datetime} for event, last occurrence of a key wins"""
+        return self._merge(event)[1]
+
+    def get_event_datetimes_list(self, event):
+        """Return the datetime of every occurrence of event, in log order"""
+        return self._merge(event)[2]
+
 # Events:
 #  fetch_killed: time VM killed
 #  new_node: node launch time (earlier event)
 #  node_started: node boot time (later event)
 class NodeEvents:
-    def __init__(self, p, c, m, run_name):
+    def __init__(self, p, c, m, run_name, index=None):
         self.p = p
         self.c = c
         self.m = m
         self.run_name = run_name
+        if not index:
+            index = RunEventIndex(p, c, run_name)
+        self.index = index
 
     def _create_datetime(self, timestamp):
-        dateTime = datetime.datetime(timestamp['year'], \
-                                     timestamp['month'], \
-                                     timestamp['day'], \
-                                     timestamp['hour'], \
-                                     timestamp['minute'], \
-                                     timestamp['second'], \
-                                     timestamp['microsecond'])
-        return dateTime
+        return _create_datetime(timestamp)
 
     # node boot times and node launch times
     def _set_provisionerlog_filenames(self):
-        logName = 'ioncontainer.log'
-        filenames = []
-        baseDir = self.p.get_conf_or_none("events", "runlogdir")
-        if not os.path.isabs(baseDir):
-            baseDir = self.c.resolve_var_dir(baseDir)
-        baseDir = os.path.join(baseDir, self.run_name)
-        for root, dirs, files in os.walk(baseDir):
-            if 'provisioner' in os.path.basename(root):
-                if logName in files:
-                    filenames.append(os.path.join(root, logName))
-        self.provisionerlog_filenames = filenames
+        baseDir = get_run_basedir(self.p, self.c, self.run_name)
+        found = _find_container_logs(baseDir, (PROVISIONER_DIR_MARKER,))
+        self.provisionerlog_filenames = found[PROVISIONER_DIR_MARKER]
 
     # vm fetch killed times
     def _set_vmkilllog_filenames(self):
-        logName = '--' + self.run_name + '-fetchkill-'
-        filenames = []
-        baseDir = self.p.get_conf_or_none("logging", "logfiledir")
-        if not os.path.isabs(baseDir):
-            baseDir = self.c.resolve_var_dir(baseDir)
-        for root, dirs, files in os.walk(baseDir):
-            print files
-            for fileName in files:
-                if logName in fileName:
-                    filenames.append(os.path.join(root, fileName))
-        self.vmkilllog_filenames = filenames
+        self.vmkilllog_filenames = find_vmkill_logs(self.p, self.c, self.run_name)
 
     def _update_log_filenames(self):
         self.c.log.debug('Gathering node log filenames')
@@ -239,117 +554,57 @@ class NodeEvents:
         self._set_vmkilllog_filenames()
 
     def get_event_count(self, event):
-        events = self.get_event_datetimes_dict(event)
-        return len(events.keys())
+        if not self._refresh(event):
+            return 0
+        return self.index.get_event_count(event)
 
-    def get_event_datetimes_dict(self, event):
-        # first update the filenames, logs from new instances
+    def _refresh(self, event):
+        if event not in PROVISIONER_EVENTS + VMKILL_EVENTS:
+            self.c.log.error("Unrecognized event: %s" % event)
+            return False
+        # first update the index, logs from new instances
         # may have arrived since we last ran this
-        self._update_log_filenames()
-        filenames = []
+        self.index.refresh(vmkill=event in VMKILL_EVENTS)
+        return True
 
-        if 'launch_ctx_done' == event:
-            jsonid = 'node_ids'
-        else:
-            jsonid = ''
-
-        if 'fetch_killed' == event:
-            filenames = self.vmkilllog_filenames
-        elif 'new_node' == event:
-            filenames = self.provisionerlog_filenames
-        elif 'terminated_node' == event:
-            filenames = self.provisionerlog_filenames
-        elif 'node_started' == event:
-            filenames = self.provisionerlog_filenames
-        elif 'launch_ctx_done' == event:
-            filenames = self.provisionerlog_filenames
-        else:
-            self.c.log.error("Unrecognized event: %s" % event)
+    def get_event_datetimes_dict(self, event):
+        if not self._refresh(event):
             return {}
+        return self.index.get_event_datetimes_dict(event)
 
-        event_times = {}
-        if filenames:
-            for filename in filenames:
-                try:
-                    event_file = open(filename, 'r')
-                    try:
-                        for line in event_file:
-                            if event in line:
-                                if not jsonid:
-                                    if 'iaas_id' in line:
-                                        jsonid = 'iaas_id'
-                                    else:
-                                        jsonid = 'node_id'
-                                splitline = line.rpartition('JSON:')[2]
-                                splitline.strip()
-                                try:
-                                    jsonEvent = json.loads(splitline)
-                                except:
-                                    emsg = "Problem parsing JSON: '%s'"
-                                    self.c.log.exception(emsg % splitline)
-                                    continue
-                                timestamp = jsonEvent['timestamp']
-                                event_time = self._create_datetime(timestamp)
-                                if event == 'launch_ctx_done':
-                                    k = jsonEvent['extra'][jsonid][0]
-                                else:
-                                    k = jsonEvent['extra'][jsonid]
-                                event_times[k] = event_time
-                    finally:
-                        event_file.close()
-                except IOError:
-                    self.c.log.error('Failed to open and read from file: ' + \
-                                     '%s' % filename)
-        return event_times
+    def get_event_datetimes_list(self, event):
+        if not self._refresh(event):
+            return []
+        return self.index.get_event_datetimes_list(event)
 
 # Events:
 #  job_sent: time job sent from amqp server to worker
 #  job_begin: time job starts on worker
 #  job_end: time job ends on worker
 class AmqpEvents:
-    def __init__(self, p, c, m, run_name):
+    def __init__(self, p, c, m, run_name, index=None):
         self.p = p
         self.c = c
         self.m = m
         self.run_name = run_name
+        if not index:
+            index = RunEventIndex(p, c, run_name)
+        self.index = index
 
     def _create_datetime(self, timestamp):
-        dateTime = datetime.datetime(timestamp['year'], \
-                                     timestamp['month'], \
-                                     timestamp['day'], \
-                                     timestamp['hour'], \
-                                     timestamp['minute'], \
-                                     timestamp['second'], \
-                                     timestamp['microsecond'])
-        return dateTime
+        return _create_datetime(timestamp)
 
     # job events: job_sent
     def _set_workproducerlog_filenames(self):
-        logName = 'ioncontainer.log'
-        filenames = []
-        baseDir = self.p.get_conf_or_none("events", "runlogdir")
-        if not os.path.isabs(baseDir):
-            baseDir = self.c.resolve_var_dir(baseDir)
-        baseDir = os.path.join(baseDir, self.run_name)
-        for root, dirs, files in os.walk(baseDir):
-            if 'producer1-container' in os.path.basename(root):
-                if logName in files:
-                    filenames.append(os.path.join(root, logName))
-        self.workproducerlog_filenames = filenames
+        baseDir = get_run_basedir(self.p, self.c, self.run_name)
+        found = _find_container_logs(baseDir, (PRODUCER_DIR_MARKER,))
+        self.workproducerlog_filenames = found[PRODUCER_DIR_MARKER]
 
     # job events: job_begin, job_end
     def _set_workconsumerlog_filenames(self):
-        logName = 'ioncontainer.log'
-        filenames = []
-        baseDir = self.p.get_conf_or_none("events", "runlogdir")
-        if not os.path.isabs(baseDir):
-            baseDir = self.c.resolve_var_dir(baseDir)
-        baseDir = os.path.join(baseDir, self.run_name)
-        for root, dirs, files in os.walk(baseDir):
-            if 'epuworker_container' in os.path.basename(root):
-                if logName in files:
-                    filenames.append(os.path.join(root, logName))
-        self.workconsumerlog_filenames = filenames
+        baseDir = get_run_basedir(self.p, self.c, self.run_name)
+        found = _find_container_logs(baseDir, (CONSUMER_DIR_MARKER,))
+        self.workconsumerlog_filenames = found[CONSUMER_DIR_MARKER]
 
     def _update_log_filenames(self):
         self.c.log.debug('Gathering amqp log filenames')
@@ -361,44 +616,25 @@ class AmqpEvents:
         self._set_workconsumerlog_filenames()
 
     def get_event_count(self, event):
-        events = self.get_event_datetimes_dict(event)
-        return len(events.keys())
+        if not self._refresh(event):
+            return 0
+        return self.index.get_event_count(event)
 
-    def get_event_datetimes_dict(self, event):
-        # first update the filenames, logs from new instances
-        # may have arrived since we last ran this
-        self._update_log_filenames()
-        filenames = []
-        jsonid = ''
-        if ('job_begin' == event) or ('job_end' == event):
-            filenames = self.workconsumerlog_filenames
-            jsonid = 'jobid'
-        elif 'job_sent' == event:
-            filenames = self.workproducerlog_filenames
-            jsonid = 'jobid'
-        else:
+    def _refresh(self, event):
+        if event not in PRODUCER_EVENTS + CONSUMER_EVENTS:
             self.c.log.error("Unrecognized event: %s" % event)
-            return {}
+            return False
+        # first update the index, logs from new instances
+        # may have arrived since we last ran this
+        self.index.refresh()
+        return True
 
-        event_times = {}
-        if filenames:
-            for filename in filenames:
-                try:
-                    event_file = open(filename, 'r')
-                    try:
-                        for line in event_file:
-                            if event in line:
-                                splitline = line.rpartition('JSON:')[2]
-                                splitline.strip()
-                                jsonEvent = json.loads(splitline)
-                                timestamp = jsonEvent['timestamp']
-                                event_time = self._create_datetime(timestamp)
-                                k = jsonEvent['extra'][jsonid]
-                                event_times[k] = event_time
-                    finally:
-                        event_file.close()
-                except IOError:
-                    self.c.log.error('Failed to open and read from file: ' + \
-                                     '%s' % filename)
-        return event_times
+    def get_event_datetimes_dict(self, event):
+        if not self._refresh(event):
+            return {}
+        return self.index.get_event_datetimes_dict(event)
 
+    def get_event_datetimes_list(self, event):
+        if not self._refresh(event):
+            return []
+        return self.index.get_event_datetimes_list(event)
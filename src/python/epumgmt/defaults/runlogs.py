@@ -5,6 +5,9 @@ from epumgmt.api.exceptions import *
 import epumgmt.main.em_args as em_args
 
 import child
+from sshmux import multiplexed
+
+FETCH_TIMEOUT = 3120.0 # seconds
 
 class DefaultRunlogs:
     
@@ -121,11 +124,41 @@ class DefaultRunlogs:
             raise ProgrammingError("operation called without necessary validation")
         self._run_one_cmd(scpcmd)
 
+    def fetch_logs_all(self, scpcmds):
+        """Run scp commands at the same time, at most [ssh] max_running of
+        them (see child.Executor).
+
+        scpcmds -- list of (key, scpcmd)
+
+        Returns {key: None or the exception for a command that failed}
+        """
+        if not self.validated:
+            raise ProgrammingError("operation called without necessary validation")
+        executor = child.Executor(max_running=child.get_max_running(self.p))
+        for (key, scpcmd) in scpcmds:
+            cmd = multiplexed(self.p, self.c, scpcmd)
+            self.c.log.debug("command = '%s'" % cmd)
+            executor.submit(cmd, timeout=FETCH_TIMEOUT, key=key)
+        errors = {}
+        for result in executor.run():
+            try:
+                self._check_result(result.cmd, result.killed, result.exitcode,
+                                   result.stdout, result.stderr)
+                errors[result.key] = None
+            except Exception, e:
+                errors[result.key] = e
+            if self.c.trace:
+                self.c.log.debug("%s: %.2fs, %d bytes of output" %
+                        (result.key, result.duration, result.stdout_bytes + result.stderr_bytes))
+        return errors
+
     def _run_one_cmd(self, cmd):
+        cmd = multiplexed(self.p, self.c, cmd)
         self.c.log.debug("command = '%s'" % cmd)
-        timeout = 3120.0 # seconds
-        (killed, retcode, stdout, stderr) = child.child(cmd, timeout=timeout)
+        (killed, retcode, stdout, stderr) = child.child(cmd, timeout=FETCH_TIMEOUT)
+        self._check_result(cmd, killed, retcode, stdout, stderr)
 
+    def _check_result(self, cmd, killed, retcode, stdout, stderr):
         if killed:
             raise Exception("TIMED OUT: '%s'" % cmd)
 
@@ -0,0 +1,128 @@
+import os
+import shutil
+import tempfile
+import threading
+
+from epumgmt.api.exceptions import *
+from epumgmt.defaults.child import Executor
+
+# The ssh and scp commands cloudinit.d gives out are strings starting with
+# the program (see CLOUDINITD_SSH and CLOUDINITD_SCP), options can go
+# right after it
+SSH_PROGRAMS = ("ssh", "scp")
+
+# Seconds an idle master stays up, also how long one outlives an
+# invocation that could not close it
+DEFAULT_CONTROLPERSIST = 300
+
+# Parameters -> SSHMultiplexer: every invocation (every p) has masters of
+# its own, even when several run in one process
+_multiplexers = {}
+_lock = threading.Lock()
+
+def multiplexed(p, c, cmd):
+    """Return cmd going through the invocation's master connection to its
+    host: the first ssh or scp command to a host starts the master in the
+    background, the following ones reuse it instead of connecting and
+    authenticating again.
+
+    cmd is returned as it is if it is not an ssh or scp command or if
+    [ssh] multiplex is off.
+    """
+    _lock.acquire()
+    try:
+        mux = _multiplexers.get(p)
+        if mux is None:
+            mux = SSHMultiplexer(p, c)
+            _multiplexers[p] = mux
+    finally:
+        _lock.release()
+    return mux.rewrite(cmd)
+
+def close_masters(p=None):
+    """Stop the master connections multiplexed() started for the invocation
+    with parameters p, or for every invocation if p is None.
+    """
+    _lock.acquire()
+    try:
+        if p is None:
+            muxes = _multiplexers.values()
+            _multiplexers.clear()
+        else:
+            muxes = [_multiplexers.pop(p)] if _multiplexers.has_key(p) else []
+    finally:
+        _lock.release()
+    for mux in muxes:
+        mux.close()
+
+class SSHMultiplexer:
+    """Rewrites ssh and scp commands to share one connection per host, with
+    OpenSSH's ControlMaster.  The control sockets are in a directory of
+    their own that close() removes.
+    """
+
+    def __init__(self, p, c):
+        self.c = c
+        self.enabled = _get_multiplex(p)
+        self.controlpersist = _get_controlpersist(p)
+        self.controldir = None
+
+    def _get_controldir(self):
+        # Sockets have a short path limit, so not under the var directory
+        if not self.controldir:
+            self.controldir = tempfile.mkdtemp(prefix="epumgmt-ssh-")
+            self.c.log.debug("SSH control sockets in %s" % self.controldir)
+        return self.controldir
+
+    def rewrite(self, cmd):
+        if not self.enabled or not cmd:
+            return cmd
+        parts = cmd.split(None, 1)
+        if os.path.basename(parts[0]) not in SSH_PROGRAMS:
+            return cmd
+        options = "-o ControlMaster=auto -o ControlPath=%s -o ControlPersist=%d" % \
+                  (os.path.join(self._get_controldir(), "%r@%h:%p"), self.controlpersist)
+        if len(parts) == 1:
+            return "%s %s" % (parts[0], options)
+        return "%s %s %s" % (parts[0], options, parts[1])
+
+    def get_sockets(self):
+        if not self.controldir or not os.path.isdir(self.controldir):
+            return []
+        return [os.path.join(self.controldir, name) for name in sorted(os.listdir(self.controldir))]
+
+    def close(self):
+        executor = Executor()
+        for socket in self.get_sockets():
+            # The host is not used, the socket says where the master is
+            cmd = ["ssh", "-o", "ControlPath=%s" % socket, "-O", "exit", "epumgmt-master"]
+            executor.submit(cmd, timeout=10, key=socket)
+        for result in executor.run():
+            if not result.succeeded():
+                self.c.log.debug("Could not stop SSH master %s: %s" % (result.key, result.stderr))
+        if self.controldir:
+            shutil.rmtree(self.controldir, ignore_errors=True)
+            self.controldir = None
+
+def _get_multiplex(p):
+    multiplex = p.get_conf_or_none("ssh", "multiplex")
+    if not multiplex:
+        return False
+    multiplex = multiplex.strip().lower()
+    if multiplex in ("true", "yes", "1"):
+        return True
+    if multiplex in ("false", "no", "0"):
+        return False
+    raise InvalidConfig("ssh->multiplex must be true or false: '%s'" % multiplex)
+
+def _get_controlpersist(p):
+    controlpersist = p.get_conf_or_none("ssh", "controlpersist")
+    if not controlpersist:
+        return DEFAULT_CONTROLPERSIST
+    try:
+        controlpersist = int(controlpersist)
+        if controlpersist < 1:
+            raise ValueError()
+    except ValueError:
+        raise InvalidConfig("ssh->controlpersist must be a number of seconds > 0: '%s'" % controlpersist)
+    return controlpersist
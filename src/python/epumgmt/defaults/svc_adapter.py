@@ -1,14 +1,138 @@
 from epumgmt.api import EPUControllerState, WorkerInstanceState, RunVM
 from epumgmt.defaults.cloudinitd_load import get_cloudinitd_service
-from epumgmt.defaults.child import child
+from epumgmt.defaults.child import child, Executor, get_max_running
+from epumgmt.defaults.sshmux import multiplexed
 from epumgmt.api.exceptions import *
-from datetime import timedelta
 import epustates
 import os
+import re
 import json
 import time
 import uuid
 
+# How worker_state() gets the epu-state result, see svcadapter.conf
+STATE_QUERY_FILE = "file"
+STATE_QUERY_STDOUT = "stdout"
+STATE_QUERY_MODES = (STATE_QUERY_FILE, STATE_QUERY_STDOUT)
+
+# What epu-state is told to write the result to in the stdout mode
+STATE_STDOUT_PATH = "/dev/stdout"
+
+# Seconds a state query may take, for each controller when they are
+# queried separately
+DEFAULT_STATE_QUERY_TIMEOUT = 30
+
+# What StateStreamParser looks at in the result: the braces that nest
+# objects, and the quotes and escapes that tell the braces in strings apart
+RESULT_TOKENS = re.compile(r'[{}"\\]')
+
+class StateStreamParser:
+    """Picks the epu-state JSON result out of a command's stdout, as it
+    arrives.  Anything printed before the result (lines not starting
+    with "{") is skipped, and so is anything printed after it.
+
+    Each chunk is only scanned once, for the brace that closes the result,
+    and the result is decoded once, when it is asked for.
+    """
+
+    def __init__(self):
+        self.decoder = json.JSONDecoder()
+        # the partial line the result may start in, until it does
+        self.pending = ""
+        self.started = False
+        # the result so far, from its "{" on
+        self.chunks = []
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.complete = False
+        self.result = None
+
+    def feed(self, data):
+        """Called with each chunk of stdout, see child()"""
+        if self.complete:
+            return
+        if not self.started:
+            data = self._find_start(self.pending + data)
+            if data is None:
+                return
+        end = self._scan(data)
+        if end is None:
+            self.chunks.append(data)
+        else:
+            self.chunks.append(data[:end])
+            self.complete = True
+
+    def _find_start(self, buf):
+        """The part of buf from the start of the result on, None if it is
+        not in there yet"""
+        if buf.startswith("{"):
+            idx = 0
+        else:
+            idx = buf.find("\n{")
+            if idx < 0:
+                # Keep only what could be the start of the line with the result
+                self.pending = buf[buf.rfind("\n") + 1:]
+                return None
+            idx += 1
+        self.pending = ""
+        self.started = True
+        return buf[idx:]
+
+    def _scan(self, data):
+        """Follow the nesting through data, return the offset just past
+        the brace that closes the result or None if it is still open"""
+        skip_to = 0
+        if self.escaped and data:
+            # the character after a backslash that ended the last chunk
+            self.escaped = False
+            skip_to = 1
+        for match in RESULT_TOKENS.finditer(data):
+            if match.start() < skip_to:
+                continue
+            token = match.group()
+            if self.in_string:
+                if token == "\\":
+                    skip_to = match.end() + 1
+                    if skip_to > len(data):
+                        self.escaped = True
+                elif token == '"':
+                    self.in_string = False
+            elif token == '"':
+                self.in_string = True
+            elif token == "{":
+                self.depth += 1
+            elif token == "}":
+                self.depth -= 1
+                if self.depth == 0:
+                    return match.end()
+        return None
+
+    def get_result(self):
+        """The decoded result, raises UnexpectedError if there was none"""
+        if self.result is not None:
+            return self.result
+        if not self.started:
+            raise UnexpectedError("No state query result in the output")
+        try:
+            self.result = self.decoder.raw_decode("".join(self.chunks).decode("utf-8"))[0]
+        except ValueError, e:
+            raise UnexpectedError("Could not parse the state query result: %s" % e)
+        return self.result
+
+class StateQuery:
+    """The commands of an epu-state query, see DefaultRemoteSvcAdapter"""
+
+    def __init__(self, provisioner_vm):
+        self.provisioner_vm = provisioner_vm
+        self.cmd = None
+        # Only when the result is written to a file and copied back
+        self.scpcmd = None
+        self.filename = None
+        self.remote_filename = None
+        # Only when the result is read from the ssh command's stdout
+        self.parser = None
+
 class DefaultRemoteSvcAdapter:
 
     def __init__(self, params, common):
@@ -24,6 +148,13 @@ class DefaultRemoteSvcAdapter:
         self.cloudinitd = None
         self.homedir = None
         self.envfile = None
+        self.state_query = None
+        self.state_query_fanout = False
+        self.state_query_timeout = DEFAULT_STATE_QUERY_TIMEOUT
+
+        # {controller name: reason} of the controllers the last
+        # worker_state() call got no state from
+        self.failed_controllers = {}
 
         # These may or may not be present at a given time
         self.provisioner = None
@@ -58,6 +189,28 @@ class DefaultRemoteSvcAdapter:
         self.envfile = self.p.get_conf_or_none("svcadapter", "envfile")
         if not self.envfile:
             raise InvalidConfig("Missing configuration: [svcadapter] -> envfile")
+
+        self.state_query = self.p.get_conf_or_none("svcadapter", "state_query")
+        if not self.state_query:
+            self.state_query = STATE_QUERY_FILE
+        if self.state_query not in STATE_QUERY_MODES:
+            raise InvalidConfig("[svcadapter] -> state_query must be one of %s: '%s'" %
+                                (", ".join(STATE_QUERY_MODES), self.state_query))
+
+        fanout = self.p.get_conf_or_none("svcadapter", "state_query_fanout")
+        if fanout:
+            if fanout.lower() not in ("true", "false"):
+                raise InvalidConfig("[svcadapter] -> state_query_fanout must be true or false: '%s'" % fanout)
+            self.state_query_fanout = fanout.lower() == "true"
+
+        timeout = self.p.get_conf_or_none("svcadapter", "state_query_timeout")
+        if timeout:
+            try:
+                self.state_query_timeout = float(timeout)
+                if self.state_query_timeout <= 0:
+                    raise ValueError()
+            except ValueError:
+                raise InvalidConfig("[svcadapter] -> state_query_timeout must be a number of seconds > 0: '%s'" % timeout)
         
         self.initialized = True
 
@@ -124,7 +277,12 @@ class DefaultRemoteSvcAdapter:
 
         Returns dictionary of { controller_name -> EPUControllerState instance }
 
-        Raise Exception if state retrieval fails
+        With [svcadapter] state_query_fanout each controller is queried
+        separately, at the same time: the dictionary then only has the
+        controllers that answered in time, see failed_controllers for the
+        others.
+
+        Raise Exception if state retrieval fails (for all controllers)
         """
 
         if not provisioner_vm:
@@ -140,20 +298,109 @@ class DefaultRemoteSvcAdapter:
         if not provisioner_vm.hostname:
             raise IncompatibleEnvironment("Cannot get state of provisionner that doesn't (yet) have a hostname")
 
-        filename = "epu-worker-state-%s" % str(uuid.uuid4())
+        self.failed_controllers = {}
+        unique = []
+        for controller in controllers:
+            if controller not in unique:
+                unique.append(controller)
+        if self.state_query_fanout and len(unique) > 1:
+            return self._worker_state_fanout(provisioner_vm, unique)
+        query = self._prepare_state_query(provisioner_vm, controllers)
+        return self._run_state_query(query, self.state_query_timeout)
+
+    def _prepare_state_query(self, provisioner_vm, controllers):
+        """The commands of an epu-state query for the controllers.  They
+        come from cloudinit.d, which can only be used from the thread that
+        loaded it: this is done there, see _run_state_query().
+        """
+        query = StateQuery(provisioner_vm)
+        if self.state_query == STATE_QUERY_STDOUT:
+            # epu-state writes the result on the ssh command's stdout
+            query.parser = StateStreamParser()
+            extra_args = [STATE_STDOUT_PATH]
+        else:
+            query.filename = "epu-worker-state-%s" % str(uuid.uuid4())
+            (abs_homedir, abs_envfile) = \
+                self._get_pathconfs("provisioner", self._get_provisioner().get_scp_username())
+            query.remote_filename = "%s/logs/%s" % (abs_homedir, query.filename)
+            query.scpcmd = self.m.runlogs.get_onefile_scp_command_str(
+                    self.c, provisioner_vm, self.cloudinitd, query.remote_filename)
+            extra_args = [query.remote_filename]
+        extra_args.extend(controllers)
+        query.cmd = self._get_provisioner().get_ssh_command()
+        query.cmd += ' ' + self._get_epu_script_cmd_provisioner("epu-state", extras=extra_args)
+        return query
 
-        (abs_homedir, abs_envfile) = \
-            self._get_pathconfs("provisioner", self._get_provisioner().get_scp_username())
-        remote_filename = "%s/logs/%s" % (abs_homedir, filename)
+    def _run_state_query(self, query, timeout):
+        """Returns dictionary of { controller_name -> EPUControllerState instance }
+        """
+        if query.parser:
+            if not self._run_one_cmd(query.cmd, timeout=timeout, stdout_consumer=query.parser.feed):
+                raise UnexpectedError("Could not run state query")
+            return self._intake_query_result_dict(query.parser.get_result())
 
-        extra_args = [remote_filename]
-        extra_args.extend(controllers)
-        cmd = self._get_provisioner().get_ssh_command()
-        cmd += ' ' + self._get_epu_script_cmd_provisioner("epu-state", extras=extra_args)
-        if not self._run_one_cmd(cmd):
+        if not self._run_one_cmd(query.cmd, timeout=timeout):
             raise UnexpectedError("Could not run state query")
+        return self._intake_query_result(query.provisioner_vm, query.filename,
+                                         query.remote_filename, query.scpcmd)
+
+    def _worker_state_fanout(self, provisioner_vm, controllers):
+        """worker_state() with a query per controller, run at the same
+        time, each with its own deadline.  A slow or failing controller
+        only loses its own state.
+        """
+        queries = {}
+        for controller in controllers:
+            queries[controller] = self._prepare_state_query(provisioner_vm, [controller])
+
+        cmds = []
+        for controller in controllers:
+            query = queries[controller]
+            consumer = None
+            if query.parser:
+                consumer = query.parser.feed
+            cmds.append((controller, query.cmd, consumer))
+        results = self._run_cmds(cmds, self.state_query_timeout)
+
+        answered = []
+        for controller in controllers:
+            result = results[controller]
+            if result.killed:
+                self.failed_controllers[controller] = "timed out"
+            elif not self._check_result(result.cmd, *result.as_tuple()):
+                self.failed_controllers[controller] = "Could not run state query"
+            else:
+                answered.append(controller)
+
+        # With the file mode the results are then copied back, also all at once
+        scpcmds = [(controller, queries[controller].scpcmd, None)
+                   for controller in answered if queries[controller].scpcmd]
+        copied = self._run_cmds(scpcmds, self.state_query_timeout)
+
+        controller_state_map = {}
+        for controller in answered:
+            query = queries[controller]
+            try:
+                if query.parser:
+                    result = self._intake_query_result_dict(query.parser.get_result())
+                else:
+                    if not self._check_result(query.scpcmd, *copied[controller].as_tuple()):
+                        raise UnexpectedError("Could not obtain state query result")
+                    result = self._read_query_result(provisioner_vm, query.filename)
+            except Exception, e:
+                self.failed_controllers[controller] = str(e)
+                continue
+            if not result.has_key(controller):
+                self.failed_controllers[controller] = "not in the query result"
+            else:
+                controller_state_map[controller] = result[controller]
 
-        return self._intake_query_result(provisioner_vm, filename, remote_filename)
+        for controller in controllers:
+            if self.failed_controllers.has_key(controller):
+                self.c.log.warn("No state from controller '%s': %s" % (controller, self.failed_controllers[controller]))
+        if not controller_state_map:
+            raise UnexpectedError("Could not get the state of any controller: %s" % ", ".join(controllers))
+        return controller_state_map
 
     def controller_map(self, allvms):
         """Returns dictionary of { instanceid --> list of controller service addressess }
@@ -193,9 +440,14 @@ class DefaultRemoteSvcAdapter:
         """
         if not vm_list:
             return []
+        for vm in vm_list:
+            if not vm or not vm.instanceid:
+                raise ProgrammingError("VM required and required to have instanceid: %s" % vm)
+        # one query for all of them
+        states = self._latest_iaas_states(vm_list)
         ok = []
         for vm in vm_list:
-            if self.running_iaas_status(vm, include_pending=include_pending):
+            if self._running_state(states.get(vm.instanceid), include_pending):
                 ok.append(vm)
         return ok
 
@@ -207,16 +459,7 @@ class DefaultRemoteSvcAdapter:
         if not vm or not vm.instanceid:
             raise ProgrammingError("VM required and required to have instanceid: %s" % vm)
 
-        latest = self.latest_iaas_status(vm)
-        if not latest:
-            # We don't have IaaS info for the "turtle" VMs yet: they default to True
-            return True
-        if latest in [epustates.STARTED, epustates.RUNNING]:
-            return True
-        if include_pending:
-            if latest in [epustates.PENDING, epustates.ERROR_RETRYING, epustates.REQUESTED, epustates.REQUESTING]:
-                return True
-        return False
+        return self._running_state(self.latest_iaas_status(vm), include_pending)
 
     def latest_iaas_status(self, vm):
         """Return iaas status or None if it cannot be determined
@@ -224,26 +467,34 @@ class DefaultRemoteSvcAdapter:
         if not vm or not vm.instanceid:
             raise ProgrammingError("VM required and required to have instanceid: %s" % vm)
 
-        # todo: switch to SQL query. There are far bigger performance issues in other parts
-        d = timedelta(minutes=0)
-        latest = None
-        for ev in vm.events:
-            if ev.name == "iaas_state":
-                if not latest:
-                    latest = ev
-                elif (ev.timestamp - latest.timestamp) > d:
-                    latest = ev
-        if not latest:
-            return None
-        if not latest.extra or not latest.extra.has_key("state"):
-            raise ProgrammingError("iaas_state event has unexpected structure: %s" % latest.extra)
-        return latest.extra["state"]
+        return self._latest_iaas_states([vm]).get(vm.instanceid)
 
 
     # ----------------------------------------------------------------------------------------------------
     # IMPL methods
     # ----------------------------------------------------------------------------------------------------
 
+    def _latest_iaas_states(self, vms):
+        """Return {instanceid: iaas status} of the VMs that have one"""
+        self._check_init()
+        vm_states = self.m.persistence.get_vm_states(self.run_name, vms)
+        states = {}
+        for instanceid, vm_state in vm_states.iteritems():
+            if vm_state.iaas_state:
+                states[instanceid] = vm_state.iaas_state
+        return states
+
+    def _running_state(self, latest, include_pending):
+        if not latest:
+            # We don't have IaaS info for the "turtle" VMs yet: they default to True
+            return True
+        if latest in [epustates.STARTED, epustates.RUNNING]:
+            return True
+        if include_pending:
+            if latest in [epustates.PENDING, epustates.ERROR_RETRYING, epustates.REQUESTED, epustates.REQUESTING]:
+                return True
+        return False
+
     def _check_init(self):
         if not self.initialized:
             raise ProgrammingError("You can not use this module without initializing it")
@@ -300,13 +551,35 @@ class DefaultRemoteSvcAdapter:
         abs_envfile = self._reconcile_relative_conf(self.envfile, username, source)
         return abs_homedir, abs_envfile
 
-    def  _run_one_cmd(self, cmd, timeout=30):
+    def  _run_one_cmd(self, cmd, timeout=30, stdout_consumer=None):
         """Runs a command and handles timeouts and failures.
            Default timeout is 30 secs
         """
+        cmd = multiplexed(self.p, self.c, cmd)
         self.c.log.debug("command = '%s'" % cmd)
-        (killed, retcode, stdout, stderr) = child(cmd, timeout=timeout)
+        (killed, retcode, stdout, stderr) = child(cmd, timeout=timeout,
+                                                  stdout_consumer=stdout_consumer)
+        return self._check_result(cmd, killed, retcode, stdout, stderr)
 
+    def _run_cmds(self, cmds, timeout):
+        """Runs commands at the same time, at most [ssh] max_running of them.
+
+        cmds -- list of (key, cmd, stdout_consumer or None)
+
+        Returns dictionary of { key -> child.ChildResult }, see _check_result()
+        """
+        executor = Executor(max_running=get_max_running(self.p))
+        for (key, cmd, stdout_consumer) in cmds:
+            cmd = multiplexed(self.p, self.c, cmd)
+            self.c.log.debug("command = '%s'" % cmd)
+            executor.submit(cmd, timeout=timeout, stdout_consumer=stdout_consumer, key=key)
+        results = {}
+        for result in executor.run():
+            results[result.key] = result
+        return results
+
+    def _check_result(self, cmd, killed, retcode, stdout, stderr):
+        """Logs what went wrong, returns True if the command succeeded"""
         if killed:
             self.c.log.error("TIMED OUT: '%s'" % cmd)
             return False
@@ -325,14 +598,20 @@ class DefaultRemoteSvcAdapter:
             self.c.log.error(errmsg)
             return False
 
-    def _intake_query_result(self, provisioner_vm, filename, remote_filename):
+    def _intake_query_result(self, provisioner_vm, filename, remote_filename, scpcmd=None):
         """Returns dictionary of { controller_name -> EPUControllerState instance }
         """
 
-        scpcmd = self.m.runlogs.get_onefile_scp_command_str(self.c, provisioner_vm, self.cloudinitd, remote_filename)
+        if not scpcmd:
+            scpcmd = self.m.runlogs.get_onefile_scp_command_str(self.c, provisioner_vm, self.cloudinitd, remote_filename)
         if not self._run_one_cmd(scpcmd):
             raise UnexpectedError("Could not obtain state query result")
+        return self._read_query_result(provisioner_vm, filename)
 
+    def _read_query_result(self, provisioner_vm, filename):
+        """Returns dictionary of { controller_name -> EPUControllerState instance }
+        from the state query result copied back to the run's logs
+        """
         local_filename = os.path.join(provisioner_vm.runlogdir, filename)
         if os.path.exists(local_filename):
             self.c.log.debug("State query result: %s" % local_filename)
@@ -347,7 +626,12 @@ class DefaultRemoteSvcAdapter:
         f = open(local_filename)
         result = json.load(f)
         f.close()
+        return self._intake_query_result_dict(result)
 
+    def _intake_query_result_dict(self, result):
+        """Returns dictionary of { controller_name -> EPUControllerState instance }
+        from the decoded state query result
+        """
         controller_state_map = {}
 
         controllers = result.keys()
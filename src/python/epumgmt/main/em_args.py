@@ -37,12 +37,24 @@ NAME.help = "Unique run name for logs and management.  Can use across multiple i
 
 GRAPH_NAME = ControlArg("graphname", "-r", metavar="GRAPH_NAME")
 a.append(GRAPH_NAME)
-GRAPH_NAME.help = "For the generate-graph action, name of graph to generate: stacked-vms, job-tts, job-rate, node-info, or controller."
+GRAPH_NAME.help = "For the generate-graph action, name of graph to generate: stacked-vms, job-tts, job-rate, node-info, or controller.  Use 'all' or a comma separated list to generate several from one parse of the logs."
 
 GRAPH_TYPE = ControlArg("graphtype", "-t", metavar="GRAPH_TYPE")
 a.append(GRAPH_TYPE)
 GRAPH_TYPE.help = "For the generate-graph action, output file type: eps or png."
 
+GRAPH_PROCESSES = ControlArg("graph-processes", None, metavar="NUM")
+a.append(GRAPH_PROCESSES)
+GRAPH_PROCESSES.help = "For the generate-graph action with several graph names, number of processes rendering graphs in parallel.  Default is 1."
+
+GRAPH_RESOLUTION = ControlArg("graph-resolution", None, metavar="SECONDS")
+a.append(GRAPH_RESOLUTION)
+GRAPH_RESOLUTION.help = "For the generate-graph action, seconds per point of the graphs over evaluation time (stacked-vms, job-rate, controller), e.g. 10, 10s, 1m or 'auto' to fit the length of the evaluation.  Default is 1."
+
+GRAPH_WINDOW = ControlArg("graph-window", None, metavar="START:END")
+a.append(GRAPH_WINDOW)
+GRAPH_WINDOW.help = "For the generate-graph action, only graph the evaluation seconds from START to END (e.g. 2h:3h), either can be left out."
+
 WORKLOAD_FILE = ControlArg("workloadfilename", "-f", metavar="WORKLOAD_FILE")
 a.append(WORKLOAD_FILE)
 WORKLOAD_FILE.help = "For the execute-workload-test action, file name of workload definition file."
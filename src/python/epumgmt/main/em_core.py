@@ -8,6 +8,7 @@ from epumgmt.api.actions import ACTIONS
 from epumgmt.main import get_class_by_keyword, get_all_configs
 from epumgmt.main import Modules
 import epumgmt.main.em_args as em_args
+import epumgmt.defaults.sshmux as sshmux
 import em_core_load
 import em_core_eventgather
 import em_core_findworkers
@@ -90,6 +91,8 @@ def core(opts, dbgmsgs=None):
         # Important for invocation logs to also record any problem
         c.log.exception("")
         raise
+    finally:
+        sshmux.close_masters(p)
         
 def _core(action, p, c):
         
@@ -144,6 +147,8 @@ def _core(action, p, c):
         c.log.info("Load only, done.")
     elif action == ACTIONS.UPDATE_EVENTS:
         em_core_eventgather.update_events(p, c, modules, run_name)
+    elif action == ACTIONS.COMPACT_EVENTS:
+        em_core_eventgather.compact_events(p, c, modules, run_name)
     elif action == ACTIONS.KILLRUN:
         no_fetch = p.get_arg_or_none(em_args.KILLRUN_NOFETCH)
         try:
@@ -179,7 +184,7 @@ def _core(action, p, c):
         except ImportError:
             c.log.exception("")
             raise IncompatibleEnvironment("Problem with graphing dependencies: do you have "
-            "matplotlib installed? (matplotlib is the source of the 'pylab' module)")
+            "numpy and matplotlib installed?")
         em_core_generategraph.generate_graph(p, c, modules, run_name)
     elif action == ACTIONS.RECONFIGURE_N:
         em_core_reconfigure.reconfigure_n(p, c, modules, run_name, cloudinitd)
@@ -296,13 +301,28 @@ class EPUMgmtAction(object):
 
         # TODO: fname
 
+    def close(self):
+        """Stop the SSH master connections the calls so far started, they
+        are otherwise kept until they are idle for ssh->controlpersist
+        """
+        sshmux.close_masters(self.p)
+
+    def _fresh(self, runname):
+        """Every call is an invocation of its own: what persistence cached
+        of the run before may have been changed by other processes since.
+        """
+        self.m.persistence.clear_run_cache(runname)
+
     def load(self, runname):
+        self._fresh(runname)
         return em_core_load.load(self.p, self.c, self.m, runname)
 
     def update(self, runname):
+        self._fresh(runname)
         return em_core_eventgather.update_events(self.p, self.c, self.m, runname)
 
     def kill(self, runname, cloudinitd):
+        self._fresh(runname)
         try:
             em_core_findworkers.find_once(self.p, self.c, self.m, runname)
             em_core_logfetch.fetch_all(self.p, self.c, self.m, runname, cloudinitd)
@@ -317,9 +337,11 @@ class EPUMgmtAction(object):
     # em_core_fetchkill.fetch_kill(self.p, self.c, self.m, runname)
 
     def logfetch(self, runname):
+        self._fresh(runname)
         return em_core_logfetch.fetch_all(self.p, self.c, self.m, runname)
 
     def findworkers(self, runname):
+        self._fresh(runname)
         return em_core_findworkers.find_once(self.p, self.c, self.m, ACTIONS.FIND_WORKERS_ONCE, runname)
 
 
@@ -6,6 +6,15 @@ def update_events(p, c, m, run_name):
     """
     m.event_gather.populate_run_vms(m, run_name)
 
+def compact_events(p, c, m, run_name):
+    """Remove the status events of the run that only repeat the previous
+    state, see Persistence.compact_events()
+    """
+    if not m.persistence.get_run_vms(run_name, with_events=False):
+        raise IncompatibleEnvironment("Cannot find any VMs associated with run '%s'" % run_name)
+    removed = m.persistence.compact_events(run_name)
+    c.log.info("Removed %d repeated status events from run '%s'" % (removed, run_name))
+
 def _get_runvms_required(persistence, run_name):
     run_vms = persistence.get_run_vms_or_none(run_name)
     if not run_vms or len(run_vms) == 0:
@@ -1,12 +1,10 @@
 from epumgmt.api.exceptions import *
 from epumgmt.api import RunVM
 from epumgmt.main import em_args
-from epumgmt.main.em_core_logfetch import FetchThread
+from epumgmt.main.em_core_logfetch import fetch_vms
 import cloudyvents.cyvents as cyvents
 from epumgmt.main import em_core_status
 
-THREADS_PER_BATCH = 20
-
 def fetch_kill(p, c, m, run_name, cloudinitd, controller_name=None):
     """Get logs and then kill a worker.
     If controller_name is not supplied to this function, it is expected to be in the cmdline args
@@ -58,37 +56,17 @@ def fetch_kill_byID(p, c, m, run_name, cloudinitd, tokill_list, get_workerstatus
         # Get the latest information, especially for IaaS status and controller correlation
         em_core_status.find_latest_status(p, c, m, run_name, cloudinitd, findworkersfirst=False)
 
-    threads = []
+    fetches = []
     for one_kill in tokill_list:
         scpcmd = m.runlogs.get_scp_command_str(c, one_kill, cloudinitd)
-        threads.append(FetchThread(one_kill, c, m, scpcmd))
+        fetches.append((one_kill, scpcmd))
 
     txt = "%d worker" % len(tokill_list)
     if len(tokill_list) != 1:
         txt += "s"
     c.log.info("Beginning to fetch and kill %s" % txt)
 
-    done = False
-    idx = 0
-    while not done:
-        current_batch = threads[idx:idx+THREADS_PER_BATCH]
-        idx += THREADS_PER_BATCH
-        if idx > len(threads):
-            done = True
-            
-        for thr in current_batch:
-            thr.start()
-           
-        for thr in current_batch:
-            thr.join()
-        
-    error_count = 0
-    for thr in threads:
-        if thr.error:
-            error_count += 1
-            msg = "** Issue with %s:\n" % thr.worker.instanceid
-            msg += str(thr.error)
-            c.log.error("\n\n%s\n" % msg)
+    error_count = fetch_vms(c, m, fetches)
 
     # terminate even if there was an error log fetching
 
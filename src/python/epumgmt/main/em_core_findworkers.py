@@ -23,7 +23,7 @@ def find_once(p, c, m, run_name):
     for vm in launched_vms:
         m.persistence.new_vm(run_name, vm)
 
-    allsvcs = m.persistence.get_run_vms_or_none(run_name)
+    allsvcs = m.persistence.get_run_vms(run_name, with_events=False)
     vm_num = 0
     for svc in allsvcs:
         if not is_piggybacked(svc):
@@ -34,26 +34,26 @@ def find_once(p, c, m, run_name):
 def vms_launched(m, run_name, eventname):
     provisioner = _get_provisioner(m, run_name)
     vms = []
-    for event in provisioner.events:
-        if event.name == eventname:
-            vm = RunVM()
-            if eventname == "new_node":
-                vm.instanceid = event.extra['iaas_id']
-                vm.nodeid = event.extra['node_id']
-            elif eventname == "node_started":
-                vm.instanceid = event.extra['iaas_id']
-                vm.nodeid = event.extra['node_id']
-            else:
-                raise IncompatibleEnvironment("eventname is illegal")
-            vm.hostname = event.extra['public_ip']
-            # todo: 'unknown' is hardcoded in fetchkill, too
-            vm.service_type = "unknown" + vm.WORKER_SUFFIX
-            m.runlogs.new_vm(vm)
-            vms.append(vm)
+    events = m.persistence.get_events_by_name(run_name, eventname, vms=[provisioner])
+    for (instanceid, event) in events:
+        vm = RunVM()
+        if eventname == "new_node":
+            vm.instanceid = event.extra['iaas_id']
+            vm.nodeid = event.extra['node_id']
+        elif eventname == "node_started":
+            vm.instanceid = event.extra['iaas_id']
+            vm.nodeid = event.extra['node_id']
+        else:
+            raise IncompatibleEnvironment("eventname is illegal")
+        vm.hostname = event.extra['public_ip']
+        # todo: 'unknown' is hardcoded in fetchkill, too
+        vm.service_type = "unknown" + vm.WORKER_SUFFIX
+        m.runlogs.new_vm(vm)
+        vms.append(vm)
     return vms
 
 def _get_provisioner(m, run_name):
-    allvms = m.persistence.get_run_vms_or_none(run_name)
+    allvms = m.persistence.get_run_vms(run_name, with_events=False)
     provisioner = None
     for vm in allvms:
         if vm.service_type == PROVISIONER:
@@ -1,14 +1,54 @@
 from operator import itemgetter
-from pylab import *
 
-import matplotlib
-import json
+import datetime
+import multiprocessing
+import numpy
 import os
+import time
 
 from epumgmt.api.exceptions import *
 from epumgmt.defaults.log_events import AmqpEvents, TorqueEvents, NodeEvents, ControllerEvents
+from epumgmt.defaults.log_events import RunEventIndex
+from epumgmt.main.em_core_graphcache import GraphEventCache, CachedEvents
 
-props = matplotlib.font_manager.FontProperties(size=10)
+# matplotlib is only imported once a graph is drawn, see _load_matplotlib()
+Figure = None
+FigureCanvasAgg = None
+setp = None
+props = None
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+GRAPH_NAMES = ('stacked-vms', 'job-tts', 'job-rate', 'node-info', 'controller')
+
+def _load_matplotlib(c):
+    """Import the few matplotlib pieces the graphs use.
+
+    Figures are drawn straight onto the non-interactive Agg canvas (and
+    saved as EPS through it), pylab/pyplot and their GUI backends are never
+    imported, so this works without a display whatever the matplotlib
+    configuration says.
+    """
+    global Figure, FigureCanvasAgg, setp, props
+    if Figure:
+        return
+    started = time.time()
+    try:
+        from matplotlib.artist import setp
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+        from matplotlib.font_manager import FontProperties
+    except ImportError:
+        c.log.exception("")
+        raise IncompatibleEnvironment("Problem with graphing dependencies: do you have "
+        "matplotlib installed?")
+    props = FontProperties(size=10)
+    c.log.debug("Loaded matplotlib in %.3f seconds" % (time.time() - started))
+
+def _new_figure():
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    return fig
 
 def validate(p):
     """Validate input for our graph type
@@ -28,7 +68,74 @@ def validate(p):
     if not workloadtype:
         raise InvalidInput("You must specify a --workloadtype for the 'generate-graph' action")
 
+    _get_graphnames(graphname)
+    _get_graph_processes(p)
+    _get_graph_resolution(p)
+    _get_graph_window(p)
+
+def _get_graphnames(graphname):
+    """'all', one graph name or a comma separated list of them"""
+    if graphname.strip().lower() == 'all':
+        return list(GRAPH_NAMES)
+    graphnames = []
+    for name in graphname.split(','):
+        name = name.strip()
+        if name not in GRAPH_NAMES:
+            raise InvalidInput("Unrecognized graph name '%s', must be 'all' or " % name + \
+                               "one or more (comma separated) of: %s" % ', '.join(GRAPH_NAMES))
+        if name not in graphnames:
+            graphnames.append(name)
+    return graphnames
+
+def _get_graph_processes(p):
+    processes = p.get_arg_or_none('graph-processes')
+    if not processes:
+        return 1
+    try:
+        processes = int(processes)
+    except ValueError:
+        processes = 0
+    if processes < 1:
+        raise InvalidInput("--graph-processes must be a number, 1 or more")
+    return processes
+
+
+def _get_graph_resolution(p):
+    """Bucket size in seconds, or 'auto'"""
+    resolution = p.get_arg_or_none('graph-resolution')
+    if not resolution:
+        return 1
+    if resolution.strip().lower() == 'auto':
+        return 'auto'
+    seconds = _parse_duration(resolution)
+    if not seconds:
+        raise InvalidInput("--graph-resolution must be 'auto' or a number of seconds, " + \
+                           "optionally with an s, m, h or d suffix: '%s'" % resolution)
+    return seconds
 
+def _get_graph_window(p):
+    """(start, end) evaluation seconds to graph, end is None for 'until the end'"""
+    window = p.get_arg_or_none('graph-window')
+    if not window:
+        return (0, None)
+    error = "--graph-window must be start:end, both are evaluation seconds " + \
+            "(optionally with an s, m, h or d suffix) and either can be left out: '%s'" % window
+    if window.count(':') != 1:
+        raise InvalidInput(error)
+    start, end = window.split(':')
+    if start.strip():
+        start = _parse_duration(start)
+        if start is None:
+            raise InvalidInput(error)
+    else:
+        start = 0
+    if end.strip():
+        end = _parse_duration(end)
+        if end is None or end <= start:
+            raise InvalidInput(error)
+    else:
+        end = None
+    return (start, end)
 
 def _convert_datetime_to_seconds(dateTime):
     seconds = (dateTime.microseconds + \
@@ -61,10 +168,6 @@ def _get_last_datetime(datetimes):
             endtime = datetimes[key]
     return endtime
 
-def _get_eval_seconds_list(begin, end):
-    total_seconds = _get_datetime_diff_seconds(begin, end) + 60
-    return range(total_seconds)
-
 def _get_eval_begin_datetime(*args):
     if len(args) <= 0:
         return
@@ -119,194 +222,195 @@ def _get_unique_graph_filename(key, run_name, filetype):
                                 filetype)
     return filename
 
-def _get_killed_vms_list(log_events, seconds, begin, killed_datetimes):
-    killedvms = {}
-    for second in seconds:
-        killedvms[second] = 0
+# The time series below are built on arrays: every event becomes its
+# whole-second offset from the beginning of the evaluation and an
+# EvalTimeline turns those into counts per bucket (killed VMs, completed
+# jobs...) or into "from then on" levels (running VMs, running jobs...).
+# Only one value per bucket is ever allocated, so a long evaluation at a
+# coarse resolution costs no more than a short one.
+
+# Bucket sizes --graph-resolution auto picks from, the smallest one that
+# keeps a graph under AUTO_MAX_POINTS points per line
+AUTO_STEPS = (1, 2, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 7200, 21600, 86400)
+AUTO_MAX_POINTS = 1000
+
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+def _parse_duration(text):
+    """Seconds in '90', '90s', '10m', '2h' or '1d'"""
+    text = text.strip().lower()
+    multiplier = 1
+    if text and DURATION_UNITS.has_key(text[-1]):
+        multiplier = DURATION_UNITS[text[-1]]
+        text = text[:-1]
+    try:
+        seconds = int(text)
+    except ValueError:
+        return None
+    if seconds < 0:
+        return None
+    return seconds * multiplier
 
-    for key in killed_datetimes.keys():
-        diff = _get_datetime_diff_seconds(begin, killed_datetimes[key])
-        try:
-            killedvms[diff] += 1
-        except:
-            log_events.c.log.error('problem adding to killedvms: %s' % diff)
+class EvalTimeline:
+    """The seconds of the evaluation a graph shows, in buckets of step
+    seconds.
 
-    returnlist = []
-    keys = killedvms.keys()
-    keys.sort()
-    for key in keys:
-        returnlist.append(killedvms[key])
-    return returnlist
+    total is the length of the whole evaluation in seconds, the graph
+    covers [start, end) of it.  With the defaults (step 1, whole
+    evaluation) there is one bucket per evaluation second.
+    """
+
+    def __init__(self, total, step=1, start=0, end=None):
+        if end is None or end > total:
+            end = total
+        if start >= end:
+            raise InvalidInput("The graph window starts at second %d, " % start + \
+                               "after the end of the evaluation (%d seconds)" % total)
+        if step == 'auto':
+            step = _get_auto_step(end - start)
+        self.total = total
+        self.step = step
+        self.start = start
+        self.end = end
+        self.buckets = (end - start + step - 1) // step
+
+    def is_default(self):
+        """True if this is the timeline of a graph without --graph-resolution
+        or --graph-window: the whole evaluation, one bucket per second"""
+        return self.step == 1 and self.start == 0 and self.end == self.total
+
+    def get_seconds(self):
+        """The evaluation second each bucket starts at"""
+        return range(self.start, self.end, self.step)
+
+    def get_step_name(self):
+        for seconds, name in ((86400, 'day'), (3600, 'hour'), (60, 'minute'), (1, 'second')):
+            if self.step == seconds:
+                return name
+            if self.step % seconds == 0:
+                return '%d %ss' % (self.step / seconds, name)
+
+    def counts(self, diffs):
+        """How many of diffs fall in each bucket"""
+        diffs = diffs[(diffs >= self.start) & (diffs < self.end)]
+        counts = numpy.bincount((diffs - self.start) // self.step, minlength=self.buckets)
+        return counts[:self.buckets]
+
+    def levels(self, diffs):
+        """How many of diffs happened up to the end of each bucket, the
+        ones before the window all count from its first bucket on.
+        """
+        diffs = diffs[diffs < self.end]
+        diffs = numpy.maximum(diffs, self.start)
+        counts = numpy.bincount((diffs - self.start) // self.step, minlength=self.buckets)
+        return numpy.cumsum(counts[:self.buckets])
+
+def _get_auto_step(seconds):
+    for step in AUTO_STEPS:
+        if (seconds + step - 1) // step <= AUTO_MAX_POINTS:
+            return step
+    return (seconds + AUTO_MAX_POINTS - 1) // AUTO_MAX_POINTS
+
+# More x axis ticks than this are unreadable and slow to render
+MAX_XTICKS = 50
+
+def _get_xstep(timeline, xstep):
+    """Seconds between x axis ticks, xstep unless --graph-resolution or
+    --graph-window make that too many.  The default graphs keep theirs.
+    """
+    if timeline.is_default():
+        return xstep
+    while (timeline.end - timeline.start) / xstep > MAX_XTICKS:
+        xstep *= 10
+    return xstep
+
+def _get_eval_timeline(begin, end, resolution=1, window=(0, None)):
+    # the evaluation is taken to last a minute past its last event
+    total = _get_datetime_diff_seconds(begin, end) + 60
+    return EvalTimeline(total, resolution, window[0], window[1])
+
+def _datetimes_to_microseconds(datetimes):
+    us = numpy.empty(len(datetimes), dtype=numpy.int64)
+    for i, dt in enumerate(datetimes):
+        delta = dt - EPOCH
+        us[i] = (delta.days * 24 * 3600 + delta.seconds) * 10**6 + delta.microseconds
+    return us
+
+def _get_diff_seconds_array(begin, datetimes):
+    """_get_datetime_diff_seconds(begin, dt) for every datetime, as an array"""
+    diffs = _datetimes_to_microseconds(datetimes) - _datetimes_to_microseconds([begin])[0]
+    return diffs // 10**6
+
+def _valid_diffs(log_events, diffs, timeline, message):
+    """The diffs within the evaluation, message is logged for the others"""
+    valid = (diffs >= 0) & (diffs < timeline.total)
+    if not valid.all():
+        for diff in diffs[~valid]:
+            log_events.c.log.error(message % diff)
+    return diffs[valid]
+
+def _get_killed_vms_list(log_events, timeline, begin, killed_datetimes):
+    diffs = _get_diff_seconds_array(begin, killed_datetimes.values())
+    diffs = _valid_diffs(log_events, diffs, timeline,
+                         'problem adding to killedvms: %s')
+    return timeline.counts(diffs).tolist()
 
 def _get_running_vms_list(log_events, \
-                          seconds, \
+                          timeline, \
                           begin, \
                           start_datetimes, \
                           killed_datetimes):
-    runningvms = {}
-    for second in seconds:
-        runningvms[second] = 0
-
-    max_seconds = max(seconds)
-
-    for key in start_datetimes.keys():
-        diff = _get_datetime_diff_seconds(begin, start_datetimes[key])
-        if (diff >= 0) and (diff <= max_seconds):
-            second = diff
-            while second <= max_seconds:
-                runningvms[second] += 1
-                second += 1
-        else:
-            log_events.c.log.error('running vm time does not appear to be ' + \
-                                   'valid: %s' % diff)
-    for key in killed_datetimes.keys(): 
-        diff = _get_datetime_diff_seconds(begin, killed_datetimes[key])
-        if (diff >= 0) and (diff <= max_seconds):
-            second = diff
-            while second <= max_seconds:
-                runningvms[second] -= 1
-                second += 1
-        else:
-            log_events.c.log.error('killed vm time does not appear to be ' + \
-                                   'valid: %s' % diff)
-
-    returnlist = []
-    keys = runningvms.keys()
-    keys.sort()
-    for key in keys:
-        returnlist.append(runningvms[key])
-    return returnlist
+    started = _get_diff_seconds_array(begin, start_datetimes.values())
+    started = _valid_diffs(log_events, started, timeline,
+                           'running vm time does not appear to be valid: %s')
+    killed = _get_diff_seconds_array(begin, killed_datetimes.values())
+    killed = _valid_diffs(log_events, killed, timeline,
+                          'killed vm time does not appear to be valid: %s')
+    runningvms = timeline.levels(started) - timeline.levels(killed)
+    return runningvms.tolist()
 
 def _get_jobs_running_list(log_events,
-                           seconds,
+                           timeline,
                            begin,
                            job_begin_datetimes,
                            job_end_datetimes):
-    jobs = {}
-    for second in seconds:
-        jobs[second] = 0
-
-    max_seconds = max(seconds)
-
-    for key in job_begin_datetimes.keys():
-        diff = _get_datetime_diff_seconds(begin, job_begin_datetimes[key])
-        if (diff >= 0) and (diff <= max_seconds):
-            second = diff
-            while second <= max_seconds:
-                jobs[second] += 1
-                second += 1
-        else:
-            log_events.c.log.error('job time does not appear to be ' + \
-                                   'valid: %s' % diff)
-
-    for key in job_end_datetimes.keys():
-        diff = _get_datetime_diff_seconds(begin, job_end_datetimes[key])
-        if (diff >= 0) and (diff <= max_seconds):
-            second = diff
-            while second <= max_seconds:
-                jobs[second] -= 1
-                second += 1
-        else:
-            log_events.c.log.error('job time does not appear to be ' + \
-                                   'valid: %s' % diff)
-
-    returnlist = []
-    keys = jobs.keys()
-    keys.sort()
-    for key in keys:
-        returnlist.append(jobs[key])
-    return returnlist
+    begun = _get_diff_seconds_array(begin, job_begin_datetimes.values())
+    begun = _valid_diffs(log_events, begun, timeline,
+                         'job time does not appear to be valid: %s')
+    ended = _get_diff_seconds_array(begin, job_end_datetimes.values())
+    ended = _valid_diffs(log_events, ended, timeline,
+                         'job time does not appear to be valid: %s')
+    jobs = timeline.levels(begun) - timeline.levels(ended)
+    return jobs.tolist()
 
 def _get_jobs_completed_rate_list(log_events,
-                                  seconds,
+                                  timeline,
                                   begin,
                                   job_end_datetimes):
-    jobs = {}
-    for second in seconds:
-        jobs[second] = 0
-
-    max_seconds = max(seconds)
-
-    for key in job_end_datetimes.keys():
-        diff = _get_datetime_diff_seconds(begin, job_end_datetimes[key])
-        if (diff >= 0) and (diff <= max_seconds):
-            second = diff
-            jobs[second] += 1
-        else:
-            log_events.c.log.error('job time does not appear to be ' + \
-                                   'valid: %s' % diff)
-
-    returnlist = []
-    keys = jobs.keys()
-    keys.sort()
-    for key in keys:
-        returnlist.append(jobs[key])
-    return returnlist
+    ended = _get_diff_seconds_array(begin, job_end_datetimes.values())
+    ended = _valid_diffs(log_events, ended, timeline,
+                         'job time does not appear to be valid: %s')
+    return timeline.counts(ended).tolist()
 
 def _get_jobs_queued_list(log_events,
-                          seconds,
+                          timeline,
                           begin,
                           job_sent_datetimes,
                           job_begin_datetimes):
-    jobs = {}
-    for second in seconds:
-        jobs[second] = 0
-
-    max_seconds = max(seconds)
-
-    for key in job_sent_datetimes.keys():
-        diff = _get_datetime_diff_seconds(begin, job_sent_datetimes[key])
-        if (diff >= 0) and (diff <= max_seconds):
-            second = diff
-            while second <= max_seconds:
-                jobs[second] += 1
-                second += 1
-        else:
-            log_events.c.log.error('job time does not appear to be ' + \
-                                   'valid: %s' % diff)
-
-    for key in job_begin_datetimes.keys():
-        diff = _get_datetime_diff_seconds(begin, job_begin_datetimes[key])
-        if (diff >= 0) and (diff <= max_seconds):
-            second = diff
-            while second <= max_seconds:
-                jobs[second] -= 1
-                second += 1
-        else:
-            log_events.c.log.error('job time does not appear to be ' + \
-                                   'valid: %s' % diff)
-
-    returnlist = []
-    keys = jobs.keys()
-    keys.sort()
-    for key in keys:
-        returnlist.append(jobs[key])
-    return returnlist
-
-def _get_jobs_list(log_events, seconds, begin, job_datetimes):
-    jobs = {}
-    for second in seconds:
-        jobs[second] = 0
-
-    max_seconds = max(seconds)
-
-    for key in job_datetimes.keys():
-        diff = _get_datetime_diff_seconds(begin, job_datetimes[key])
-        if (diff >= 0) and (diff <= max_seconds):
-            second = diff
-            while second <= max_seconds:
-                jobs[second] += 1
-                second += 1
-        else:
-            log_events.c.log.error('job time does not appear to be ' + \
-                                   'valid: %s' % diff)
-
-    returnlist = []
-    keys = jobs.keys()
-    keys.sort()
-    for key in keys:
-        returnlist.append(jobs[key])
-    return returnlist
+    sent = _get_diff_seconds_array(begin, job_sent_datetimes.values())
+    sent = _valid_diffs(log_events, sent, timeline,
+                        'job time does not appear to be valid: %s')
+    begun = _get_diff_seconds_array(begin, job_begin_datetimes.values())
+    begun = _valid_diffs(log_events, begun, timeline,
+                         'job time does not appear to be valid: %s')
+    jobs = timeline.levels(sent) - timeline.levels(begun)
+    return jobs.tolist()
+
+def _get_jobs_list(log_events, timeline, begin, job_datetimes):
+    diffs = _get_diff_seconds_array(begin, job_datetimes.values())
+    diffs = _valid_diffs(log_events, diffs, timeline,
+                         'job time does not appear to be valid: %s')
+    return timeline.levels(diffs).tolist()
 
 def _get_jobtts_list(log_events, job_begin_datetimes, job_sent_datetimes):
     jobtts = {}
@@ -328,25 +432,10 @@ def _get_jobtts_list(log_events, job_begin_datetimes, job_sent_datetimes):
         returnlist.append(jobtts[key])
     return returnlist
 
-def _get_killed_controller_list(seconds, begin, killed_datetimes):
-    vms = {}
-    for second in seconds:
-        vms[second] = 0
-
-    max_seconds = max(seconds)
-
-    for event_time in killed_datetimes: 
-        diff = _get_datetime_diff_seconds(begin, event_time)
-        if (diff >= 0) and (diff <= max_seconds):
-            second = diff
-            vms[second] += 1
-
-    returnlist = []
-    keys = vms.keys()
-    keys.sort()
-    for key in keys:
-        returnlist.append(vms[key])
-    return returnlist
+def _get_killed_controller_list(timeline, begin, killed_datetimes):
+    diffs = _get_diff_seconds_array(begin, killed_datetimes)
+    diffs = diffs[(diffs >= 0) & (diffs < timeline.total)]
+    return timeline.counts(diffs).tolist()
 
 def _get_nodeinfo_list(events, ids, ctxdone_datetimes, nodestarted_datetimes, first):
     ctxdone = []
@@ -363,81 +452,23 @@ def _get_nodeinfo_list(events, ids, ctxdone_datetimes, nodestarted_datetimes, fi
             events.c.log.warn("skipping node: %s" % anid)
     return new_ids, ctxdone, nodestarted
 
-def _get_running_controller_list(seconds, begin, running_datetimes, killed_datetimes):
-    vms = {}
-    for second in seconds:
-        vms[second] = 0
-
-    max_seconds = max(seconds)
-
-    for event_time in running_datetimes:
-        diff = _get_datetime_diff_seconds(begin, event_time)
-        if diff < 0:
-            diff = 0
-        if (diff >= 0) and (diff <= max_seconds):
-            second = diff
-            while second <= max_seconds:
-                vms[second] += 1
-                second += 1
-
-    for event_time in killed_datetimes: 
-        diff = _get_datetime_diff_seconds(begin, event_time)
-        if (diff >= 0) and (diff <= max_seconds):
-            second = diff
-            while second <= max_seconds:
-                vms[second] -= 1
-                second += 1
-
-    returnlist = []
-    keys = vms.keys()
-    keys.sort()
-    for key in keys:
-        returnlist.append(vms[key])
-    return returnlist
-
-# added for very large job_end workloads...
-def _get_job_rate_from_file(log_events, node_events, begin, seconds):
-    log_events._set_workproducerlog_filenames()
-    filenames = log_events.workconsumerlog_filenames
-    jobs = {}
-    for second in seconds:
-        jobs[second] = 0
-
-    max_seconds = max(seconds)
-
-    event = 'job_end'
-    if filenames:
-        for filename in filenames:
-            try:
-                eventFile = open(filename, 'r')
-                try:
-                    for line in eventFile:
-                        if event in line:
-                            splitline = line.rpartition('JSON:')[2]
-                            splitline.strip()
-                            jsonEvent = json.loads(splitline)
-                            timestamp = jsonEvent['timestamp']
-                            eventTime = log_events._create_datetime(timestamp)
-                            diff = _get_datetime_diff_seconds(begin, eventTime)
-                            if (diff >= 0) and (diff <= max_seconds):
-                                second = diff
-                                jobs[second] += 1
-                            else:
-                                log_events.c.log.error('job time does not appear to be ' + \
-                                                       'valid: %s' % diff)
-
-                finally:
-                    eventFile.close()
-            except IOError:
-                self.c.log.error('Failed to open and read from file: ' + \
-                                 '%s' % filename)
-
-    returnlist = []
-    keys = jobs.keys()
-    keys.sort()
-    for key in keys:
-        returnlist.append(jobs[key])
-    return returnlist
+def _get_running_controller_list(timeline, begin, running_datetimes, killed_datetimes):
+    running = _get_diff_seconds_array(begin, running_datetimes)
+    # controllers started before the evaluation count from its beginning
+    running[running < 0] = 0
+    running = running[running < timeline.total]
+    killed = _get_diff_seconds_array(begin, killed_datetimes)
+    killed = killed[(killed >= 0) & (killed < timeline.total)]
+    vms = timeline.levels(running) - timeline.levels(killed)
+    return vms.tolist()
+
+# added for very large job_end workloads, every job_end occurrence counts
+# (not only the last one per job id) and comes straight from the event index
+def _get_job_rate_list(log_events, node_events, begin, timeline):
+    ended = _get_diff_seconds_array(begin, log_events.get_event_datetimes_list('job_end'))
+    ended = _valid_diffs(log_events, ended, timeline,
+                         'job time does not appear to be valid: %s')
+    return timeline.counts(ended).tolist()
 
 def _generate_job_tts(log_events, node_events, run_name, graphtype='eps'):
     filename = _get_unique_graph_filename('job-tts', run_name, graphtype)
@@ -458,9 +489,7 @@ def _generate_job_tts(log_events, node_events, run_name, graphtype='eps'):
     ymin = min(jobtts_list)
     ymax = max(jobtts_list)
 
-    fig = figure()
-
-    clf()
+    fig = _new_figure()
 
     fig.suptitle('Job Time to Start', \
                  verticalalignment='top', \
@@ -472,8 +501,8 @@ def _generate_job_tts(log_events, node_events, run_name, graphtype='eps'):
     ax.set_xlabel('Job ID')
     ax.axis([xmin, xmax, ymin, ymax])
     if len(jobids) <= 20:
-        xticks(jobids)
-    ylim(0, ymax)
+        ax.set_xticks(jobids)
+    ax.set_ylim(0, ymax)
     if len(jobids) < 100:
         h1 = ax.stem(jobids, jobtts_list, '-')
         setp(h1[0], 'markerfacecolor', 'b')
@@ -496,7 +525,8 @@ def _generate_job_tts(log_events, node_events, run_name, graphtype='eps'):
 
     fig.savefig(filename)
 
-def _generate_stacked_vms(workloadtype, log_events, node_events, run_name, graphtype='eps'):
+def _generate_stacked_vms(workloadtype, log_events, node_events, run_name, graphtype='eps', \
+                          resolution=1, window=(0, None)):
     filename = _get_unique_graph_filename('stacked-vms', run_name, graphtype)
 
     node_started_datetimes = node_events.get_event_datetimes_dict('node_started') 
@@ -520,33 +550,34 @@ def _generate_stacked_vms(workloadtype, log_events, node_events, run_name, graph
                                  jobs_completed_datetimes, \
                                  jobs_sent_datetimes)
 
-    seconds = _get_eval_seconds_list(begin, end)
+    timeline = _get_eval_timeline(begin, end, resolution, window)
+    seconds = timeline.get_seconds()
 
     killed_vms_list = _get_killed_vms_list(node_events, \
-                                           seconds, \
+                                           timeline, \
                                            begin, \
                                            node_killed_datetimes)
     running_vms_list = _get_running_vms_list(node_events, \
-                                             seconds, \
+                                             timeline, \
                                              begin, \
                                              node_started_datetimes, \
                                              node_killed_datetimes)
 
     jobs_completed_list = _get_jobs_list(log_events, \
-                                         seconds, \
+                                         timeline, \
                                          begin, \
                                          jobs_completed_datetimes)
     jobs_sent_list = _get_jobs_list(log_events, \
-                                    seconds, \
+                                    timeline, \
                                     begin, \
                                     jobs_sent_datetimes)
     jobs_running_list = _get_jobs_running_list(log_events,
-                                               seconds,
+                                               timeline,
                                                begin,
                                                jobs_begin_datetimes,
                                                jobs_completed_datetimes)
     jobs_queued_list = _get_jobs_queued_list(log_events,
-                                             seconds,
+                                             timeline,
                                              begin,
                                              jobs_sent_datetimes,
                                              jobs_begin_datetimes)
@@ -570,12 +601,10 @@ def _generate_stacked_vms(workloadtype, log_events, node_events, run_name, graph
     if ymaxt_1 >= (ymaxt - 10):
         ymaxt_1 = ymaxt
 
-    xstep = 100
-    xvals = arange(xmin, xmax, xstep)
-
-    fig = figure()
+    xstep = _get_xstep(timeline, 100)
+    xvals = numpy.arange(xmin, xmax, xstep)
 
-    clf()
+    fig = _new_figure()
 
     fig.suptitle('Jobs and Instances', \
                  verticalalignment='top', \
@@ -595,15 +624,15 @@ def _generate_stacked_vms(workloadtype, log_events, node_events, run_name, graph
                    label='Killed VMs', \
                    color='r')
     axb.legend((pb1, pb2), ('Running VMs', 'Killed VMs'), 'upper left', prop=props)
-    axb.locator_params(axis='x', tight=True, nbins=xmax/xstep)
-    xticks(xvals)
+    axb.locator_params(axis='x', tight=True, nbins=(xmax - xmin)/xstep)
+    axb.set_xticks(xvals)
 
     # top graph
     axt = fig.add_subplot(2,1,1)
     axt.set_ylabel('Submitted / Queued / Completed')
     axt.set_xlabel('Evaluation Second')
     axt.axis([xmin, xmax, ymint, ymaxt])
-    ylim(ymax=ymaxt)
+    axt.set_ylim(ymax=ymaxt)
     pt1 = axt.plot(seconds, \
                    jobs_completed_list, \
                    label='Jobs Completed', \
@@ -632,12 +661,13 @@ def _generate_stacked_vms(workloadtype, log_events, node_events, run_name, graph
                                  'Jobs Submitted',
                                  'Jobs Queued',
                                  'Jobs Running'), 'center left', prop=props)
-    axt.locator_params(axis='x', tight=True, nbins=xmax/xstep)
-    xticks(xvals)
+    axt.locator_params(axis='x', tight=True, nbins=(xmax - xmin)/xstep)
+    axt_1.set_xticks(xvals)
 
     fig.savefig(filename)
 
-def _generate_job_rate(workloadtype, log_events, node_events, run_name, graphtype='eps'):
+def _generate_job_rate(workloadtype, log_events, node_events, run_name, graphtype='eps', \
+                       resolution=1, window=(0, None)):
     filename = _get_unique_graph_filename('job-rate', run_name, graphtype)
 
     node_started_datetimes = node_events.get_event_datetimes_dict('node_started') 
@@ -657,25 +687,26 @@ def _generate_job_rate(workloadtype, log_events, node_events, run_name, graphtyp
                                  new_node_datetimes, \
                                  jobs_completed_datetimes)
 
-    seconds = _get_eval_seconds_list(begin, end)
+    timeline = _get_eval_timeline(begin, end, resolution, window)
+    seconds = timeline.get_seconds()
 
     killed_vms_list = _get_killed_vms_list(node_events, \
-                                           seconds, \
+                                           timeline, \
                                            begin, \
                                            node_killed_datetimes)
     running_vms_list = _get_running_vms_list(node_events, \
-                                             seconds, \
+                                             timeline, \
                                              begin, \
                                              node_started_datetimes, \
                                              node_killed_datetimes)
 
     # get number of jobs completed each second
-    jobs_completed_rate_list = _get_job_rate_from_file(log_events, \
-                                                       node_events, \
-                                                       begin, \
-                                                       seconds)
+    jobs_completed_rate_list = _get_job_rate_list(log_events, \
+                                                  node_events, \
+                                                  begin, \
+                                                  timeline)
 
-    log_events.c.log.info("Total jobs completed: %s" % sum(jobs_completed_rate_list))
+    log_events.c.log.info("Total jobs completed: %s" % numpy.sum(jobs_completed_rate_list))
 
     # graph
     xmin = min(seconds)
@@ -686,12 +717,10 @@ def _generate_job_rate(workloadtype, log_events, node_events, run_name, graphtyp
     ymint = min(jobs_completed_rate_list)
     ymaxt = max(jobs_completed_rate_list) + 2
 
-    xstep = 500
-    xvals = arange(xmin, xmax, xstep)
+    xstep = _get_xstep(timeline, 500)
+    xvals = numpy.arange(xmin, xmax, xstep)
 
-    fig = figure()
-
-    clf()
+    fig = _new_figure()
 
     fig.suptitle('Job Rate and Instances', \
                  verticalalignment='top', \
@@ -711,8 +740,8 @@ def _generate_job_rate(workloadtype, log_events, node_events, run_name, graphtyp
                    label='Killed VMs', \
                    color='r')
     axb.legend((pb1, pb2), ('Running VMs', 'Killed VMs'), 'lower center', prop=props)
-    axb.locator_params(axis='x', tight=True, nbins=xmax/xstep)
-    xticks(xvals)
+    axb.locator_params(axis='x', tight=True, nbins=(xmax - xmin)/xstep)
+    axb.set_xticks(xvals)
 
     # top graph
     axt = fig.add_subplot(2,1,1)
@@ -725,9 +754,9 @@ def _generate_job_rate(workloadtype, log_events, node_events, run_name, graphtyp
                    color='b',
                    linestyle=':')
 
-    axt.legend((pt1,), ('Jobs Completed (per second)',), 'best', prop=props)
-    axt.locator_params(axis='x', tight=True, nbins=xmax/xstep)
-    xticks(xvals)
+    axt.legend((pt1,), ('Jobs Completed (per %s)' % timeline.get_step_name(),), 'best', prop=props)
+    axt.locator_params(axis='x', tight=True, nbins=(xmax - xmin)/xstep)
+    axt.set_xticks(xvals)
 
     fig.savefig(filename)
 
@@ -757,9 +786,7 @@ def _generate_node_info(workloadtype, log_events, node_events, run_name, graphty
     ymin = min(ctxdone_list)
     ymax = max(ctxdone_list)
 
-    fig = figure()
-
-    clf()
+    fig = _new_figure()
 
     fig.suptitle('Node Information (relative to new_node event)', \
                  verticalalignment='top', \
@@ -771,8 +798,8 @@ def _generate_node_info(workloadtype, log_events, node_events, run_name, graphty
     ax.set_xlabel('Node ID')
     ax.axis([xmin, xmax, ymin, ymax])
     if len(nice_nodeids) <= 20:
-        xticks(nice_nodeids)
-    ylim(0, ymax)
+        ax.set_xticks(nice_nodeids)
+    ax.set_ylim(0, ymax)
     h1 = ax.plot(nice_nodeids, ctxdone_list, 's', color='r')
     h2 = ax.plot(nice_nodeids, nodestarted_list, 'o', color='b')
     ax.legend([h1[0], h2[0]],
@@ -789,7 +816,9 @@ def _generate_controller(workloadtype, \
                          node_events,
                          controller_events, \
                          run_name, \
-                         graphtype='eps'):
+                         graphtype='eps', \
+                         resolution=1, \
+                         window=(0, None)):
     filename = _get_unique_graph_filename('controller', run_name, graphtype)
 
     node_started_datetimes = node_events.get_event_datetimes_dict('node_started') 
@@ -812,27 +841,28 @@ def _generate_controller(workloadtype, \
                                  job_sent_datetimes, \
                                  job_begin_datetimes)
 
-    seconds = _get_eval_seconds_list(begin, end)
+    timeline = _get_eval_timeline(begin, end, resolution, window)
+    seconds = timeline.get_seconds()
 
     killed_vms_list = _get_killed_vms_list(node_events, \
-                                           seconds, \
+                                           timeline, \
                                            begin, \
                                            node_killed_datetimes)
     running_vms_list = _get_running_vms_list(node_events, \
-                                             seconds, \
+                                             timeline, \
                                              begin, \
                                              node_started_datetimes, \
                                              node_killed_datetimes)
 
     job_sent_list = _get_jobs_list(log_events, \
-                                    seconds, \
+                                    timeline, \
                                     begin, \
                                     job_sent_datetimes)
 
-    killed_controller_list = _get_killed_controller_list(seconds, \
+    killed_controller_list = _get_killed_controller_list(timeline, \
                                                          begin, \
                                                          ec_end_datetimes)
-    running_controller_list = _get_running_controller_list(seconds, \
+    running_controller_list = _get_running_controller_list(timeline, \
                                                            begin, \
                                                            ec_start_datetimes, \
                                                            ec_end_datetimes)
@@ -847,12 +877,10 @@ def _generate_controller(workloadtype, \
     ymaxt = max(max(killed_vms_list), max(running_vms_list), max(job_sent_list)) + 1
 
 
-    xstep = 250
-    xvals = arange(xmin, xmax, xstep)
-
-    fig = figure()
+    xstep = _get_xstep(timeline, 250)
+    xvals = numpy.arange(xmin, xmax, xstep)
 
-    clf()
+    fig = _new_figure()
 
     fig.suptitle('EPU Controller Recovery', \
                  verticalalignment='top', \
@@ -873,16 +901,16 @@ def _generate_controller(workloadtype, \
                    color='r')
     axb.legend((pb1, pb2), ('Running Controllers', 'Killed Controllers'), \
                'upper left', prop=props)
-    axb.locator_params(axis='x', tight=True, nbins=xmax/xstep)
-    yticks([0,1,2])
-    xticks(xvals)
+    axb.locator_params(axis='x', tight=True, nbins=(xmax - xmin)/xstep)
+    axb.set_yticks([0,1,2])
+    axb.set_xticks(xvals)
 
     # top graph
     axt = fig.add_subplot(2,1,1)
     axt.set_ylabel('Submitted Jobs / Running VMs')
     axt.set_xlabel('Evaluation Second')
     axt.axis([xmin, xmax, ymint, ymaxt])
-    ylim(ymax=ymaxt)
+    axt.set_ylim(ymax=ymaxt)
     pt1 = axt.plot(seconds, \
                    job_sent_list, \
                    label='Jobs Submitted', \
@@ -895,33 +923,38 @@ def _generate_controller(workloadtype, \
 
     axt.legend((pt1, pt2), ('Jobs Submitted',
                             'Running VMs'), 'upper left', prop=props)
-    axt.locator_params(axis='x', tight=True, nbins=xmax/xstep)
-    xticks(xvals)
+    axt.locator_params(axis='x', tight=True, nbins=(xmax - xmin)/xstep)
+    axt.set_xticks(xvals)
 
     fig.savefig(filename)
 
-def generate_graph(p, c, m, run_name):
-
-    validate(p)
-
-    graphname = p.get_arg_or_none('graphname')
-    graphtype = p.get_arg_or_none('graphtype')
-    workloadtype = p.get_arg_or_none('workloadtype')
-    workloadtype = workloadtype.lower()
-
-    node_events = NodeEvents(p, c, m, run_name)
-    controller_events = ControllerEvents(p, c, m, run_name)
+def _preload_events(graphnames, workloadtype, log_events, node_events, controller_events):
+    """Parse every event the graphs need, before rendering processes fork"""
+    for event in ('node_started', 'new_node', 'launch_ctx_done'):
+        node_events.get_event_datetimes_dict(event)
     if workloadtype == 'torque':
-        log_events = TorqueEvents(p, c, m, run_name)
+        node_events.get_event_datetimes_dict('terminated_node')
     else:
-        log_events = AmqpEvents(p, c, m, run_name)
-
+        node_events.get_event_datetimes_dict('fetch_killed')
+    for event in ('job_sent', 'job_begin', 'job_end'):
+        log_events.get_event_datetimes_dict(event)
+    if 'job-rate' in graphnames:
+        log_events.get_event_datetimes_list('job_end')
+    if 'controller' in graphnames:
+        controller_events.get_event_datetimes_list('EPU_CONTROLLER_START')
+        controller_events.get_event_datetimes_list('EPU_CONTROLLER_TERMINATE')
+
+def _generate_one(graphname, workloadtype, log_events, node_events, controller_events, run_name, graphtype,
+                  resolution=1, window=(0, None)):
+    # resolution and window only apply to the graphs over evaluation time
     if 'stacked-vms' == graphname:
-        _generate_stacked_vms(workloadtype, log_events, node_events, run_name, graphtype)
+        _generate_stacked_vms(workloadtype, log_events, node_events, run_name, graphtype,
+                              resolution, window)
     elif 'job-tts' == graphname:
         _generate_job_tts(log_events, node_events, run_name, graphtype)
     elif 'job-rate' == graphname:
-        _generate_job_rate(workloadtype, log_events, node_events, run_name, graphtype)
+        _generate_job_rate(workloadtype, log_events, node_events, run_name, graphtype,
+                           resolution, window)
     elif 'node-info' == graphname:
         _generate_node_info(workloadtype, log_events, node_events, run_name, graphtype)
     elif 'controller' == graphname:
@@ -930,7 +963,83 @@ def generate_graph(p, c, m, run_name):
                              node_events,
                              controller_events, \
                              run_name, \
-                             graphtype)
+                             graphtype, \
+                             resolution, \
+                             window)
     else:
         raise InvalidInput('Unrecognized graph name, must be stacked-vms, ' + \
                            'job-tts, job-rate, node-info, or controller.')
+
+def _generate_one_in_child(c, graphname, *args):
+    """Process target: a failure only shows in the exit code"""
+    try:
+        _generate_one(graphname, *args)
+    except:
+        c.log.exception("Problem generating graph '%s'" % graphname)
+        os._exit(1)
+    os._exit(0)
+
+def _generate_parallel(c, processes, graphnames, *args):
+    """Render the graphs in up to 'processes' forked children at a time,
+    they inherit the already parsed events.
+    """
+    failed = []
+    pending = list(graphnames)
+    while pending:
+        batch = pending[:processes]
+        pending = pending[processes:]
+        children = []
+        for graphname in batch:
+            child = multiprocessing.Process(target=_generate_one_in_child,
+                                            args=(c, graphname) + args)
+            child.start()
+            children.append((graphname, child))
+        for graphname, child in children:
+            child.join()
+            if child.exitcode != 0:
+                failed.append(graphname)
+    if failed:
+        raise UnexpectedError("Could not generate graph(s): %s" % ', '.join(failed))
+
+def generate_graph(p, c, m, run_name):
+
+    validate(p)
+
+    graphnames = _get_graphnames(p.get_arg_or_none('graphname'))
+    processes = _get_graph_processes(p)
+    resolution = _get_graph_resolution(p)
+    window = _get_graph_window(p)
+    graphtype = p.get_arg_or_none('graphtype')
+    workloadtype = p.get_arg_or_none('workloadtype')
+    workloadtype = workloadtype.lower()
+
+    # node and amqp events come from the same log files, share one index
+    # so that each file is only read once
+    index = RunEventIndex(p, c, run_name)
+    node_events = NodeEvents(p, c, m, run_name, index=index)
+    controller_events = ControllerEvents(p, c, m, run_name)
+    if workloadtype == 'torque':
+        log_events = TorqueEvents(p, c, m, run_name)
+    else:
+        log_events = AmqpEvents(p, c, m, run_name, index=index)
+
+    # and only parse them at all if they changed since the last graph
+    cache = GraphEventCache(p, c, run_name)
+    node_events = CachedEvents(node_events, cache, 'node')
+    controller_events = CachedEvents(controller_events, cache, 'controller')
+    log_events = CachedEvents(log_events, cache, workloadtype)
+
+    _load_matplotlib(c)
+
+    args = (workloadtype, log_events, node_events, controller_events, run_name, graphtype,
+            resolution, window)
+    try:
+        if processes > 1 and len(graphnames) > 1:
+            _preload_events(graphnames, *args[:4])
+            cache.save()
+            _generate_parallel(c, processes, graphnames, *args)
+        else:
+            for graphname in graphnames:
+                _generate_one(graphname, *args)
+    finally:
+        cache.save()
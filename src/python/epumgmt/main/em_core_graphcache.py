@@ -0,0 +1,175 @@
+import datetime
+import os
+
+import numpy
+
+from epumgmt.defaults.log_events import get_run_basedir, find_vmkill_logs
+
+# Lives in the run's runlog directory, with the other files derived
+# from the logs there
+GRAPH_CACHE_FILENAME = '.graph-events.npz'
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+def datetimes_to_epoch(datetimes):
+    """Seconds since the epoch, as a float array.  Microseconds survive the
+    round trip: a float64 holds them exactly for any date near now.
+    """
+    return numpy.array([_datetime_to_epoch(dt) for dt in datetimes], dtype=numpy.float64)
+
+def _datetime_to_epoch(dt):
+    delta = dt - EPOCH
+    return (delta.days * 86400 + delta.seconds) + delta.microseconds / 1e6
+
+def epoch_to_datetimes(epochs):
+    return [EPOCH + datetime.timedelta(microseconds=int(round(x * 1e6))) for x in epochs]
+
+def _keys_to_array(keys):
+    if keys and all(isinstance(k, (int, long)) and not isinstance(k, bool) for k in keys):
+        return numpy.array(keys, dtype=numpy.int64)
+    return numpy.array([unicode(k) for k in keys], dtype=numpy.unicode_)
+
+def _array_to_keys(array):
+    if array.dtype.kind == 'i':
+        return [int(k) for k in array]
+    return [unicode(k) for k in array]
+
+def source_signature(p, c, run_name):
+    """(path, size, mtime) of every file the graph events come from: all of
+    the run's fetched logs and its fetchkill logs.
+    """
+    files = []
+    basedir = get_run_basedir(p, c, run_name)
+    for root, dirs, names in os.walk(basedir):
+        for name in names:
+            if name.startswith('.'):
+                # our own caches, checkpoints and manifests
+                continue
+            files.append(os.path.join(root, name))
+    if p.get_conf_or_none("logging", "logfiledir"):
+        files.extend(find_vmkill_logs(p, c, run_name))
+    files.sort()
+    signature = []
+    for path in files:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        signature.append(u"%s %d %r" % (path, st.st_size, st.st_mtime))
+    return signature
+
+class GraphEventCache:
+    """The event times of one run, in a compact columnar file.
+
+    Every event that generate-graph asks for is stored as an array of keys
+    and an array of epoch seconds (and for occurrence lists just the
+    latter) in a .npz file under the run's runlog directory.  The file is
+    only used while the logs it was derived from are unchanged, otherwise
+    events are parsed again and the file is rewritten.
+    """
+
+    def __init__(self, p, c, run_name):
+        self.p = p
+        self.c = c
+        self.run_name = run_name
+        self.path = os.path.join(get_run_basedir(p, c, run_name), GRAPH_CACHE_FILENAME)
+        self.signature = source_signature(p, c, run_name)
+        self.arrays = {}
+        # what was already handed out, the graphs of one invocation share it
+        self.converted = {}
+        self.dirty = False
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            npz = numpy.load(self.path)
+            try:
+                arrays = dict([(name, npz[name]) for name in npz.files])
+            finally:
+                npz.close()
+        except Exception, e:
+            self.c.log.warn("Ignoring unreadable graph event cache '%s': %s" % (self.path, e))
+            return
+        if list(arrays.get('signature', [])) != self.signature:
+            self.c.log.debug("Graph event cache '%s' is stale" % self.path)
+            return
+        self.c.log.debug("Using graph event cache '%s'" % self.path)
+        self.arrays = arrays
+
+    def save(self):
+        if not self.dirty or not os.path.isdir(os.path.dirname(self.path)):
+            return
+        arrays = dict(self.arrays)
+        arrays['signature'] = numpy.array(self.signature, dtype=numpy.unicode_)
+        tmppath = "%s.%d" % (self.path, os.getpid())
+        try:
+            f = open(tmppath, 'wb')
+            try:
+                numpy.savez(f, **arrays)
+            finally:
+                f.close()
+            os.rename(tmppath, self.path)
+        except (IOError, OSError), e:
+            self.c.log.warn("Could not save graph event cache '%s': %s" % (self.path, e))
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+            return
+        self.dirty = False
+
+    def get_dict(self, source, event, events):
+        """{key: datetime} for event, from the cache or events"""
+        name = "%s:%s" % (source, event)
+        if self.converted.has_key(name):
+            return self.converted[name]
+        self.converted[name] = self._get_dict(name, event, events)
+        return self.converted[name]
+
+    def _get_dict(self, name, event, events):
+        if not self.arrays.has_key(name + ':keys'):
+            event_times = events.get_event_datetimes_dict(event)
+            keys = event_times.keys()
+            self.arrays[name + ':keys'] = _keys_to_array(keys)
+            self.arrays[name + ':times'] = datetimes_to_epoch([event_times[k] for k in keys])
+            self.dirty = True
+            return event_times
+        keys = _array_to_keys(self.arrays[name + ':keys'])
+        return dict(zip(keys, epoch_to_datetimes(self.arrays[name + ':times'])))
+
+    def get_list(self, source, event, events):
+        """[datetime] of every occurrence of event, from the cache or events"""
+        name = "%s:%s:list" % (source, event)
+        if self.converted.has_key(name):
+            return self.converted[name]
+        self.converted[name] = self._get_list(name, event, events)
+        return self.converted[name]
+
+    def _get_list(self, name, event, events):
+        if not self.arrays.has_key(name):
+            event_list = events.get_event_datetimes_list(event)
+            self.arrays[name] = datetimes_to_epoch(event_list)
+            self.dirty = True
+            return event_list
+        return epoch_to_datetimes(self.arrays[name])
+
+class CachedEvents:
+    """Stands in for an AmqpEvents, NodeEvents, TorqueEvents or
+    ControllerEvents object, answering from a GraphEventCache.
+    """
+
+    def __init__(self, events, cache, source):
+        self.events = events
+        self.cache = cache
+        self.source = source
+        self.p = events.p
+        self.c = events.c
+
+    def get_event_datetimes_dict(self, event):
+        return self.cache.get_dict(self.source, event, self.events)
+
+    def get_event_datetimes_list(self, event):
+        return self.cache.get_list(self.source, event, self.events)
+
+    def get_event_count(self, event):
+        return len(self.get_event_datetimes_dict(event))
@@ -2,30 +2,37 @@ from epumgmt.api.exceptions import *
 from epumgmt.main import em_core_status
 from epumgmt.main.em_core_load import get_cloudinit
 import epumgmt.defaults.epustates as epustates
-from em_core_status import _find_state_from_events as find_state_from_events
+from em_core_status import _find_states as find_states
 
-from threading import Thread
+def fetch_vms(c, m, fetches):
+    """Run the scp commands, all at the same time (up to [ssh] max_running)
+    and log the problems.
 
-THREADS_PER_BATCH = 20
+    fetches -- list of (RunVM, scpcmd)
 
-class FetchThread(Thread):
-    
-    def __init__ (self, worker, c, m, scpcmd):
-        Thread.__init__(self)
-        self.worker = worker
-        self.iid = worker.instanceid # convenience
-        self.scpcmd = scpcmd
-        self.c = c
-        self.m = m
-        self.error = None
-        
-    def run(self):
-        try:
-            self.m.runlogs.fetch_logs(self.scpcmd)
-            self.c.log.info("Fetched logs from '%s'" % self.iid)
-        except Exception,e:
-            self.c.log.error("error retrieving logs from '%s'" % self.iid)
-            self.error = e
+    Returns the number of VMs the logs could not be fetched from
+    """
+    scpcmds = []
+    error_count = 0
+    for (vm, scpcmd) in fetches:
+        if not scpcmd:
+            error_count += 1
+            c.log.error("\n\n** Issue with %s:\nno scp command\n" % vm.instanceid)
+            continue
+        scpcmds.append((vm.instanceid, scpcmd))
+
+    errors = m.runlogs.fetch_logs_all(scpcmds)
+    for (iid, scpcmd) in scpcmds:
+        error = errors.get(iid)
+        if error is None:
+            c.log.info("Fetched logs from '%s'" % iid)
+            continue
+        error_count += 1
+        c.log.error("error retrieving logs from '%s'" % iid)
+        msg = "** Issue with %s:\n" % iid
+        msg += str(error)
+        c.log.error("\n\n%s\n" % msg)
+    return error_count
 
 def fetch_all(p, c, m, run_name, cloudinitd):
     """Fetch log files from any VM instance that is part of the run
@@ -36,39 +43,19 @@ def fetch_all(p, c, m, run_name, cloudinitd):
     
     run_vms = _get_runvms_required(p, c, m, run_name, cloudinitd)
 
-    threads = []
+    fetches = []
     for vm in run_vms:
         scpcmd = m.runlogs.get_scp_command_str(c, vm, cloudinitd)
         if not scpcmd:
             continue
-        threads.append(FetchThread(vm, c, m, scpcmd))
+        fetches.append((vm, scpcmd))
     
     txt = "%d service" % len(run_vms)
     if len(run_vms) != 1:
         txt += "s"
     c.log.info("Beginning to logfetch %s" % txt)
     
-    done = False
-    idx = 0
-    while not done:
-        current_batch = threads[idx:idx+THREADS_PER_BATCH]
-        idx += THREADS_PER_BATCH
-        if idx > len(threads):
-            done = True
-            
-        for thr in current_batch:
-            thr.start()
-           
-        for thr in current_batch:
-            thr.join()
-        
-    error_count = 0
-    for thr in threads:
-        if thr.error:
-            error_count += 1
-            msg = "** Issue with %s:\n" % thr.worker.instanceid
-            msg += str(thr.error)
-            c.log.error("\n\n%s\n" % msg)
+    error_count = fetch_vms(c, m, fetches)
     
     if error_count > 1:
         c.log.info("All fetched with %d errors (%s)" % (error_count, txt))
@@ -126,15 +113,14 @@ def fetch_by_service_name(p, c, m, run_name, servicename, cloudinitd=None):
         
 # -----------------------------------------------------------------
 
-def _ok_to_fetch(a_vm):
-    state = find_state_from_events(a_vm)
+def _ok_to_fetch(state):
     if state != epustates.TERMINATED and state != epustates.TERMINATING and state != epustates.FAILED:
         return True
     else:
         return False
 
 def _get_runvms_required(p, c, m, run_name, cloudinitd):
-    run_vms = m.persistence.get_run_vms_or_none(run_name)
+    run_vms = m.persistence.get_run_vms(run_name, with_events=False)
     if not run_vms or len(run_vms) == 0:
         raise IncompatibleEnvironment("Cannot find any VMs associated with run '%s'" % run_name)
 
@@ -146,9 +132,10 @@ def _get_runvms_required(p, c, m, run_name, cloudinitd):
         else:
             c.log.warn("Cannot get worker status: there is no channel open to the EPU controllers")
 
-    run_vms = m.persistence.get_run_vms_or_none(run_name)
+    run_vms = m.persistence.get_run_vms(run_name, with_events=False)
     before = len(run_vms)
-    run_vms = filter(_ok_to_fetch, run_vms)
+    states = find_states(m, run_name, run_vms)
+    run_vms = [vm for vm in run_vms if _ok_to_fetch(states.get(vm.instanceid))]
     after = len(run_vms)
     if before != after:
         c.log.debug("filtered: %d are ok to fetch vs. %d total" % (after, before))
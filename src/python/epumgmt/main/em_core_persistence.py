@@ -1,10 +1,169 @@
 from epumgmt.defaults import is_piggybacked
+from epumgmt.defaults.log_checkpoint import ManifestEntry
+import epumgmt.defaults.epustates as epustates
 import os
 import urlparse
 from epumgmt.api import RunVM
 from epumgmt.api.exceptions import *
-from cloudminer import CloudMiner
+from cloudminer import CloudMiner, vm_table, event_table, xtra_table
 from cloudyvents.cyvents import CYvent
+import sqlalchemy
+import sqlalchemy.event
+from sqlalchemy import Column, DateTime, Float, Index, Integer, MetaData, String, Table
+from sqlalchemy import and_, select
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import SingletonThreadPool
+
+# Indexes the queries here need and cloudminer does not create.  Defined
+# once: they become part of cloudminer's tables, so new databases get them
+# from CloudMiner and validate() adds them to existing ones.
+INDEXES = (
+    # Latest event of a name for each VM is the question most of the
+    # status code asks, this answers it without reading any other event
+    Index("ix_events_vm_name_timestamp", event_table.c.vm_id,
+          event_table.c.name, event_table.c.timestamp),
+    # Every VM lookup by run
+    Index("ix_vms_runname", vm_table.c.runname),
+    # Loading the extras of an event
+    Index("ix_extras_event_id", xtra_table.c.event_id),
+    )
+
+# [persistence] settings applied to every SQLite connection, with the
+# values they accept (None for any integer)
+SQLITE_PRAGMAS = (
+    ("sqlite_journal_mode", "journal_mode",
+     ("DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF")),
+    ("sqlite_synchronous", "synchronous", ("OFF", "NORMAL", "FULL", "EXTRA")),
+    ("sqlite_mmap_size", "mmap_size", None),
+    ("sqlite_cache_size", "cache_size", None),
+    )
+
+# The events status queries record, compact_events() removes those that
+# repeat the one before them
+POLL_EVENT_NAMES = ("iaas_state", "heartbeat_state", "de_state", "de_conf_report")
+
+# The fields cloudminer's add_cloudyvent_vm() changes on a VM it already
+# has, the others keep the value the VM was first stored with
+CLOUDMINER_UPDATED_FIELDS = ("nodeid", "hostname", "service_type", "parent")
+
+# How many ids go into one IN clause
+IN_CHUNK = 500
+
+# The current state of every VM, kept up to date as its events are stored
+# so that nobody needs to go through the events to know it.  Not part of
+# cloudminer's tables: validate() creates it, and fills it in from the
+# events, when a database does not have it yet.
+state_metadata = MetaData()
+vm_state_table = Table('vm_states', state_metadata,
+    Column('iaasid', String(50), primary_key=True),
+    Column('runname', String(50), index=True),
+    Column('iaas_state', String(50)),
+    Column('iaas_state_time', DateTime),
+    Column('heartbeat_state', String(50)),
+    Column('heartbeat_time', DateTime),
+    Column('de_state', String(50)),
+    Column('de_state_time', DateTime),
+    Column('running_time', DateTime),
+    Column('terminated_time', DateTime),
+    )
+
+# What the event gather already parsed of each log file of a run, see
+# log_checkpoint.ManifestEntry.  Kept with the events it led to: a new
+# database, or a run that is not in it, starts without one.
+event_manifest_table = Table('event_manifest', state_metadata,
+    Column('runname', String(50), primary_key=True),
+    Column('path', String(1024), primary_key=True),
+    Column('inode', Integer),
+    Column('size', Integer),
+    Column('mtime', Float),
+    Column('offset', Integer),
+    Column('fingerprint', String(32)),
+    )
+
+def _copy_vm(vm, with_events=True):
+    """A RunVM with the fields of vm and a list of its (shared) events"""
+    copy = RunVM()
+    for field in RunVM.STORED_FIELDS:
+        setattr(copy, field, getattr(vm, field))
+    if with_events:
+        copy.events = list(vm.events)
+    copy.mark_stored()
+    return copy
+
+class VMState:
+    """The latest IaaS, heartbeat and decision engine states of a VM and
+    when it was last seen RUNNING and TERMINATED, all None if unknown.
+    """
+
+    # The events that change it
+    EVENT_NAMES = ("iaas_state", "heartbeat_state", "de_state")
+
+    FIELDS = ("iaas_state", "iaas_state_time", "heartbeat_state", "heartbeat_time",
+              "de_state", "de_state_time", "running_time", "terminated_time")
+
+    def __init__(self):
+        for field in self.FIELDS:
+            setattr(self, field, None)
+
+    def apply(self, event):
+        """Update from the event, return True if anything changed.  Of
+        states with the same timestamp the one applied first is kept.
+        """
+        extra = event.extra or {}
+        if event.name == "iaas_state":
+            state = self._get_state(event, extra, "state")
+            changed = self._set("iaas_state", "iaas_state_time", state, event.timestamp)
+            if state == epustates.RUNNING:
+                changed = self._seen("running_time", event.timestamp) or changed
+            elif state == epustates.TERMINATED:
+                changed = self._seen("terminated_time", event.timestamp) or changed
+            return changed
+        elif event.name == "heartbeat_state":
+            state = self._get_state(event, extra, "state")
+            return self._set("heartbeat_state", "heartbeat_time", state, event.timestamp)
+        elif event.name == "de_state":
+            # older controllers reported it as "state"
+            state = extra.get("state") or self._get_state(event, extra, "de_state")
+            return self._set("de_state", "de_state_time", state, event.timestamp)
+        return False
+
+    def get_values(self):
+        return dict([(field, getattr(self, field)) for field in self.FIELDS])
+
+    def _get_state(self, event, extra, key):
+        if not extra.has_key(key):
+            raise ProgrammingError("%s event has unexpected structure: %s" % (event.name, extra))
+        return extra[key]
+
+    def _set(self, field, timefield, state, timestamp):
+        current = getattr(self, timefield)
+        if current is not None and not timestamp > current:
+            return False
+        setattr(self, field, state)
+        setattr(self, timefield, timestamp)
+        return True
+
+    def _seen(self, timefield, timestamp):
+        current = getattr(self, timefield)
+        if current is not None and timestamp < current:
+            return False
+        setattr(self, timefield, timestamp)
+        return current != timestamp
+
+    def __repr__(self):
+        return "VMState: %s" % self.get_values()
+
+class _EngineCloudMiner(CloudMiner):
+    """CloudMiner on an engine made by the caller, CloudMiner() itself only
+    takes a URL.  Does what its constructor does with the engine.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        vm_table.metadata.create_all(engine)
+        self.Session = sessionmaker(bind=engine)
+        self.session = self.Session()
 
 class Persistence:
     def __init__(self, params, common):
@@ -12,7 +171,12 @@ class Persistence:
         self.c = common
         self.lockfilepath = None
         self.cdb = None
-        
+
+        # {run name: [RunVM]} of the runs read with their events, kept up
+        # to date by what this instance stores.  Callers get copies, see
+        # get_run_vms()
+        self.run_cache = {}
+
     def _find_db_conf(self):
         dbconf = self.p.get_conf_or_none("persistence", "persistencedb")
         if not dbconf:
@@ -56,7 +220,70 @@ class Persistence:
         
             
     def validate(self):
-        self.cdb = CloudMiner(self._find_db_conf())
+        pragmas = self._get_sqlite_pragmas()
+        self.cdb = self._open_db(self._find_db_conf(), pragmas)
+        self._create_indexes()
+        self._create_state_table()
+        event_manifest_table.create(bind=self.cdb.engine, checkfirst=True)
+
+    def _create_indexes(self):
+        for index in INDEXES:
+            try:
+                index.create(bind=self.cdb.engine)
+                self.c.log.info("Added index %s to the persistence database" % index.name)
+            except DBAPIError, e:
+                # most likely it is there already
+                self.c.log.debug("Not creating index %s: %s" % (index.name, e))
+
+    def _get_sqlite_pragmas(self):
+        """[(pragma, value)] from the [persistence] tuning settings"""
+        pragmas = []
+        for (key, pragma, allowed) in SQLITE_PRAGMAS:
+            value = self.p.get_conf_or_none("persistence", key)
+            if not value:
+                continue
+            value = value.strip().upper()
+            if allowed is None:
+                try:
+                    value = str(int(value))
+                except ValueError:
+                    raise InvalidConfig("persistence->%s must be a number: '%s'" % (key, value))
+            elif value not in allowed:
+                raise InvalidConfig("persistence->%s must be one of %s: '%s'" % (key, ", ".join(allowed), value))
+            pragmas.append((pragma, value))
+        return pragmas
+
+    def _open_db(self, dburl, pragmas):
+        """CloudMiner for dburl.  With SQLite tuning settings the engine
+        keeps one connection (per thread) open for the whole invocation:
+        CloudMiner's own opens one for each transaction, which would run
+        the pragmas every time and lose the page cache and memory map.
+        """
+        if not pragmas:
+            return CloudMiner(dburl)
+        if sqlalchemy.engine.url.make_url(dburl).get_backend_name() != "sqlite":
+            self.c.log.debug("Not a SQLite database, ignoring the sqlite_* settings")
+            return CloudMiner(dburl)
+
+        def on_connect(dbapi_conn, connection_record):
+            cursor = dbapi_conn.cursor()
+            try:
+                for (pragma, value) in pragmas:
+                    cursor.execute("PRAGMA %s = %s" % (pragma, value))
+            finally:
+                cursor.close()
+
+        engine = sqlalchemy.create_engine(dburl, poolclass=SingletonThreadPool)
+        sqlalchemy.event.listen(engine, "connect", on_connect)
+        self.c.log.debug("SQLite pragmas: %s" % ", ".join(["%s=%s" % x for x in pragmas]))
+        return _EngineCloudMiner(engine)
+
+    def _create_state_table(self):
+        if vm_state_table.exists(bind=self.cdb.engine):
+            return
+        vm_state_table.create(bind=self.cdb.engine)
+        self.c.log.info("Added the VM state table to the persistence database, filling it in")
+        self._rebuild_vm_states()
         
     def new_vm(self, run_name, vm):
         """Adds VM to a run_vms list if it exists for "run_name".  If list
@@ -66,10 +293,17 @@ class Persistence:
         # vm.events = CYvents
         # vm.instanceid = iaasid
         # runname
-        newone = self.cdb.add_cloudyvent_vm(run_name, vm.instanceid, vm.nodeid, vm.hostname, vm.service_type, vm.parent, vm.runlogdir, vm.vmlogdir)
-        for e in vm.events:
-            self.cdb.add_cloudyvent(run_name, vm.instanceid, vm.nodeid, vm.hostname, vm.service_type, vm.parent, vm.runlogdir, vm.vmlogdir, e)
-        self.cdb.commit()
+        try:
+            newone = self.cdb.add_cloudyvent_vm(run_name, vm.instanceid, vm.nodeid, vm.hostname, vm.service_type, vm.parent, vm.runlogdir, vm.vmlogdir)
+            for e in vm.get_new_events():
+                self.cdb.add_cloudyvent(run_name, vm.instanceid, vm.nodeid, vm.hostname, vm.service_type, vm.parent, vm.runlogdir, vm.vmlogdir, e)
+            self._update_vm_states(run_name, [vm])
+            self.cdb.commit()
+        except:
+            self._rollback()
+            raise
+        self._cache_stored(run_name, [vm])
+        vm.mark_stored()
         if newone:
             kind = "VM"
             if is_piggybacked(vm.instanceid):
@@ -78,14 +312,38 @@ class Persistence:
         return newone
         
     def store_run_vms(self, run_name, run_vms):
+        """Persist what changed in the VMs since they were loaded or last
+        stored, all in one transaction.
+        """
         if not self.cdb:
             raise ProgrammingError("cannot persist anything without setup/validation")
+        newevents = 0
+        try:
+            for vm in run_vms:
+                if vm.fields_changed():
+                    # This will updates some fields if needed, it's not actually "add" but "add only if new"
+                    self.cdb.add_cloudyvent_vm(run_name, vm.instanceid, vm.nodeid, vm.hostname, vm.service_type, vm.parent, vm.runlogdir, vm.vmlogdir)
+                for e in vm.get_new_events():
+                    self.cdb.add_cloudyvent(run_name, vm.instanceid, vm.nodeid, vm.hostname, vm.service_type, vm.parent, vm.runlogdir, vm.vmlogdir, e)
+                    newevents += 1
+            self._update_vm_states(run_name, run_vms)
+            self.cdb.commit()
+        except:
+            self._rollback()
+            raise
+        self._cache_stored(run_name, run_vms)
         for vm in run_vms:
-            # This will updates some fields if needed, it's not actually "add" but "add only if new"
-            self.cdb.add_cloudyvent_vm(run_name, vm.instanceid, vm.nodeid, vm.hostname, vm.service_type, vm.parent, vm.runlogdir, vm.vmlogdir)
-            for e in vm.events:
-                self.cdb.add_cloudyvent(run_name, vm.instanceid, vm.nodeid, vm.hostname, vm.service_type, vm.parent, vm.runlogdir, vm.vmlogdir, e)
-        self.cdb.commit()
+            vm.mark_stored()
+        self.c.log.debug("Stored %d VMs of run '%s', %d new events" % (len(run_vms), run_name, newevents))
+
+    def _rollback(self):
+        """Nothing of a failed store is kept, and the next one doesn't
+        start in a broken transaction.
+        """
+        try:
+            self.cdb.session.rollback()
+        except Exception, e:
+            self.c.log.error("Problem rolling back the persistence session: %s" % e)
 
     def find_instanceid_byservice(self, run_name, servicename):
         """Expects only zero or 1 result -- you cannot use the "piggybacking service" trick with a non-unique name
@@ -109,27 +367,478 @@ class Persistence:
 
     def get_run_vms_or_none(self, run_name):
         """Get list of VMs for a run name or return None"""
+        return self.get_run_vms(run_name)
+
+    def get_run_vms(self, run_name, with_events=True):
+        """Get list of VMs for a run name, with their events unless
+        with_events is False.
+
+        Loading the events (and each one's extras) is most of the cost of
+        this call, callers that only need the VM fields should skip them.
+        Their VMs have an empty event list and no stored event keys:
+        every event added to it is handed to cloudminer, which skips those
+        whose unique_event_key the database already has.
+
+        A run is only read from the database once per instance (that is,
+        per invocation), after that the list comes from run_cache.  Every
+        call returns new RunVM objects, so a caller changing its VMs
+        without storing them does not change what the next one gets.
+        """
 
         if not self.cdb:
             raise ProgrammingError("cannot persist anything without setup/validation")
-        cyvm_a = self.cdb.get_iaas_by_runname(run_name) 
+        cached = self.run_cache.get(run_name)
+        if cached is None and with_events:
+            cached = self._load_run_vms(run_name, True)
+            self.run_cache[run_name] = cached
+        if cached is None:
+            return self._load_run_vms(run_name, False)
+        return [_copy_vm(vm, with_events) for vm in cached]
+
+    def clear_run_cache(self, run_name=None):
+        """Read the run (all runs if run_name is None) from the database
+        again next time, for changes made by other processes.
+        """
+        if run_name is None:
+            self.run_cache = {}
+        elif self.run_cache.has_key(run_name):
+            del self.run_cache[run_name]
+
+    def _cache_stored(self, run_name, run_vms):
+        """Bring the cached run, if there is one, up to date with VMs that
+        were just stored (before their mark_stored)
+        """
+        cached = self.run_cache.get(run_name)
+        if cached is None:
+            return
+        by_instanceid = dict([(vm.instanceid, vm) for vm in cached])
+        for vm in run_vms:
+            if vm.instanceid is None:
+                self.clear_run_cache(run_name)
+                return
+            cvm = by_instanceid.get(vm.instanceid)
+            if cvm is None:
+                # New to the run, everything it has was just stored
+                cvm = RunVM()
+                cvm.events = list(vm.events)
+                cached.append(cvm)
+                by_instanceid[vm.instanceid] = cvm
+                fields = RunVM.STORED_FIELDS
+            else:
+                keys = set([e.key for e in cvm.events])
+                cvm.events.extend([e for e in vm.get_new_events() if e.key not in keys])
+                fields = CLOUDMINER_UPDATED_FIELDS
+            for field in fields:
+                setattr(cvm, field, getattr(vm, field))
+            cvm.mark_stored()
+
+    def _load_run_vms(self, run_name, with_events):
+        # Straight from the tables: going through cloudminer's objects
+        # means a query for the events of every VM and one for the extras
+        # of every event.
+        query = select([vm_table], vm_table.c.runname == run_name)
+        query = query.order_by(vm_table.c.id.asc())
         vm_a = []
-        for cyvm in cyvm_a:
+        by_id = {}
+        for row in self.cdb.session.execute(query):
             rvm = RunVM()
-            rvm.instanceid = cyvm.iaasid
-            rvm.nodeid = cyvm.nodeid
-            rvm.hostname = cyvm.hostname
-            rvm.service_type = cyvm.service_type
-            rvm.parent = cyvm.parent
-            rvm.runlogdir = cyvm.runlogdir
-            rvm.vmlogdir = cyvm.vmlogdir
-
-            for e in cyvm.events:
-                xtras = {}
-                for x in e.extra:
-                    xtras[x.key] = x.value
-                c = CYvent(e.source, e.name, e.unique_event_key, e.timestamp, xtras)
-                rvm.events.append(c)
+            rvm.instanceid = row['iaasid']
+            rvm.nodeid = row['nodeid']
+            rvm.hostname = row['hostname']
+            rvm.service_type = row['service_type']
+            rvm.parent = row['parent']
+            rvm.runlogdir = row['runlogdir']
+            rvm.vmlogdir = row['vmlogdir']
+            by_id[row['id']] = rvm
             vm_a.append(rvm)
 
+        if with_events and vm_a:
+            in_run = and_(vm_table.c.runname == run_name,
+                          event_table.c.vm_id == vm_table.c.id)
+            extras = self._get_run_extras(in_run)
+            query = select([event_table.c.vm_id, event_table.c.id, event_table.c.source,
+                            event_table.c.name, event_table.c.unique_event_key,
+                            event_table.c.timestamp], in_run)
+            query = query.order_by(event_table.c.id.asc())
+            for (vm_id, eid, source, name, key, timestamp) in self.cdb.session.execute(query):
+                c = CYvent(source, name, key, timestamp, extras.get(eid, {}))
+                by_id[vm_id].events.append(c)
+
+        for rvm in vm_a:
+            rvm.mark_stored()
         return vm_a
+
+    def _get_run_extras(self, in_run):
+        """{event id: {key: value}} for all events matching in_run"""
+        query = select([xtra_table.c.event_id, xtra_table.c.key, xtra_table.c.value],
+                       and_(in_run, xtra_table.c.event_id == event_table.c.id))
+        query = query.order_by(xtra_table.c.id.asc())
+        extras = {}
+        for (eid, key, value) in self.cdb.session.execute(query):
+            extras.setdefault(eid, {})[key] = value
+        return extras
+
+    def get_latest_events(self, run_name, event_name, vms=None, source=None):
+        """Return {instanceid: CYvent}, the latest event named event_name of
+        every VM in the run that has one.  If source is given only events
+        from that source are looked at.
+
+        If vms is given only those VMs are looked at, and events added to
+        them that are not stored yet count too.  Of events with the same
+        timestamp the first one stored wins.
+        """
+        latest = {}
+        for (iaasid, event) in self._latest_events(run_name, event_name, vms, source, False):
+            latest[iaasid] = event
+        for vm in vms or []:
+            for event in vm.get_new_events():
+                if event.name != event_name:
+                    continue
+                if source is not None and event.source != source:
+                    continue
+                current = latest.get(vm.instanceid)
+                if not current or event.timestamp > current.timestamp:
+                    latest[vm.instanceid] = event
+        return latest
+
+    def get_latest_events_by_source(self, run_name, event_name, vms=None):
+        """Return {(instanceid, source): CYvent}, the latest event named
+        event_name from each source of every VM in the run, otherwise the
+        same as get_latest_events().
+        """
+        latest = {}
+        for (iaasid, event) in self._latest_events(run_name, event_name, vms, None, True):
+            latest[(iaasid, event.source)] = event
+        for vm in vms or []:
+            for event in vm.get_new_events():
+                if event.name != event_name:
+                    continue
+                current = latest.get((vm.instanceid, event.source))
+                if not current or event.timestamp > current.timestamp:
+                    latest[(vm.instanceid, event.source)] = event
+        return latest
+
+    def _latest_events(self, run_name, event_name, vms, source, by_source):
+        """[(iaasid, CYvent)] of the stored latest events, one per VM or
+        with by_source one per VM and source.  Each is found through the
+        (vm, name, timestamp) index, only their extras are loaded.
+        """
+        if not self.cdb:
+            raise ProgrammingError("cannot persist anything without setup/validation")
+        latest_e = event_table.alias()
+        latest_clauses = [latest_e.c.vm_id == vm_table.c.id,
+                          latest_e.c.name == event_name]
+        if source is not None:
+            latest_clauses.append(latest_e.c.source == source)
+        if by_source:
+            latest_clauses.append(latest_e.c.source == event_table.c.source)
+        latest_id = select([latest_e.c.id], and_(*latest_clauses))
+        latest_id = latest_id.order_by(latest_e.c.timestamp.desc(), latest_e.c.id.asc())
+        latest_id = latest_id.limit(1).as_scalar()
+        where = and_(vm_table.c.runname == run_name,
+                     event_table.c.vm_id == vm_table.c.id,
+                     event_table.c.name == event_name,
+                     event_table.c.id == latest_id)
+        rows = self._select_events(where, self._vms_clause(vms))
+        return self._rows_to_events(rows, vms)
+
+    def get_events_by_name(self, run_name, event_name, start=None, end=None, vms=None):
+        """Return [(instanceid, CYvent)] of every event named event_name in
+        the run, oldest first.  If start and/or end are given only events
+        with start <= timestamp < end are returned.
+
+        If vms is given only those VMs are looked at, and events added to
+        them that are not stored yet are included.
+        """
+        if not self.cdb:
+            raise ProgrammingError("cannot persist anything without setup/validation")
+        clauses = [vm_table.c.runname == run_name,
+                   event_table.c.vm_id == vm_table.c.id,
+                   event_table.c.name == event_name]
+        if start is not None:
+            clauses.append(event_table.c.timestamp >= start)
+        if end is not None:
+            clauses.append(event_table.c.timestamp < end)
+        rows = self._select_events(and_(*clauses), self._vms_clause(vms))
+        found = self._rows_to_events(rows, vms)
+
+        unsaved = []
+        for vm in vms or []:
+            for event in vm.get_new_events():
+                if event.name != event_name:
+                    continue
+                if start is not None and event.timestamp < start:
+                    continue
+                if end is not None and event.timestamp >= end:
+                    continue
+                unsaved.append((vm.instanceid, event))
+        if unsaved:
+            # stable, so stored events stay ahead of unsaved ones at the same time
+            found.extend(unsaved)
+            found.sort(key=lambda (iaasid, event): event.timestamp)
+        return found
+
+    def get_event_sources(self, run_name, vms=None):
+        """Return {instanceid: set of the sources of its events} for the
+        VMs of the run.
+
+        If vms is given only those VMs are looked at, and events added to
+        them that are not stored yet count too.
+        """
+        if not self.cdb:
+            raise ProgrammingError("cannot persist anything without setup/validation")
+        where = and_(vm_table.c.runname == run_name,
+                     event_table.c.vm_id == vm_table.c.id)
+        vms_clause = self._vms_clause(vms)
+        if vms_clause is not None:
+            where = and_(where, vms_clause)
+        query = select([vm_table.c.iaasid, event_table.c.source], where).distinct()
+        wanted = None
+        if vms is not None:
+            wanted = set([vm.instanceid for vm in vms])
+        sources = {}
+        for (iaasid, source) in self.cdb.session.execute(query):
+            if wanted is None or iaasid in wanted:
+                sources.setdefault(iaasid, set()).add(source)
+        for vm in vms or []:
+            for event in vm.get_new_events():
+                sources.setdefault(vm.instanceid, set()).add(event.source)
+        return sources
+
+    def _vms_clause(self, vms):
+        # with one VM the query can go straight to it, otherwise the run's
+        # rows are filtered in _rows_to_events
+        if vms and len(vms) == 1:
+            return vm_table.c.iaasid == vms[0].instanceid
+        return None
+
+    def _select_events(self, where, extra_clause=None):
+        if extra_clause is not None:
+            where = and_(where, extra_clause)
+        query = select([vm_table.c.iaasid, event_table.c.id, event_table.c.source,
+                        event_table.c.name, event_table.c.unique_event_key,
+                        event_table.c.timestamp], where)
+        query = query.order_by(event_table.c.timestamp.asc(), event_table.c.id.asc())
+        return self.cdb.session.execute(query).fetchall()
+
+    def _rows_to_events(self, rows, vms=None):
+        """[(iaasid, CYvent)] for the rows of _select_events, with extras"""
+        if vms is not None:
+            wanted = set([vm.instanceid for vm in vms])
+            rows = [row for row in rows if row[0] in wanted]
+        extras = self._get_extras([row[1] for row in rows])
+        events = []
+        for (iaasid, eid, source, name, key, timestamp) in rows:
+            event = CYvent(source, name, key, timestamp, extras.get(eid, {}))
+            events.append((iaasid, event))
+        return events
+
+    def _get_extras(self, event_ids):
+        """{event id: {key: value}}"""
+        extras = {}
+        for i in range(0, len(event_ids), IN_CHUNK):
+            chunk = event_ids[i:i + IN_CHUNK]
+            query = select([xtra_table.c.event_id, xtra_table.c.key, xtra_table.c.value],
+                           xtra_table.c.event_id.in_(chunk))
+            query = query.order_by(xtra_table.c.id.asc())
+            for (eid, key, value) in self.cdb.session.execute(query):
+                extras.setdefault(eid, {})[key] = value
+        return extras
+
+    def get_vm_states(self, run_name, vms=None):
+        """Return {instanceid: VMState} of every VM in the run that has
+        state events.
+
+        If vms is given only those VMs are looked at, and events added to
+        them that are not stored yet count too.
+        """
+        if not self.cdb:
+            raise ProgrammingError("cannot persist anything without setup/validation")
+        if vms is None:
+            return self._select_vm_states(run_name)
+        states = self._select_vm_states(run_name, [vm.instanceid for vm in vms])
+        for vm in vms:
+            events = self._new_state_events(vm)
+            if not events:
+                continue
+            state = states.get(vm.instanceid) or VMState()
+            for event in events:
+                state.apply(event)
+            states[vm.instanceid] = state
+        return states
+
+    def _new_state_events(self, vm):
+        events = [e for e in vm.get_new_events() if e.name in VMState.EVENT_NAMES]
+        events.sort(key=lambda e: e.timestamp)
+        return events
+
+    def _select_vm_states(self, run_name=None, iaasids=None):
+        """{iaasid: VMState} from the state table, for the run and/or iaasids"""
+        clauses = []
+        if run_name is not None:
+            clauses.append(vm_state_table.c.runname == run_name)
+        if iaasids is None:
+            chunks = [None]
+        else:
+            chunks = [iaasids[i:i + IN_CHUNK] for i in range(0, len(iaasids), IN_CHUNK)]
+        states = {}
+        for chunk in chunks:
+            where = list(clauses)
+            if chunk is not None:
+                where.append(vm_state_table.c.iaasid.in_(chunk))
+            query = vm_state_table.select(and_(*where))
+            for row in self.cdb.session.execute(query):
+                state = VMState()
+                for field in VMState.FIELDS:
+                    setattr(state, field, row[field])
+                states[row['iaasid']] = state
+        return states
+
+    def _update_vm_states(self, run_name, run_vms):
+        """Apply the VMs' new state events to the state table, part of the
+        transaction that stores the events.
+        """
+        updates = []
+        for vm in run_vms:
+            if not vm.instanceid:
+                continue
+            events = self._new_state_events(vm)
+            if events:
+                updates.append((vm.instanceid, events))
+        if not updates:
+            return
+        current = self._select_vm_states(iaasids=[iaasid for (iaasid, events) in updates])
+        for (iaasid, events) in updates:
+            state = current.get(iaasid)
+            isnew = state is None
+            if isnew:
+                state = VMState()
+            changed = False
+            for event in events:
+                changed = state.apply(event) or changed
+            self._write_vm_state(run_name, iaasid, state, isnew, changed)
+            current[iaasid] = state
+
+    def _write_vm_state(self, run_name, iaasid, state, isnew, changed=True):
+        if isnew:
+            values = state.get_values()
+            values['iaasid'] = iaasid
+            values['runname'] = run_name
+            self.cdb.session.execute(vm_state_table.insert().values(**values))
+        elif changed:
+            update = vm_state_table.update().where(vm_state_table.c.iaasid == iaasid)
+            self.cdb.session.execute(update.values(**state.get_values()))
+
+    def _rebuild_vm_states(self, run_name=None):
+        """Compute the state table rows of the run (or all runs) from
+        their events, replacing what is there.
+        """
+        try:
+            count = self._fill_vm_states(run_name)
+            self.cdb.commit()
+        except:
+            self._rollback()
+            raise
+        self.c.log.debug("Rebuilt the state of %d VMs" % count)
+
+    def _fill_vm_states(self, run_name=None):
+        """The work of _rebuild_vm_states, in the current transaction"""
+        clauses = [event_table.c.vm_id == vm_table.c.id,
+                   event_table.c.name.in_(VMState.EVENT_NAMES)]
+        if run_name is not None:
+            clauses.append(vm_table.c.runname == run_name)
+        query = select([vm_table.c.runname, vm_table.c.iaasid, event_table.c.id,
+                        event_table.c.name, event_table.c.timestamp], and_(*clauses))
+        query = query.order_by(event_table.c.timestamp.asc(), event_table.c.id.asc())
+        rows = self.cdb.session.execute(query).fetchall()
+        extras = self._get_extras([row[2] for row in rows])
+        states = {}
+        for (runname, iaasid, eid, name, timestamp) in rows:
+            if not states.has_key(iaasid):
+                states[iaasid] = (runname, VMState())
+            event = CYvent(None, name, None, timestamp, extras.get(eid, {}))
+            try:
+                states[iaasid][1].apply(event)
+            except ProgrammingError, e:
+                # an old event must not stop every command from opening
+                # the database, it is left out of the state
+                self.c.log.warn("Skipping event %d of %s: %s" % (eid, iaasid, e))
+        delete = vm_state_table.delete()
+        if run_name is not None:
+            delete = delete.where(vm_state_table.c.runname == run_name)
+        self.cdb.session.execute(delete)
+        for iaasid, (runname, state) in states.iteritems():
+            self._write_vm_state(runname, iaasid, state, True)
+        return len(states)
+
+    def get_event_manifest(self, run_name):
+        """Return {path: log_checkpoint.ManifestEntry} of the run, see
+        store_event_manifest()
+        """
+        if not self.cdb:
+            raise ProgrammingError("cannot persist anything without setup/validation")
+        t = event_manifest_table
+        query = select([t.c.path, t.c.inode, t.c.size, t.c.mtime, t.c.offset, t.c.fingerprint],
+                       t.c.runname == run_name)
+        manifest = {}
+        for (path, inode, size, mtime, offset, digest) in self.cdb.session.execute(query):
+            manifest[path] = ManifestEntry(path, inode, size, mtime, offset, digest)
+        return manifest
+
+    def store_event_manifest(self, run_name, manifest):
+        """Replace the run's event gather manifest, only to be called once
+        the events gathered from those files are stored.
+        """
+        if not self.cdb:
+            raise ProgrammingError("cannot persist anything without setup/validation")
+        t = event_manifest_table
+        try:
+            self.cdb.session.execute(t.delete(t.c.runname == run_name))
+            rows = [{"runname": run_name, "path": entry.path, "inode": entry.inode,
+                     "size": entry.size, "mtime": entry.mtime, "offset": entry.offset,
+                     "fingerprint": entry.fingerprint} for entry in manifest.values()]
+            if rows:
+                self.cdb.session.execute(t.insert(), rows)
+            self.cdb.commit()
+        except:
+            self._rollback()
+            raise
+
+    def compact_events(self, run_name):
+        """Remove the status poll events of the run that repeat the one
+        before them: of every VM's events of a POLL_EVENT_NAMES name from
+        the same source, only those where the extras changed are kept.
+        Returns how many events were removed.
+        """
+        if not self.cdb:
+            raise ProgrammingError("cannot persist anything without setup/validation")
+        query = select([event_table.c.id, event_table.c.vm_id, event_table.c.source,
+                        event_table.c.name],
+                       and_(vm_table.c.runname == run_name,
+                            event_table.c.vm_id == vm_table.c.id,
+                            event_table.c.name.in_(POLL_EVENT_NAMES)))
+        query = query.order_by(event_table.c.vm_id, event_table.c.name, event_table.c.source,
+                               event_table.c.timestamp.asc(), event_table.c.id.asc())
+        try:
+            rows = self.cdb.session.execute(query).fetchall()
+            extras = self._get_extras([row[0] for row in rows])
+            redundant = []
+            previous = None
+            for (eid, vm_id, source, name) in rows:
+                current = (vm_id, name, source, extras.get(eid, {}))
+                if current == previous:
+                    redundant.append(eid)
+                previous = current
+            for i in range(0, len(redundant), IN_CHUNK):
+                chunk = redundant[i:i + IN_CHUNK]
+                self.cdb.session.execute(xtra_table.delete(xtra_table.c.event_id.in_(chunk)))
+                self.cdb.session.execute(event_table.delete(event_table.c.id.in_(chunk)))
+            if redundant:
+                self._fill_vm_states(run_name)
+            self.cdb.commit()
+        except:
+            self._rollback()
+            raise
+        self.clear_run_cache(run_name)
+        self.c.log.debug("Removed %d of %d status events of run '%s'" % (len(redundant), len(rows), run_name))
+        return len(redundant)
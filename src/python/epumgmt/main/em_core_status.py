@@ -50,7 +50,7 @@ def pretty_status(p, c, m, run_name, cloudinitd):
         c.log.info("Getting the latest status information")
         allvms = find_latest_status(p, c, m, run_name, cloudinitd)
 
-    c.log.info("\n%s" % _report(allvms))
+    c.log.info("\n%s" % _report(m, run_name, allvms))
 
 
 # ----------------------------------------------------------------------------------------------------
@@ -91,11 +91,28 @@ def _find_latest_worker_status(c, m, run_name, cloudinitd, allvms):
         c.log.exception("Unable to get worker state for controllers: %s" % controllers)
         return
 
-    _update_worker_parents(c, m, run_name, controllers, controller_state_map, allvms)
-    _update_worker_states(c, m, run_name, controllers, controller_state_map, allvms)
-    _update_controller_states(c, m, run_name, controller_map, controller_state_map, allvms)
-
-def _get_running_terminate_timestamps(run_vms):
+    # Everything the pass changes is stored at the end, in one transaction:
+    # if any of it fails nothing is
+    index = VMIndex(allvms)
+    changed = []
+    _update_worker_parents(c, m, run_name, controllers, controller_state_map, allvms, index, changed)
+    _update_worker_states(c, m, run_name, controllers, controller_state_map, allvms, index, changed)
+    _update_controller_states(c, m, run_name, controller_map, controller_state_map, allvms, index, changed)
+    _store_changed(m, run_name, changed)
+
+def _store_changed(m, run_name, changed):
+    """Persist the VMs in changed, each once, with one store_run_vms call
+    """
+    vms = []
+    seen = set()
+    for vm in changed:
+        if id(vm) not in seen:
+            seen.add(id(vm))
+            vms.append(vm)
+    if vms:
+        m.persistence.store_run_vms(run_name, vms)
+
+def _get_running_terminate_timestamps(m, run_name, run_vms):
     """returns a dictionary of tuples of the timestamps of the
        timestamp where a worker is RUNNING and TERMINATED.
 
@@ -105,16 +122,14 @@ def _get_running_terminate_timestamps(run_vms):
        {"i-fsdfdse" : (running_timestamp, terminated_timestamp), ... }
     """
 
+    vm_states = m.persistence.get_vm_states(run_name, run_vms)
     map = {}
     for vm in run_vms:
         running, terminated = None, None
-        for event in vm.events:
-            if event.name == "iaas_state":
-                state = event.extra["state"]
-                if state == epustates.RUNNING:
-                    running = event.timestamp
-                elif state == epustates.TERMINATED:
-                    terminated = event.timestamp
+        vm_state = vm_states.get(vm.instanceid)
+        if vm_state:
+            running = vm_state.running_time
+            terminated = vm_state.terminated_time
 
         map[vm.instanceid] = (running, terminated)
 
@@ -132,14 +147,21 @@ def _get_provisioner_vm(allvms):
 
     return provisioner_vm
 
-def _update_controller_states(c, m, run_name, controller_map, controller_state_map, allvms):
+def _update_controller_states(c, m, run_name, controller_map, controller_state_map, allvms, index, changed):
     """Generate "de_state" and "de_conf_report" cloudyvents.
+
+    index is the VMIndex of allvms.  The VMs that got new events are added
+    to changed for the caller to store, see _store_changed().  The same goes
+    for the other _update functions.
     """
 
     trace = False
 
+    controller_vms = [index.get_by_instanceid(instanceid) for instanceid in controller_map.keys()]
+    last_values = _last_controller_values(m, run_name, [vm for vm in controller_vms if vm])
+
     for instanceid in controller_map.keys():
-        vm = _get_vm_with_instanceid(instanceid, allvms)
+        vm = index.get_by_instanceid(instanceid)
         if not vm:
             msg = "instanceid '%s' is in your controller_map, but not your list of VMs?" % instanceid
             raise ProgrammingError(msg)
@@ -154,15 +176,16 @@ def _update_controller_states(c, m, run_name, controller_map, controller_state_m
                 msg += "Maybe a query failed?"
                 c.log.warn(msg)
                 continue
-            newevent = _get_events_from_controller_state(state, vm, controller, trace, c)
+            last = last_values.get((instanceid, controller), {})
+            newevent = _get_events_from_controller_state(state, vm, controller, trace, c, last)
             if newevent:
                 any_newevent = True
 
         if any_newevent:
-            m.persistence.store_run_vms(run_name, [vm])
+            changed.append(vm)
 
 
-def _update_worker_parents(c, m, run_name, controllers, controller_state_map, allvms):
+def _update_worker_parents(c, m, run_name, controllers, controller_state_map, allvms, index, changed):
     """Update the parent attribute for each worker vm
     """
 
@@ -175,7 +198,7 @@ def _update_worker_parents(c, m, run_name, controllers, controller_state_map, al
             c.log.warn(msg)
             continue
         for wis in state.instances:
-            vm = _get_vm_with_nodeid(wis.nodeid, allvms)
+            vm = index.get_by_nodeid(wis.nodeid)
             if not vm:
                 # Can't make a RunVM yet for this, unfortunately
                 c.log.warn("Controller '%s' knows about worker we have no IaaS id for yet: %s" % (controller, wis.nodeid))
@@ -190,14 +213,17 @@ def _update_worker_parents(c, m, run_name, controllers, controller_state_map, al
                         "'%s', new status query indicates parent is '%s'" % (vm.parent, controller))
 
             if newparent:
-                m.persistence.store_run_vms(run_name, [vm])
+                changed.append(vm)
+
 
-def _update_worker_states(c, m, run_name, controllers, controller_state_map, allvms):
+def _update_worker_states(c, m, run_name, controllers, controller_state_map, allvms, index, changed):
     """Generate "iaas_state" and "heartbeat_state" cloudyvents. 
     """
 
     trace = False
 
+    vm_states = m.persistence.get_vm_states(run_name, allvms)
+
     for controller in controllers:
         try:
             state = controller_state_map[controller]
@@ -208,23 +234,26 @@ def _update_worker_states(c, m, run_name, controllers, controller_state_map, all
             continue
 
         for wis in state.instances:
-            vm = _get_vm_with_nodeid(wis.nodeid, allvms)
+            vm = index.get_by_nodeid(wis.nodeid)
             if not vm:
                 # Can't make a RunVM yet for this, unfortunately
                 c.log.warn("Controller '%s' knows about worker we have no IaaS id for yet: %s" % (controller, wis.nodeid))
                 continue
 
-            newevent = _get_events_from_wis(wis, vm, controller, trace, c)
+            newevent = _get_events_from_wis(wis, vm, controller, trace, c, vm_states.get(vm.instanceid))
             if newevent:
-                m.persistence.store_run_vms(run_name, [vm])
+                changed.append(vm)
 
 
-def _get_events_from_wis(wis, vm, controller, trace, c):
+def _get_events_from_wis(wis, vm, controller, trace, c, last=None):
     """See if there is anything in the WorkerInstanceState, return True if events were added
+
+    last -- the VMState persistence has for the VM, if any.  States that
+    are the same as there are not recorded again.
     """
     newevent = False
 
-    if wis.iaas_state:
+    if wis.iaas_state and not (last and last.iaas_state == wis.iaas_state):
         event = CYvent(controller,
                        "iaas_state",
                        str(uuid.uuid4()),
@@ -237,7 +266,7 @@ def _get_events_from_wis(wis, vm, controller, trace, c):
         if trace:
             c.log.debug("iaas_state for %s: %s (from controller '%s')" % (vm.instanceid, wis.iaas_state, controller))
 
-    if wis.heartbeat_state:
+    if wis.heartbeat_state and not (last and last.heartbeat_state == wis.heartbeat_state):
         event = CYvent(controller,
                        "heartbeat_state",
                        str(uuid.uuid4()),
@@ -253,12 +282,31 @@ def _get_events_from_wis(wis, vm, controller, trace, c):
     return newevent
 
 
-def _get_events_from_controller_state(state, vm, controller, trace, c):
+def _last_controller_values(m, run_name, vms):
+    """{(instanceid, controller): {event name: value}} of the de_state and
+    de_conf_report last recorded for each controller of the given VMs, with
+    one query per event name for all of them.
+    """
+    last = {}
+    if not vms:
+        return last
+    for name in ("de_state", "de_conf_report"):
+        latest = m.persistence.get_latest_events_by_source(run_name, name, vms)
+        for key, event in latest.iteritems():
+            last.setdefault(key, {})[name] = event.extra.get(name)
+    return last
+
+def _get_events_from_controller_state(state, vm, controller, trace, c, last=None):
     """See if there is anything in the EPUControllerState, return True if any events were added
+
+    last -- see _last_controller_values(), values that are the same as
+    there are not recorded again.
     """
     newevent = False
+    if last is None:
+        last = {}
 
-    if state.de_state:
+    if state.de_state and state.de_state != last.get("de_state"):
         event = CYvent(controller,
                        "de_state",
                        str(uuid.uuid4()),
@@ -269,7 +317,7 @@ def _get_events_from_controller_state(state, vm, controller, trace, c):
         if trace:
             c.log.debug("de_state for controller %s: %s" % (controller, state.de_state))
 
-    if state.de_conf_report:
+    if state.de_conf_report and state.de_conf_report != last.get("de_conf_report"):
         event = CYvent(controller,
                        "de_conf_report",
                        str(uuid.uuid4()),
@@ -282,21 +330,44 @@ def _get_events_from_controller_state(state, vm, controller, trace, c):
 
     return newevent
 
-def _get_vm_with_nodeid(nodeid, allvms):
-    """Return RunVM object for nodeid or None if not found
+class VMIndex:
+    """The VMs of a status pass by nodeid, by instanceid and by the sources
+    of their events, built once so that finding one does not mean going
+    through all of them.  Where several VMs match, the first one in the
+    list is returned.
     """
-    for vm in allvms:
-        if vm.nodeid == nodeid:
-            return vm
-    return None
 
-def _get_vm_with_instanceid(instanceid, allvms):
-    """Return RunVM object for instanceid or None if not found
-    """
-    for vm in allvms:
-        if vm.instanceid == instanceid:
-            return vm
-    return None
+    def __init__(self, allvms):
+        self.allvms = allvms
+        self.by_nodeid = {}
+        self.by_instanceid = {}
+        for vm in allvms:
+            self.by_nodeid.setdefault(vm.nodeid, vm)
+            self.by_instanceid.setdefault(vm.instanceid, vm)
+        # needs persistence, see get_by_source()
+        self.by_source = None
+
+    def get_by_nodeid(self, nodeid):
+        """Return RunVM object for nodeid or None if not found
+        """
+        return self.by_nodeid.get(nodeid)
+
+    def get_by_instanceid(self, instanceid):
+        """Return RunVM object for instanceid or None if not found
+        """
+        return self.by_instanceid.get(instanceid)
+
+    def get_by_source(self, m, run_name, source):
+        """Return RunVM object with events from source (a controller for
+        example) or None if not found
+        """
+        if self.by_source is None:
+            self.by_source = {}
+            sources = m.persistence.get_event_sources(run_name, self.allvms)
+            for vm in self.allvms:
+                for vm_source in sources.get(vm.instanceid, []):
+                    self.by_source.setdefault(vm_source, vm)
+        return self.by_source.get(source)
 
 def _filter_out_workers(allvms):
 
@@ -327,60 +398,40 @@ def _filter_out_services(allvms):
             workers.append(vm)
     return workers
 
-def _find_state_from_events(vm):
+def _find_states(m, run_name, vms):
+    """Return {instanceid: latest iaas_state} of the VMs that have one"""
+    vm_states = m.persistence.get_vm_states(run_name, vms)
+    states = {}
+    for instanceid, vm_state in vm_states.iteritems():
+        if vm_state.iaas_state:
+            states[instanceid] = vm_state.iaas_state
+    return states
 
-    if not vm:
-        return None
-    if not vm.events:
-        return None
-    latest = None
-    for ev in vm.events:
-        if ev.name == "iaas_state":
-            if latest:
-                if latest.timestamp < ev.timestamp:
-                    latest = ev
-            else:
-                latest = ev
-
-    if not latest:
-        return None
-    return latest.extra["state"]
+def _find_state_from_events(m, run_name, vm):
 
-def _get_vm_with_controller(controller, vm_list):
-    for vm in vm_list:
-        for ev in vm.events:
-            if ev.source == controller:
-                return vm
-    return None
-
-def _latest_controller_state(vm):
     if not vm:
         return None
-    if not vm.events:
+    return _find_states(m, run_name, [vm]).get(vm.instanceid)
+
+def _latest_controller_states(m, run_name, vms):
+    """Return {instanceid: latest de_state} of the VMs that have one"""
+    vm_states = m.persistence.get_vm_states(run_name, vms)
+    states = {}
+    for instanceid, vm_state in vm_states.iteritems():
+        if vm_state.de_state:
+            states[instanceid] = vm_state.de_state
+    return states
+
+def _latest_controller_state(m, run_name, vm):
+    if not vm:
         return None
-    latest_destate = None
-    for ev in vm.events:
-        if ev.name == "de_state":
-            if latest_destate:
-                if latest_destate.timestamp < ev.timestamp:
-                    latest_destate = ev
-            else:
-                latest_destate = ev
-
-    ret_state = latest_destate
-    if latest_destate:
-        if latest_destate.extra.has_key("de_state"):
-            ret_state = latest_destate.extra["de_state"]
-        if latest_destate.extra.has_key("state"):
-            ret_state = latest_destate.extra["state"]
-
-    return ret_state
+    return _latest_controller_states(m, run_name, [vm]).get(vm.instanceid)
 
 # ----------------------------------------------------------------------------------------------------
 # REPORT
 # ----------------------------------------------------------------------------------------------------
 
-def _report(allvms):
+def _report(m, run_name, allvms):
     txt = "\n------------\nBase System:\n------------\n\n"
     default_typetxt = "(unknown)"
     default_hostname = "(unknown)"
@@ -409,7 +460,8 @@ def _report(allvms):
     default_controller = "(unknown controller)"
     by_controller = {} # key: controller, value: list of vm_info tuples for it
     
-    timestamps = _get_running_terminate_timestamps(workers)
+    timestamps = _get_running_terminate_timestamps(m, run_name, workers)
+    states = _find_states(m, run_name, workers)
 
     for vm in workers:
 
@@ -417,7 +469,7 @@ def _report(allvms):
         if vm.hostname:
             hostname = vm.hostname
 
-        status = _find_state_from_events(vm)
+        status = states.get(vm.instanceid)
         if not status:
             status = default_status
 
@@ -451,12 +503,14 @@ def _report(allvms):
                 widest_running_timestamp = len(str(vm_info[3]))
 
 
+    controller_states = _latest_controller_states(m, run_name, services)
+    services_index = VMIndex(services)
     for controller in by_controller.keys():
         txt += "%s:\n" % controller
 
-        vm = _get_vm_with_controller(controller, services)
+        vm = services_index.get_by_source(m, run_name, controller)
         if vm:
-            latest_destate = _latest_controller_state(vm)
+            latest_destate = controller_states.get(vm.instanceid)
             if latest_destate:
                 txt += "  EPU state: %s" % latest_destate
             else:
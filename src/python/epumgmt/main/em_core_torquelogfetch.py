@@ -3,6 +3,7 @@ import os
 
 import epumgmt.main.em_core_load
 import epumgmt.defaults.child
+import epumgmt.defaults.sshmux
 
 
 # used to fetch torque logs on torque headnode
@@ -32,6 +33,7 @@ class TorqueLogs:
             os.mkdir(self.torquelogdir)
 
     def _execute_cmd(self, cmd):
+        cmd = epumgmt.defaults.sshmux.multiplexed(self.p, self.c, cmd)
         self.c.log.debug("command = '%s'" % cmd)
         timeout = 30.0 # seconds
         (k, rc, out, err) = epumgmt.defaults.child.child(cmd, timeout=timeout)
@@ -94,11 +94,11 @@ def _pad_txt(txt, widest):
 def _gather_vnodes(p, c, m, run_name):
     c.log.debug("Looking for versions")
 
-    allvms = m.persistence.get_run_vms_or_none(run_name)
+    allvms = m.persistence.get_run_vms(run_name, with_events=False)
     if not allvms or len(allvms) == 0:
         raise IncompatibleEnvironment("Cannot find any VMs associated with run '%s'" % run_name)
 
-    vnodes = _init_vnodes(allvms)
+    vnodes = _init_vnodes(m, run_name, allvms)
     vlen = len(vnodes)
     if not vlen:
         raise IncompatibleEnvironment("Could not find any version information")
@@ -116,27 +116,29 @@ def _gather_vnodes(p, c, m, run_name):
                 counts[version] = 1
     return vnodes, counts
 
-def _init_vnodes(allvms):
+def _init_vnodes(m, run_name, allvms):
+    deplists = {}
+    for (instanceid, ev) in m.persistence.get_events_by_name(run_name, "deplist", vms=allvms):
+        deplists.setdefault(instanceid, []).append(ev)
     vnodes = []
     for vm in allvms:
-        for ev in vm.events:
-            if ev.name == "deplist":
-                vnode = VersionsNode(vm)
-                vnodes.append(vnode)
-                if not ev.extra:
-                    raise UnexpectedError("deplist event syntax is not right")
-                #print "DEPLIST EXTRA: %s" % ev.extra
-                for key in ev.extra.keys():
-                    if key == "depsource":
-                        continue
-                    elif key == "gitcommit":
-                        vnode.gitcommit = ev.extra[key]
-                    elif key == "projectversion":
-                        vnode.projectversion = ev.extra[key]
-                    elif key.startswith("dep"):
-                        dep = _filter_dep(ev.extra[key])
-                        if dep:
-                            vnode.versions.append(dep)
+        for ev in deplists.get(vm.instanceid, []):
+            vnode = VersionsNode(vm)
+            vnodes.append(vnode)
+            if not ev.extra:
+                raise UnexpectedError("deplist event syntax is not right")
+            #print "DEPLIST EXTRA: %s" % ev.extra
+            for key in ev.extra.keys():
+                if key == "depsource":
+                    continue
+                elif key == "gitcommit":
+                    vnode.gitcommit = ev.extra[key]
+                elif key == "projectversion":
+                    vnode.projectversion = ev.extra[key]
+                elif key.startswith("dep"):
+                    dep = _filter_dep(ev.extra[key])
+                    if dep:
+                        vnode.versions.append(dep)
     return vnodes
 
 def _filter_dep(dep):
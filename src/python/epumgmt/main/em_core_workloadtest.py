@@ -14,6 +14,7 @@ from epumgmt.api.exceptions import InvalidConfig, ProgrammingError
 import epumgmt.main.em_core
 import epumgmt.main.em_core_load
 import epumgmt.defaults.child
+import epumgmt.defaults.sshmux
 
 
 # just used for logging events for starting / terminating the EPU controller
@@ -71,6 +72,7 @@ class Torque:
         self.svc = cloudinitd.get_service("basenode")
 
     def _execute_cmd(self, cmd):
+        cmd = epumgmt.defaults.sshmux.multiplexed(self.p, self.c, cmd)
         self.c.log.debug("command = '%s'" % cmd)
         timeout = 30.0 # seconds
         (k, rc, out, err) = epumgmt.defaults.child.child(cmd, timeout=timeout)
@@ -193,6 +195,7 @@ class Workload:
         self.workload_type = workloadtype
         self.cloudinitd = epumgmt.main.em_core_load.get_cloudinit(p, c, m, run_name)
         self.epucontroller = epucontroller
+        self.amqp_events = None
         # hardcoded for now, ick -- is this in a config somewhere?
         self.port = '8001'
         if self.workload_type == 'torque':
@@ -248,7 +251,7 @@ class Workload:
                                 'definition file: %s.' % line)
 
     def _get_hostname(self, name):
-        vms = self.m.persistence.get_run_vms_or_none(self.run_name)
+        vms = self.m.persistence.get_run_vms(self.run_name, with_events=False)
         host = ''
         for vm in vms:
             if vm.service_type == name:
@@ -338,8 +341,11 @@ class Workload:
     def _num_amqp_jobs_done(self):
         self._find_workers()
         self._fetch_logs()
-        log_events = AmqpEvents(self.p, self.c, self.m, self.run_name)
-        count = log_events.get_event_count('job_end')
+        # keep the events around between polls, only the logs that were
+        # fetched again since the last poll need to be re-read
+        if not self.amqp_events:
+            self.amqp_events = AmqpEvents(self.p, self.c, self.m, self.run_name)
+        count = self.amqp_events.get_event_count('job_end')
         return count
 
     def _num_torque_jobs_done(self):
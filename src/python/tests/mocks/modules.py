@@ -1,7 +1,10 @@
+from epumgmt.main.em_core_persistence import VMState
+
 class FakePersistence:
 
     def __init__(self):
         self.vm_store = {}
+        self.event_manifests = {}
 
     def store_run_vms(self, run_name, vms):
         if not self.vm_store.has_key(run_name):
@@ -12,6 +15,72 @@ class FakePersistence:
     def get_run_vms_or_none(self, run_name):
         return self.vm_store[run_name]
 
+    def get_run_vms(self, run_name, with_events=True):
+        return self.vm_store[run_name]
+
+    def get_event_manifest(self, run_name):
+        return dict(self.event_manifests.get(run_name, {}))
+
+    def store_event_manifest(self, run_name, manifest):
+        self.event_manifests[run_name] = dict(manifest)
+
+    def get_latest_events(self, run_name, event_name, vms=None, source=None):
+        latest = {}
+        for instanceid, event in self.get_events_by_name(run_name, event_name, vms=vms):
+            if source is not None and event.source != source:
+                continue
+            current = latest.get(instanceid)
+            if not current or event.timestamp > current.timestamp:
+                latest[instanceid] = event
+        return latest
+
+    def get_latest_events_by_source(self, run_name, event_name, vms=None):
+        latest = {}
+        for instanceid, event in self.get_events_by_name(run_name, event_name, vms=vms):
+            current = latest.get((instanceid, event.source))
+            if not current or event.timestamp > current.timestamp:
+                latest[(instanceid, event.source)] = event
+        return latest
+
+    def get_vm_states(self, run_name, vms=None):
+        if vms is None:
+            vms = self.vm_store.get(run_name, [])
+        states = {}
+        for vm in vms:
+            events = [e for e in vm.events if e.name in VMState.EVENT_NAMES]
+            if not events:
+                continue
+            events.sort(key=lambda e: e.timestamp)
+            states[vm.instanceid] = VMState()
+            for event in events:
+                states[vm.instanceid].apply(event)
+        return states
+
+    def get_event_sources(self, run_name, vms=None):
+        if vms is None:
+            vms = self.vm_store.get(run_name, [])
+        sources = {}
+        for vm in vms:
+            for event in vm.events:
+                sources.setdefault(vm.instanceid, set()).add(event.source)
+        return sources
+
+    def get_events_by_name(self, run_name, event_name, start=None, end=None, vms=None):
+        if vms is None:
+            vms = self.vm_store.get(run_name, [])
+        found = []
+        for vm in vms:
+            for event in vm.events:
+                if event.name != event_name:
+                    continue
+                if start is not None and event.timestamp < start:
+                    continue
+                if end is not None and event.timestamp >= end:
+                    continue
+                found.append((vm.instanceid, event))
+        found.sort(key=lambda (instanceid, event): event.timestamp)
+        return found
+
 class FakeModules:
     
     def __init__(self, remote_svc_adapter=None, runlogs=None):
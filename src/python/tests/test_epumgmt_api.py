@@ -108,3 +108,27 @@ class TestEpumgmtAPI:
         assert c.__class__ == common_class
         assert p.get_arg_or_none("name") == self.opts.name
         assert ac.has_section("emimpls")
+
+
+class TestRunVM:
+
+    def test_dirty_tracking(self):
+        from epumgmt.api import RunVM
+        from cloudyvents.cyvents import CYvent
+
+        vm = RunVM()
+        vm.instanceid = "i-4h23ui4"
+        vm.events = [CYvent("src", "first", "key1", None, None)]
+        assert not vm.is_stored()
+        assert vm.fields_changed()
+        assert len(vm.get_new_events()) == 1
+
+        vm.mark_stored()
+        assert vm.is_stored()
+        assert not vm.fields_changed()
+        assert vm.get_new_events() == []
+
+        vm.events.append(CYvent("src", "second", "key2", None, None))
+        vm.hostname = "fake.example.com"
+        assert vm.fields_changed()
+        assert [e.key for e in vm.get_new_events()] == ["key2"]
@@ -0,0 +1,244 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+import ConfigParser
+
+from nose.plugins.attrib import attr
+from nose.plugins.skip import SkipTest
+
+from epumgmt.api.exceptions import InvalidConfig
+from epumgmt.defaults import DefaultParameters
+from epumgmt.defaults.child import child, Executor, get_max_running, get_fd_budget
+from epumgmt.defaults.child import DEFAULT_MAX_RUNNING
+import epumgmt.defaults.child as child_module
+
+class TestChild:
+
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.tmpdir)
+        child_module._fd_budgets.clear()
+
+    def test_child(self):
+
+        (killed, retcode, stdout, stderr) = child("echo out; echo err >&2; exit 3")
+        assert not killed
+        assert retcode == 3
+        assert stdout == "out\n"
+        assert stderr == "err\n"
+
+        chunks = []
+        (killed, retcode, stdout, stderr) = child("echo a; echo b", stdout_consumer=chunks.append)
+        assert retcode == 0
+        assert stdout is None
+        assert "".join(chunks) == "a\nb\n"
+
+    def test_timeout_kills_process_group(self):
+
+        pidfile = os.path.join(self.tmpdir, "pid")
+        started = time.time()
+        (killed, retcode, stdout, stderr) = child("sleep 30 & echo $! > %s; wait" % pidfile,
+                                                  timeout=0.5)
+        assert time.time() - started < 5
+        assert killed
+        assert retcode < 0
+
+        # what the child started is gone too
+        pid = int(open(pidfile).read())
+        gone = False
+        for i in range(50):
+            try:
+                os.kill(pid, 0)
+            except OSError:
+                gone = True
+                break
+            time.sleep(0.1)
+        assert gone
+
+    def test_background_output_holder(self):
+
+        # exits while something it started still has its output open
+        started = time.time()
+        (killed, retcode, stdout, stderr) = child("(sleep 5 &); echo done")
+        assert time.time() - started < 3
+        assert not killed
+        assert stdout == "done\n"
+
+    def test_executor(self):
+
+        done = []
+        executor = Executor(max_running=2)
+        results = []
+        for i in range(6):
+            results.append(executor.submit("sleep 0.5; echo %d; echo e >&2" % i, key=i,
+                                           callback=done.append))
+        executor.submit("sleep 30", timeout=0.2, key="slow", callback=done.append)
+
+        started = time.time()
+        assert executor.run()[:6] == results
+        elapsed = time.time() - started
+
+        # two at a time: three rounds of half a second
+        assert 1.4 < elapsed < 3, elapsed
+        assert len(done) == 7
+        for i, result in enumerate(results):
+            assert result.key == i
+            assert result.succeeded()
+            assert result.stdout == "%d\n" % i
+            assert result.stdout_bytes == 2
+            assert result.stderr_bytes == 2
+            assert 0.4 < result.duration < 2
+        slow = [result for result in done if result.key == "slow"][0]
+        assert slow.killed
+        assert not slow.succeeded()
+
+    def test_many(self):
+
+        executor = Executor(max_running=DEFAULT_MAX_RUNNING)
+        for i in range(200):
+            executor.submit("echo %d" % i, key=i)
+        results = executor.run()
+        assert [result.stdout for result in results] == ["%d\n" % i for i in range(200)]
+
+    def test_exec(self):
+
+        # not through a shell
+        (killed, retcode, stdout, stderr) = child(["echo", "$HOME", "a b"])
+        assert retcode == 0
+        assert stdout == "$HOME a b\n"
+
+        (killed, retcode, stdout, stderr) = child(["/no/such/program", "x"])
+        assert retcode == 127
+        assert "/no/such/program" in stderr
+
+    def test_cancel(self):
+
+        executor = Executor(max_running=2)
+        first = executor.submit("sleep 30")
+        second = executor.submit(["sleep", "30"])
+        queued = executor.submit("echo never")
+
+        def cancel():
+            time.sleep(0.3)
+            executor.cancel(queued)
+            executor.cancel(first)
+            time.sleep(0.3)
+            executor.cancel_all()
+        thr = threading.Thread(target=cancel)
+        thr.start()
+        started = time.time()
+        executor.run()
+        thr.join()
+
+        assert time.time() - started < 5
+        for result in (first, second, queued):
+            assert result.cancelled
+            assert not result.killed
+            assert not result.succeeded()
+        assert first.duration < second.duration
+        assert queued.exitcode is None
+        assert queued.started is None
+
+    def test_from_callback(self):
+
+        executor = Executor(max_running=3)
+        done = []
+        def callback(result):
+            done.append(result.key)
+            if result.key == "first":
+                executor.submit("echo again", key="again", callback=callback)
+                executor.cancel(slow)
+        executor.submit("echo first", key="first", callback=callback)
+        slow = executor.submit("sleep 30", key="slow", callback=callback)
+        started = time.time()
+        results = executor.run()
+        assert time.time() - started < 5
+        assert sorted(done) == ["again", "first", "slow"]
+        assert [result.key for result in results] == ["first", "slow", "again"]
+        assert results[2].stdout == "again\n"
+        assert results[1].cancelled
+
+    def test_fd_budget(self):
+
+        try:
+            import resource
+        except ImportError:
+            raise SkipTest("no resource module")
+
+        # fake limits, the test process keeps its own
+        limits = [(1024, 4096)]
+        raised = []
+        def fake_setrlimit(which, new_limits):
+            raised.append(new_limits)
+            limits[0] = new_limits
+        real_getrlimit = resource.getrlimit
+        real_setrlimit = resource.setrlimit
+        resource.getrlimit = lambda which: limits[0]
+        resource.setrlimit = fake_setrlimit
+        try:
+            assert get_fd_budget(1) == 1
+            fits = (1024 - child_module.FD_RESERVE) / 2
+            assert get_fd_budget(fits) == fits
+            assert raised == []
+
+            # the limit is only raised when it is too low, and only once
+            assert get_fd_budget(fits + 1) == fits + 1
+            assert get_fd_budget(fits + 1) == fits + 1
+            assert raised == [(2 * (fits + 1) + child_module.FD_RESERVE, 4096)]
+
+            # never past the hard limit
+            assert get_fd_budget(10000) == (4096 - child_module.FD_RESERVE) / 2
+            assert raised[-1] == (4096, 4096)
+
+            # nor when that cannot be done
+            child_module._fd_budgets.clear()
+            limits[0] = (1024, 1024)
+            del raised[:]
+            assert get_fd_budget(10000) == fits
+            assert raised == []
+
+            limits[0] = (resource.RLIM_INFINITY, resource.RLIM_INFINITY)
+            assert get_fd_budget(20000) == 20000
+        finally:
+            resource.getrlimit = real_getrlimit
+            resource.setrlimit = real_setrlimit
+
+    @attr("slow")
+    def test_high_fanout(self):
+
+        n = os.environ.get("EPUMGMT_FANOUT_CHILDREN")
+        if not n:
+            raise SkipTest("EPUMGMT_FANOUT_CHILDREN is not set")
+        n = int(n)
+        executor = Executor(max_running=n)
+        for i in range(n):
+            executor.submit(["sleep", "2"], timeout=120)
+        started = time.time()
+        results = executor.run()
+        elapsed = time.time() - started
+        assert len([result for result in results if result.succeeded()]) == n
+        # all in flight together: batches of DEFAULT_MAX_RUNNING would take
+        # minutes
+        assert elapsed < 30
+
+    def test_max_running_config(self):
+
+        config = ConfigParser.RawConfigParser()
+        config.add_section("ssh")
+        p = DefaultParameters(config, None)
+        assert get_max_running(p) == DEFAULT_MAX_RUNNING
+        config.set("ssh", "max_running", "5")
+        assert get_max_running(p) == 5
+
+        for value in ("0", "lots"):
+            config.set("ssh", "max_running", value)
+            try:
+                get_max_running(p)
+                raised_invalid_config = False
+            except InvalidConfig:
+                raised_invalid_config = True
+            assert raised_invalid_config, value
@@ -0,0 +1,255 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+import ConfigParser
+
+import cloudyvents.cyvents as cyvents
+from nose.plugins.attrib import attr
+from nose.plugins.skip import SkipTest
+
+from epumgmt.api import RunVM
+from epumgmt.api.exceptions import InvalidConfig
+from epumgmt.defaults import DefaultParameters, DefaultEventGather
+import epumgmt.defaults.event_scanner as event_scanner
+from mocks.common import FakeCommon
+from mocks.modules import FakePersistence
+
+# the merge benchmark only runs when this is set
+BENCH_MERGE_EVENTS = os.environ.get("EPUMGMT_BENCH_MERGE_EVENTS")
+
+def _event_line(name, key, second=7):
+    event = {"eventname": name, "eventsource": "provisioner", "uniquekey": key,
+             "timestamp": {"hour": 18, "month": 7, "second": second, "microsecond": 532627,
+                           "year": 2011, "day": 7, "minute": 4},
+             "extra": {"iaas_id": "i-%s" % key}}
+    return "2011-07-07 11:03:07,532 [cei_events     : 32] WARNING:%s %s\n" % (cyvents.CYVENT_SEPARATOR, json.dumps(event))
+
+class TestDefaultEventGather:
+
+    def setup(self):
+        self.runlogdir = tempfile.mkdtemp()
+        self.run_name = "test-run"
+
+        self.config = ConfigParser.RawConfigParser()
+        self.config.add_section("events")
+        self.config.set("events", "runlogdir", self.runlogdir)
+        self.p = DefaultParameters(self.config, None)
+        self.c = FakeCommon(self.p)
+        self.event_gather = DefaultEventGather(self.p, self.c)
+        self.persistence = FakePersistence()
+
+        self.vms = []
+        for i in range(6):
+            vm = RunVM()
+            vm.instanceid = "i-%d" % i
+            vm.runlogdir = os.path.join(self.runlogdir, self.run_name, vm.instanceid)
+            os.makedirs(os.path.join(vm.runlogdir, "logs"))
+            with open(os.path.join(vm.runlogdir, "logs", "ioncontainer.log"), "w") as log:
+                log.write(_event_line("new_node", "%d-a" % i))
+                log.write(_event_line("job_begin", "%d-job" % i))
+                log.write(_event_line("node_started", "%d-b" % i))
+            with open(os.path.join(vm.runlogdir, "other.log"), "w") as log:
+                log.write(_event_line("new_node", "%d-a" % i))
+                log.write(_event_line("terminated_node", "%d-c" % i))
+            self.vms.append(vm)
+
+    def teardown(self):
+        shutil.rmtree(self.runlogdir)
+
+    def _populate(self, vms):
+        self.persistence.vm_store[self.run_name] = list(vms)
+        self.event_gather._populate_run_vms(self.persistence, self.run_name)
+
+    def test_validate_parallelism(self):
+
+        self.event_gather.validate()
+        assert self.event_gather.parallelism == 1
+
+        self.config.set("events", "parallelism", "4")
+        self.event_gather.validate()
+        assert self.event_gather.parallelism == 4
+
+        for bad in ("0", "many"):
+            self.config.set("events", "parallelism", bad)
+            try:
+                self.event_gather.validate()
+            except InvalidConfig:
+                pass
+            else:
+                assert False, "parallelism '%s' should be rejected" % bad
+
+    def test_fill_one(self):
+
+        vm = self.vms[0]
+        self.event_gather._fill_one(vm)
+        # job events are skipped, the duplicate new_node is only added once
+        assert [e.key for e in vm.events] == ["0-a", "0-b", "0-c"]
+
+    def test_parallel_same_as_serial(self):
+
+        serial_vms = []
+        for vm in self.vms:
+            serial_vm = RunVM()
+            serial_vm.instanceid = vm.instanceid
+            serial_vm.runlogdir = vm.runlogdir
+            serial_vms.append(serial_vm)
+        self._populate(serial_vms)
+        self.persistence = FakePersistence()
+
+        self.config.set("events", "parallelism", "3")
+        self.event_gather.validate()
+        self._populate(self.vms)
+
+        for vm, serial_vm in zip(self.vms, serial_vms):
+            assert [e.key for e in vm.events] == [e.key for e in serial_vm.events]
+            assert len(vm.events) == 3
+
+    def test_parallel_vm_without_runlogdir(self):
+
+        self.vms[2].runlogdir = None
+        self.config.set("events", "parallelism", "2")
+        self.event_gather.validate()
+        self._populate(self.vms)
+
+        assert self.vms[2].events == []
+        assert len(self.vms[3].events) == 3
+        warnings = [message for (level, message) in self.c.log.transcript
+                    if level == "WARNING"]
+        assert len(warnings) == 1
+
+    def _count_parsed_files(self):
+        parsed = []
+        real_events_from_open_file = event_scanner.events_from_open_file
+        def counting_events_from_open_file(f, size, start=0):
+            parsed.append((f.name, start))
+            return real_events_from_open_file(f, size, start)
+        event_scanner.events_from_open_file = counting_events_from_open_file
+        self.restore = lambda: setattr(event_scanner, "events_from_open_file", real_events_from_open_file)
+        return parsed
+
+    def test_manifest_skips_unchanged_files(self):
+
+        self._populate(self.vms)
+        manifest = self.persistence.get_event_manifest(self.run_name)
+        assert len(manifest) == 2 * len(self.vms)
+
+        parsed = self._count_parsed_files()
+        try:
+            self._populate(self.vms)
+        finally:
+            self.restore()
+        assert parsed == []
+        assert len(self.vms[0].events) == 3
+
+    def test_manifest_belongs_to_the_database(self):
+
+        self._populate(self.vms)
+
+        # a new database has none of the events and none of the manifest,
+        # everything is parsed again
+        self.persistence = FakePersistence()
+        vms = []
+        for vm in self.vms:
+            new_vm = RunVM()
+            new_vm.instanceid = vm.instanceid
+            new_vm.runlogdir = vm.runlogdir
+            vms.append(new_vm)
+        parsed = self._count_parsed_files()
+        try:
+            self._populate(vms)
+        finally:
+            self.restore()
+        assert len(parsed) == 2 * len(vms)
+        assert [e.key for e in vms[0].events] == ["0-a", "0-b", "0-c"]
+
+    def test_manifest_grown_file_parsed_from_offset(self):
+
+        self._populate(self.vms)
+        other_log = os.path.join(self.vms[1].runlogdir, "other.log")
+        parsed_size = os.path.getsize(other_log)
+        with open(other_log, "a") as log:
+            log.write(_event_line("node_started", "1-d"))
+
+        parsed = self._count_parsed_files()
+        try:
+            self._populate(self.vms)
+        finally:
+            self.restore()
+        assert parsed == [(other_log, parsed_size)]
+        assert [e.key for e in self.vms[1].events] == ["1-a", "1-b", "1-c", "1-d"]
+
+    def test_manifest_rewritten_file_parsed_again(self):
+
+        self._populate(self.vms)
+        other_log = os.path.join(self.vms[1].runlogdir, "other.log")
+        with open(other_log, "w") as log:
+            log.write(_event_line("node_started", "1-e"))
+            log.write(_event_line("terminated_node", "1-f"))
+            log.write(_event_line("terminated_node", "1-g"))
+
+        parsed = self._count_parsed_files()
+        try:
+            self._populate(self.vms)
+        finally:
+            self.restore()
+        assert parsed == [(other_log, 0)]
+        assert [e.key for e in self.vms[1].events][-3:] == ["1-e", "1-f", "1-g"]
+
+    def test_merge_events_key_lookups(self):
+
+        compared = []
+        class Key:
+            def __init__(self, name):
+                self.name = name
+            def __hash__(self):
+                return hash(self.name)
+            def __eq__(self, other):
+                compared.append(self.name)
+                return self.name == other.name
+
+        n = 1000
+        vm = RunVM()
+        vm.events = [cyvents.CYvent("provisioner", "old", Key("old-%d" % i), None, {})
+                     for i in range(n)]
+        events = list(vm.events)
+        events += [cyvents.CYvent("provisioner", "new", Key("new-%d" % i), None, {})
+                   for i in range(n)]
+        events.append(cyvents.CYvent("provisioner", "new", Key("new-0"), None, {}))
+        events.append(cyvents.CYvent("provisioner", "job_end", Key("job-0"), None, {}))
+        self.event_gather._merge_events(vm, events)
+
+        assert len(vm.events) == 2 * n
+        assert [e.key.name for e in vm.events[n:n + 2]] == ["new-0", "new-1"]
+        # looked up by hash: about one comparison per known key, not one
+        # against every event the VM has
+        assert len(compared) <= n + 1
+
+    @attr("slow")
+    def test_merge_events_scaling(self):
+        """Times re-gathering a VM that already has n events, with n new
+           ones on top, for 25k and 100k.  With the key set the time grows
+           about linearly (4x), a scan of the VM's events per new one grew
+           quadratically (16x).  Skipped unless EPUMGMT_BENCH_MERGE_EVENTS
+           is set.
+        """
+        if not BENCH_MERGE_EVENTS:
+            raise SkipTest("EPUMGMT_BENCH_MERGE_EVENTS is not set")
+
+        def merge_time(n):
+            vm = RunVM()
+            vm.events = [cyvents.CYvent("provisioner", "old", "old-%d" % i, None, {})
+                         for i in range(n)]
+            events = vm.events + [cyvents.CYvent("provisioner", "new", "new-%d" % i, None, {})
+                                  for i in range(n)]
+            self.c.log.transcript = []
+            started = time.time()
+            self.event_gather._merge_events(vm, events)
+            elapsed = time.time() - started
+            assert len(vm.events) == 2 * n
+            return elapsed
+
+        small = merge_time(25000)
+        large = merge_time(100000)
+        assert large / small < 8, "25k %.3fs, 100k %.3fs" % (small, large)
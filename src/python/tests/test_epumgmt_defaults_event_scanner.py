@@ -0,0 +1,141 @@
+import os
+import json
+import datetime
+import shutil
+import tempfile
+import time
+
+from nose.plugins.attrib import attr
+from nose.plugins.skip import SkipTest
+
+import cloudyvents.cyvents as cyvents
+import epumgmt.defaults.event_scanner as event_scanner
+import epumgmt.defaults.log_events as log_events
+from mocks.common import FakeLog
+
+# size of the synthetic log for the benchmark, it only runs when set
+BENCH_LOG_MB = os.environ.get("EPUMGMT_BENCH_LOG_MB")
+
+NOISE_LINE = "2011-07-07 11:03:07,532 [ioncontainer : 118] DEBUG:Received message on queue xchg1310061055-jobs, headers and content omitted\n"
+
+def _event_line(name, jobid):
+    event = {"eventname": name, "eventsource": "worker",
+             "uniquekey": "key-%s-%s" % (name, jobid),
+             "timestamp": {"hour": 18, "month": 7, "second": 7, "microsecond": 532627,
+                           "year": 2011, "day": 7, "minute": 4},
+             "extra": {"jobid": jobid}}
+    return "2011-07-07 11:03:07,532 [cei_events     : 32] WARNING:%s %s\n" % (cyvents.CYVENT_SEPARATOR, json.dumps(event))
+
+class TestEventScanner:
+
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.log = os.path.join(self.tmpdir, "ioncontainer.log")
+
+    def teardown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_event_lines(self):
+
+        buf = "a\njob_end 1\nb\njob_begin job_end 2\nc job_end 3"
+        lines = event_scanner.event_lines(buf, ("job_begin", "job_end"))
+        assert lines == ["job_end 1\n", "job_begin job_end 2\n", "c job_end 3"]
+
+        lines = event_scanner.event_lines(buf, ("job_end",), 2, 12)
+        assert lines == ["job_end 1\n"]
+
+        assert event_scanner.event_lines(buf, ("new_node",)) == []
+
+    def test_events_from_file(self):
+
+        with open(self.log, "w") as log:
+            log.write(NOISE_LINE)
+            log.write(_event_line("job_begin", 1))
+            log.write(NOISE_LINE)
+            log.write(_event_line("job_end", 1).rstrip("\n"))
+
+        got = event_scanner.events_from_file(self.log)
+        expected = cyvents.events_from_file(self.log)
+        assert [e.key for e in got] == [e.key for e in expected]
+        assert [e.name for e in got] == ["job_begin", "job_end"]
+
+    def test_event_from_line(self):
+
+        ev = event_scanner.event_from_line(_event_line("job_end", 7))
+        assert ev.name == "job_end"
+        assert ev.source == "worker"
+        assert ev.key == "key-job_end-7"
+        assert ev.extra == {"jobid": 7}
+        assert ev.timestamp == datetime.datetime(2011, 7, 7, 18, 4, 7, 532627)
+
+        assert event_scanner.event_from_line(NOISE_LINE) is None
+        twice = "%s %s" % (cyvents.CYVENT_SEPARATOR, _event_line("job_end", 7))
+        assert event_scanner.event_from_line(twice) is None
+
+    def test_events_from_empty_file(self):
+
+        open(self.log, "w").close()
+        assert event_scanner.events_from_file(self.log) == []
+
+    @attr("slow")
+    def test_benchmark_line_loop(self):
+        """Times the mmap scanner against the per-line loops it replaced on
+           a synthetic log of EPUMGMT_BENCH_LOG_MB, one line in 50 is an
+           event, and checks it finds the same events in less time.
+           Skipped unless that is set.
+        """
+        if not BENCH_LOG_MB:
+            raise SkipTest("EPUMGMT_BENCH_LOG_MB is not set")
+
+        chunk = []
+        for i in range(1000):
+            if i % 50 == 0:
+                chunk.append(_event_line("job_end", i))
+            else:
+                chunk.append(NOISE_LINE)
+        chunk = "".join(chunk)
+        with open(self.log, "w") as log:
+            for i in range(int(BENCH_LOG_MB) * 1024 * 1024 / len(chunk) + 1):
+                log.write(chunk)
+
+        # the event index: every line went through scan_event_lines
+        events = log_events.CONSUMER_EVENTS
+        log = FakeLog()
+        def line_loop():
+            f = open(self.log, "rb")
+            try:
+                return log_events.scan_event_lines(f, events, log)
+            finally:
+                f.close()
+        def scanner():
+            f = open(self.log, "rb")
+            buf = event_scanner.map_file(f)
+            try:
+                lines = event_scanner.event_lines(buf, events)
+            finally:
+                buf.close()
+                f.close()
+            return log_events.scan_event_lines(lines, events, log)
+        self._assert_faster(line_loop, scanner)
+
+        # event gather: cloudyvents parses every line
+        def keys(events):
+            return [e.key for e in events]
+        self._assert_faster(lambda: keys(cyvents.events_from_file(self.log)),
+                            lambda: keys(event_scanner.events_from_file(self.log)))
+
+    def _assert_faster(self, old, new, runs=3):
+        """Best of runs for each, new must give the same result sooner"""
+        timings = {}
+        for (name, fn) in (("old", old), ("new", new)):
+            best = None
+            for i in range(runs):
+                start = time.time()
+                result = fn()
+                elapsed = time.time() - start
+                if best is None or elapsed < best:
+                    best = elapsed
+            timings[name] = (best, result)
+        assert timings["new"][1] == timings["old"][1]
+        assert timings["new"][0] < timings["old"][0], \
+               "new %.3fs, old %.3fs" % (timings["new"][0], timings["old"][0])
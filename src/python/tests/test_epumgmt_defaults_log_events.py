@@ -407,3 +407,222 @@ class TestNodeEvents:
         print event_count
         assert event_count == 1
 
+
+class TestRunEventIndex:
+
+    def setup(self):
+        self.vardir = tempfile.mkdtemp()
+        self.runlogdir = "runlogs"
+        self.logfiledir = "logs"
+        self.run_name = "test-run"
+        self.event_template = '2011-07-07 11:04:07,532 [cei_events     : 32] WARNING:CLOUDYVENT_JSON: {"eventname": "%s", "timestamp": {"hour": 18, "month": 7, "second": %s, "microsecond": 532627, "year": 2011, "day": 7, "minute": 4}, "uniquekey": "2c5a9f30-a1b8-4621-ac68-d66ca1cd99f5", "eventsource": "worker", "extra": %s}\n'
+
+        rundir = os.path.join(self.vardir, self.runlogdir, self.run_name)
+        self.producer_log = self._mklog(rundir, "producer1-container")
+        self.consumer_log = self._mklog(rundir, "epuworker_container")
+        self.provisioner_log = self._mklog(rundir, "provisioner")
+        os.makedirs(os.path.join(self.vardir, self.logfiledir))
+
+        self.config = ConfigParser.RawConfigParser()
+        self.config.add_section("events")
+        self.config.set("events", "runlogdir", self.runlogdir)
+        self.config.add_section("logging")
+        self.config.set("logging", "logfiledir", self.logfiledir)
+        self.config.add_section("ecdirs")
+        self.config.set("ecdirs", "var", self.vardir)
+
+        self.p = DefaultParameters(self.config, None)
+        self.c = FakeCommon(self.p)
+        self.index = epumgmt.defaults.log_events.RunEventIndex(self.p, self.c, self.run_name)
+        self.amqp_events = epumgmt.defaults.log_events.AmqpEvents(self.p, self.c, None, self.run_name, index=self.index)
+        self.node_events = epumgmt.defaults.log_events.NodeEvents(self.p, self.c, None, self.run_name, index=self.index)
+
+    def teardown(self):
+        shutil.rmtree(self.vardir)
+
+    def _mklog(self, rundir, dirname):
+        logdir = os.path.join(rundir, dirname)
+        os.makedirs(logdir)
+        log = os.path.join(logdir, "ioncontainer.log")
+        open(log, "w").close()
+        return log
+
+    def _event(self, name, second, extra):
+        return self.event_template % (name, second, extra)
+
+    def _scans(self):
+        return [message for (level, message) in self.c.log.transcript
+                if level == "DEBUG" and message.startswith("Scanned")]
+
+    def test_each_file_read_once(self):
+
+        with open(self.consumer_log, "w") as log:
+            log.write(self._event("job_begin", 1, '{"jobid": 1}'))
+            log.write(self._event("job_end", 2, '{"jobid": 1}'))
+        with open(self.producer_log, "w") as log:
+            log.write(self._event("job_sent", 0, '{"jobid": 1}'))
+        with open(self.provisioner_log, "w") as log:
+            log.write(self._event("node_started", 3, '{"node_id": "n1"}'))
+
+        assert self.amqp_events.get_event_datetimes_dict("job_begin").has_key(1)
+        assert self.amqp_events.get_event_datetimes_dict("job_end").has_key(1)
+        assert self.amqp_events.get_event_datetimes_dict("job_sent").has_key(1)
+        assert self.node_events.get_event_datetimes_dict("node_started").has_key("n1")
+
+        # three run logs, each scanned once for all of its events
+        assert len(self._scans()) == 3
+
+    def test_changed_file_rescanned(self):
+
+        with open(self.consumer_log, "w") as log:
+            log.write(self._event("job_end", 2, '{"jobid": 1}'))
+        assert self.amqp_events.get_event_count("job_end") == 1
+
+        with open(self.consumer_log, "a") as log:
+            log.write(self._event("job_end", 3, '{"jobid": 2}'))
+        assert self.amqp_events.get_event_count("job_end") == 2
+
+        scans = self._scans()
+        assert len(scans) == 4
+        assert len([s for s in scans if self.consumer_log in s]) == 2
+
+    def test_datetimes_list_keeps_duplicates(self):
+
+        with open(self.consumer_log, "w") as log:
+            log.write(self._event("job_end", 2, '{"jobid": 1}'))
+            log.write(self._event("job_end", 3, '{"jobid": 1}'))
+
+        times = self.amqp_events.get_event_datetimes_dict("job_end")
+        assert len(times) == 1
+        assert times[1].second == 3
+        assert len(self.amqp_events.get_event_datetimes_list("job_end")) == 2
+
+    def test_node_key_from_first_line(self):
+
+        with open(self.provisioner_log, "w") as log:
+            log.write(self._event("new_node", 1, '{"node_id": "n1", "iaas_id": "i-1"}'))
+            log.write(self._event("new_node", 2, '{"node_id": "n2"}'))
+
+        times = self.node_events.get_event_datetimes_dict("new_node")
+        assert times.has_key("i-1")
+        assert not times.has_key("n2")
+        assert len([message for (level, message) in self.c.log.transcript
+                    if level == "ERROR"]) == 1
+
+    def test_bad_json_skipped(self):
+
+        with open(self.consumer_log, "w") as log:
+            log.write("job_end JSON: {not json\n")
+            log.write(self._event("job_end", 3, '{"jobid": 2}'))
+
+        assert self.amqp_events.get_event_datetimes_dict("job_end").keys() == [2]
+
+    def test_only_appended_bytes_read(self):
+
+        with open(self.consumer_log, "w") as log:
+            log.write(self._event("job_end", 2, '{"jobid": 1}'))
+        assert self.amqp_events.get_event_count("job_end") == 1
+        checkpoint = self.index._checkpoints[self.consumer_log]
+        first_offset = checkpoint.offset
+        assert first_offset == os.path.getsize(self.consumer_log)
+
+        appended = self._event("job_end", 3, '{"jobid": 2}')
+        with open(self.consumer_log, "a") as log:
+            log.write(appended)
+        assert self.amqp_events.get_event_count("job_end") == 2
+        assert checkpoint.offset == first_offset + len(appended)
+
+    def test_partial_line_not_counted_twice(self):
+
+        line = self._event("job_end", 2, '{"jobid": 1}')
+        with open(self.consumer_log, "w") as log:
+            log.write(line[:-30])
+        assert self.amqp_events.get_event_count("job_end") == 0
+        with open(self.consumer_log, "a") as log:
+            log.write(line[-30:-1])
+        # complete JSON without the newline is still reported
+        assert self.amqp_events.get_event_datetimes_list("job_end") != []
+        with open(self.consumer_log, "a") as log:
+            log.write("\n")
+        assert len(self.amqp_events.get_event_datetimes_list("job_end")) == 1
+
+    def test_truncated_log_rescanned(self):
+
+        with open(self.consumer_log, "w") as log:
+            log.write(self._event("job_end", 2, '{"jobid": 1}'))
+            log.write(self._event("job_end", 3, '{"jobid": 2}'))
+        assert self.amqp_events.get_event_count("job_end") == 2
+
+        with open(self.consumer_log, "w") as log:
+            log.write(self._event("job_end", 4, '{"jobid": 3}'))
+        assert self.amqp_events.get_event_datetimes_dict("job_end").keys() == [3]
+
+    def test_rotated_log_rescanned(self):
+
+        with open(self.consumer_log, "w") as log:
+            log.write(self._event("job_end", 2, '{"jobid": 1}'))
+        assert self.amqp_events.get_event_count("job_end") == 1
+
+        # same size, different file: only the inode tells them apart
+        rotated = self.consumer_log + ".new"
+        with open(rotated, "w") as log:
+            log.write(self._event("job_end", 2, '{"jobid": 5}'))
+        os.rename(rotated, self.consumer_log)
+        assert self.amqp_events.get_event_datetimes_dict("job_end").keys() == [5]
+
+    def test_checkpoints_persist(self):
+
+        with open(self.consumer_log, "w") as log:
+            log.write(self._event("job_end", 2, '{"jobid": 1}'))
+        assert self.amqp_events.get_event_count("job_end") == 1
+
+        c = FakeCommon(self.p)
+        amqp_events = epumgmt.defaults.log_events.AmqpEvents(self.p, c, None, self.run_name)
+        assert amqp_events.get_event_count("job_end") == 1
+        scans = [message for (level, message) in c.log.transcript
+                 if level == "DEBUG" and message.startswith("Scanned")]
+        assert scans == []
+
+    def test_checkpoint_keeps_only_keys(self):
+
+        with open(self.consumer_log, "w") as log:
+            for second in range(10):
+                log.write(self._event("job_end", second, '{"jobid": %d}' % (second % 3)))
+        assert self.amqp_events.get_event_count("job_end") == 3
+
+        checkpoint = self.index._checkpoints[self.consumer_log]
+        assert not hasattr(checkpoint, "records")
+        assert checkpoint.get_keys("job_end") == set([0, 1, 2])
+
+        # the count never reads the log again, the datetimes do
+        self.c.log.transcript = []
+        assert self.amqp_events.get_event_count("job_end") == 3
+        assert self._scans() == []
+        assert len(self.amqp_events.get_event_datetimes_list("job_end")) == 10
+
+    def test_node_count_uses_first_key(self):
+
+        with open(self.provisioner_log, "w") as log:
+            log.write(self._event("new_node", 1, '{"node_id": "n1", "iaas_id": "i-1"}'))
+            log.write(self._event("new_node", 2, '{"node_id": "n2", "iaas_id": "i-2"}'))
+            log.write(self._event("new_node", 3, '{"node_id": "n3"}'))
+
+        assert self.node_events.get_event_count("new_node") == 2
+        assert self.node_events.get_event_count("new_node") == \
+               len(self.node_events.get_event_datetimes_dict("new_node"))
+
+    def test_missing_files_pruned(self):
+
+        with open(self.consumer_log, "w") as log:
+            log.write(self._event("job_end", 2, '{"jobid": 1}'))
+        assert self.amqp_events.get_event_count("job_end") == 1
+        assert self.index._checkpoints.has_key(self.consumer_log)
+
+        shutil.rmtree(os.path.dirname(self.consumer_log))
+        assert self.amqp_events.get_event_count("job_end") == 0
+        assert not self.index._checkpoints.has_key(self.consumer_log)
+
+        c = FakeCommon(self.p)
+        index = epumgmt.defaults.log_events.RunEventIndex(self.p, c, self.run_name)
+        index.refresh()
+        assert not index._checkpoints.has_key(self.consumer_log)
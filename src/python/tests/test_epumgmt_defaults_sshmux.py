@@ -0,0 +1,148 @@
+import os
+import sys
+import shutil
+import tempfile
+import ConfigParser
+
+import epumgmt.defaults.sshmux as sshmux
+from epumgmt.api.exceptions import InvalidConfig
+from epumgmt.defaults import DefaultParameters
+from epumgmt.defaults.child import child
+
+from mocks.common import FakeCommon
+
+# Stands in for ssh, scp and an sshd: a control socket (a plain file here) is
+# created by the first connection to a host and used by the next ones,
+# every connection is logged as a "master" or a "mux" one
+FAKE_SSH = """#!%s
+import os
+import sys
+
+args = sys.argv[1:]
+options = {}
+targets = []
+for i, arg in enumerate(args):
+    if i and args[i - 1] == "-o":
+        name, value = arg.split("=", 1)
+        options[name] = value.strip("'")
+    elif "@" in arg:
+        targets.append(arg)
+log = open(%r, "a")
+if "-O" in args:
+    os.remove(options["ControlPath"])
+    log.write("exit %%s\\n" %% os.path.basename(options["ControlPath"]))
+    sys.exit(0)
+user, host = targets[0].split(":")[0].split("@")
+path = options["ControlPath"].replace("%%r", user).replace("%%h", host).replace("%%p", "22")
+if os.path.exists(path):
+    log.write("mux %%s\\n" %% host)
+else:
+    open(path, "w").close()
+    log.write("master %%s\\n" %% host)
+"""
+
+class TestSSHMux:
+
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.log = os.path.join(self.tmpdir, "connections")
+        for program in ("ssh", "scp"):
+            path = os.path.join(self.tmpdir, program)
+            f = open(path, "w")
+            f.write(FAKE_SSH % (sys.executable, self.log))
+            f.close()
+            os.chmod(path, 0755)
+        self.path = os.environ["PATH"]
+        os.environ["PATH"] = "%s:%s" % (self.tmpdir, self.path)
+
+    def teardown(self):
+        sshmux.close_masters()
+        os.environ["PATH"] = self.path
+        shutil.rmtree(self.tmpdir)
+
+    def _params(self, multiplex="true", controlpersist=None):
+        config = ConfigParser.RawConfigParser()
+        config.add_section("ssh")
+        if multiplex is not None:
+            config.set("ssh", "multiplex", multiplex)
+        if controlpersist is not None:
+            config.set("ssh", "controlpersist", controlpersist)
+        return DefaultParameters(config, None)
+
+    def _connections(self):
+        if not os.path.exists(self.log):
+            return []
+        return open(self.log).read().splitlines()
+
+    def test_rewrite(self):
+
+        mux = sshmux.SSHMultiplexer(self._params(controlpersist="60"), FakeCommon())
+        options = "-o ControlMaster=auto -o ControlPath=%s -o ControlPersist=60" % \
+                  os.path.join(mux._get_controldir(), "%r@%h:%p")
+
+        cmd = "ssh  -n -T -o BatchMode=yes user@host.example.com"
+        assert mux.rewrite(cmd) == "ssh %s -n -T -o BatchMode=yes user@host.example.com" % options
+        cmd = "/usr/local/bin/scp -r -o BatchMode=yes user@host:/logs /here"
+        assert mux.rewrite(cmd) == "/usr/local/bin/scp %s -r -o BatchMode=yes user@host:/logs /here" % options
+        assert mux.rewrite("ls /logs") == "ls /logs"
+        assert mux.rewrite(None) is None
+
+        mux.close()
+        assert mux.controldir is None
+
+        for multiplex in (None, "false", "No"):
+            mux = sshmux.SSHMultiplexer(self._params(multiplex), FakeCommon())
+            assert mux.rewrite("ssh user@host true") == "ssh user@host true"
+            assert mux.controldir is None
+
+    def test_invalid_config(self):
+
+        for multiplex, controlpersist in (("sometimes", None), ("true", "0"),
+                                          ("true", "5m")):
+            try:
+                sshmux.SSHMultiplexer(self._params(multiplex, controlpersist), FakeCommon())
+                raised_invalid_config = False
+            except InvalidConfig:
+                raised_invalid_config = True
+            assert raised_invalid_config, (multiplex, controlpersist)
+
+    def test_one_connection_per_host(self):
+
+        p = self._params()
+        c = FakeCommon()
+        cmds = ["ssh -n -T user@a.example.com true",
+                "scp user@a.example.com:/logs/x /tmp",
+                "ssh -n -T user@b.example.com true",
+                "ssh -n -T user@a.example.com true"]
+        for cmd in cmds:
+            (killed, retcode, stdout, stderr) = child(sshmux.multiplexed(p, c, cmd))
+            assert retcode == 0, stderr
+        assert self._connections() == ["master a.example.com", "mux a.example.com",
+                                       "master b.example.com", "mux a.example.com"]
+
+        controldir = sshmux._multiplexers[p].controldir
+        sshmux.close_masters(p)
+        # stopped at the same time
+        assert sorted(self._connections()[4:]) == ["exit user@a.example.com:22",
+                                                   "exit user@b.example.com:22"]
+        assert not os.path.exists(controldir)
+        assert not sshmux._multiplexers.has_key(p)
+
+        # the next invocation in this process starts over
+        child(sshmux.multiplexed(p, c, cmds[0]))
+        assert self._connections()[-1] == "master a.example.com"
+
+    def test_one_multiplexer_per_invocation(self):
+
+        p_on, p_off = self._params(), self._params("false")
+        c = FakeCommon()
+        cmd = "ssh -n -T user@a.example.com true"
+        assert sshmux.multiplexed(p_off, c, cmd) == cmd
+        assert sshmux.multiplexed(p_on, c, cmd) != cmd
+        assert sshmux.multiplexed(p_off, c, cmd) == cmd
+
+        child(sshmux.multiplexed(p_on, c, cmd))
+        sshmux.close_masters(p_off)
+        assert self._connections() == ["master a.example.com"]
+        sshmux.close_masters(p_on)
+        assert self._connections()[-1] == "exit user@a.example.com:22"
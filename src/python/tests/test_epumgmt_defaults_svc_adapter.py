@@ -1,5 +1,7 @@
 import os
 import re
+import json
+import time
 import types
 import shutil
 import tempfile
@@ -155,6 +157,148 @@ class TestDefaultRemoteSvcAdapter:
 
 
 
+    def test_worker_state_stdout(self):
+
+        self.config.set("svcadapter", "state_query", "stdout")
+        self.svc_adapter.initialize(self.m, self.run_name, self.cloudinitd)
+
+        provisioner = RunVM()
+        provisioner.hostname = "some.fake.hostname"
+        provisioner.service_type = "provisioner"
+        provisioner.runlogdir = self.runlogdir
+
+        commands = []
+        def streaming_run_one_cmd(cmd, timeout=30, stdout_consumer=None):
+            commands.append(cmd)
+            for chunk in ('Starting query\n{"one": {"de_state": "STABLE_DE", ',
+                          '"de_conf_report": "r", "instances": {"n-1": {"iaas_state": ',
+                          '"600-RUNNING", "iaas_state_time": 5, "heartbeat_state": "OK", ',
+                          '"heartbeat_time": 6}}}}\n'):
+                stdout_consumer(chunk)
+            return True
+        self.svc_adapter._run_one_cmd = streaming_run_one_cmd
+
+        before = os.listdir(self.runlogdir)
+        state_map = self.svc_adapter.worker_state(["one"], provisioner)
+        assert state_map.keys() == ["one"]
+        assert state_map["one"].de_state == "STABLE_DE"
+        assert state_map["one"].instances[0].heartbeat_time == 6
+
+        # one command, nothing written remotely or copied back
+        assert len(commands) == 1
+        assert re.match(".*epu-state.*/dev/stdout one", commands[0])
+        assert os.listdir(self.runlogdir) == before
+
+    def test_worker_state_fanout(self):
+
+        self.config.set("svcadapter", "state_query", "stdout")
+        self.config.set("svcadapter", "state_query_fanout", "true")
+        self.config.set("svcadapter", "state_query_timeout", "1")
+        self.svc_adapter.initialize(self.m, self.run_name, self.cloudinitd)
+
+        provisioner = RunVM()
+        provisioner.hostname = "some.fake.hostname"
+
+        # "slow" hangs, "broken" fails, the others answer at once
+        real_prepare_state_query = self.svc_adapter._prepare_state_query
+        def controller_prepare_state_query(provisioner_vm, controllers):
+            query = real_prepare_state_query(provisioner_vm, controllers)
+            controller = controllers[0]
+            if controller == "slow":
+                query.cmd = "sleep 5"
+            elif controller == "broken":
+                query.cmd = "exit 1"
+            else:
+                query.cmd = "echo '{\"%s\": {\"de_state\": \"STABLE_DE\", " \
+                            "\"de_conf_report\": \"r\", \"instances\": {}}}'" % controller
+            return query
+        self.svc_adapter._prepare_state_query = controller_prepare_state_query
+
+        started = time.time()
+        state_map = self.svc_adapter.worker_state(["one", "slow", "two", "broken", "one"],
+                                                  provisioner)
+        assert time.time() - started < 4
+        assert sorted(state_map.keys()) == ["one", "two"]
+        assert state_map["two"].controller_name == "two"
+        assert self.svc_adapter.failed_controllers == \
+               {"slow": "timed out", "broken": "Could not run state query"}
+        warnings = [message for (level, message) in self.c.log.transcript
+                    if level == "WARNING"]
+        assert "No state from controller 'slow': timed out" in warnings
+
+        try:
+            self.svc_adapter.worker_state(["slow", "broken"], provisioner)
+            raised_unexpected_error = False
+        except UnexpectedError:
+            raised_unexpected_error = True
+        assert raised_unexpected_error
+
+    def test_state_query_config(self):
+
+        for key, value in (("state_query", "email"), ("state_query_fanout", "yes please"),
+                           ("state_query_timeout", "0"), ("state_query_timeout", "soon")):
+            self.config.set("svcadapter", key, value)
+            svc_adapter = DefaultRemoteSvcAdapter(self.p, self.c)
+            try:
+                svc_adapter.initialize(self.m, self.run_name, self.cloudinitd)
+                raised_invalid_config = False
+            except InvalidConfig:
+                raised_invalid_config = True
+            assert raised_invalid_config, (key, value)
+            self.config.remove_option("svcadapter", key)
+
+    def test_state_stream_parser(self):
+
+        result = '{"a": {"b": [1, 2]},\n "c": "}"}\n'
+        parser = epumgmt.defaults.svc_adapter.StateStreamParser()
+        for chunk in ["log line\nanother", " one\n", result[:9], result[9:20], result[20:]]:
+            parser.feed(chunk)
+        assert parser.get_result() == {"a": {"b": [1, 2]}, "c": "}"}
+
+        # through a real command
+        parser = epumgmt.defaults.svc_adapter.StateStreamParser()
+        svc_adapter = DefaultRemoteSvcAdapter(self.p, self.c)
+        assert svc_adapter._run_one_cmd("echo hello; echo '%s'" % result.strip(),
+                                        stdout_consumer=parser.feed)
+        assert parser.get_result()["c"] == "}"
+
+        for output in ["nothing here\n", '{"a": \n', "{broken}\n"]:
+            parser = epumgmt.defaults.svc_adapter.StateStreamParser()
+            parser.feed(output)
+            try:
+                parser.get_result()
+                raised_unexpected_error = False
+            except UnexpectedError:
+                raised_unexpected_error = True
+            assert raised_unexpected_error, output
+
+    def test_state_stream_parser_scans_once(self):
+
+        # escapes and braces in strings, cut at every possible place
+        result = '{"a": "x\\"}{\\\\", "b": {"c": "\\\\"}}'
+        for cut in range(1, len(result)):
+            parser = epumgmt.defaults.svc_adapter.StateStreamParser()
+            for chunk in ["log {line}\n", result[:cut], result[cut:], "\n{trailing}\n"]:
+                parser.feed(chunk)
+            assert parser.complete, cut
+            assert parser.get_result() == {"a": 'x"}{\\', "b": {"c": "\\"}}, cut
+
+        # a large result in many chunks is decoded once, at the end
+        decoded = []
+        parser = epumgmt.defaults.svc_adapter.StateStreamParser()
+        real_raw_decode = parser.decoder.raw_decode
+        def counting_raw_decode(s):
+            decoded.append(len(s))
+            return real_raw_decode(s)
+        parser.decoder.raw_decode = counting_raw_decode
+        result = json.dumps({"instances": [{"id": i, "state": "}"} for i in range(5000)]})
+        for i in range(0, len(result), 100):
+            parser.feed(result[i:i + 100])
+            assert not decoded
+        assert len(parser.get_result()["instances"]) == 5000
+        parser.get_result()
+        assert decoded == [len(result)]
+
     def test_reconcile_relative_conf(self):
 
         absolute_dir = "/path/to/conf"
@@ -366,8 +510,8 @@ class TestDefaultRemoteSvcAdapter:
 
 
 def make_fake_run_one_cmd(target, real_run_one_cmd):
-    def fake_run_one_cmd(target, cmd):
+    def fake_run_one_cmd(target, cmd, **kwargs):
         cmd = "echo %s" % cmd
-        return real_run_one_cmd(cmd)
+        return real_run_one_cmd(cmd, **kwargs)
 
     return fake_run_one_cmd
@@ -0,0 +1,233 @@
+import datetime
+import numpy
+
+import epumgmt.main.em_core_generategraph as em_core_generategraph
+from epumgmt.api.exceptions import InvalidInput
+from epumgmt.defaults.parameters import DefaultParameters
+from mocks.common import FakeCommon
+
+class FakeEvents:
+
+    def __init__(self):
+        self.c = FakeCommon()
+
+class TestSeriesBuilders:
+
+    def setup(self):
+        self.events = FakeEvents()
+        self.begin = datetime.datetime(2011, 7, 7, 18, 0, 0, 500000)
+        self.timeline = em_core_generategraph.EvalTimeline(6)
+
+    def _at(self, seconds):
+        return self.begin + datetime.timedelta(seconds=seconds)
+
+    def _errors(self):
+        return [message for (level, message) in self.events.c.log.transcript
+                if level == "ERROR"]
+
+    def test_get_diff_seconds_array(self):
+
+        datetimes = [self._at(0), self._at(1.4), self._at(-0.1), self._at(-1)]
+        diffs = em_core_generategraph._get_diff_seconds_array(self.begin, datetimes)
+        expected = [em_core_generategraph._get_datetime_diff_seconds(self.begin, dt)
+                    for dt in datetimes]
+        assert diffs.tolist() == expected == [0, 1, -1, -1]
+
+    def test_get_running_vms_list(self):
+
+        started = {"a": self._at(1), "b": self._at(2.5), "c": self._at(10)}
+        killed = {"a": self._at(4)}
+        running = em_core_generategraph._get_running_vms_list(self.events, \
+                                                              self.timeline, \
+                                                              self.begin, \
+                                                              started, \
+                                                              killed)
+        assert running == [0, 1, 2, 2, 1, 1]
+        assert self._errors() == ["running vm time does not appear to be valid: 10"]
+
+    def test_get_killed_vms_list(self):
+
+        killed = {"a": self._at(4), "b": self._at(4.9), "c": self._at(-2)}
+        killedvms = em_core_generategraph._get_killed_vms_list(self.events, \
+                                                               self.timeline, \
+                                                               self.begin, \
+                                                               killed)
+        assert killedvms == [0, 0, 0, 0, 2, 0]
+        assert self._errors() == ["problem adding to killedvms: -2"]
+
+    def test_get_jobs_queued_list(self):
+
+        sent = {1: self._at(0), 2: self._at(1), 3: self._at(1)}
+        begun = {1: self._at(2), 2: self._at(5)}
+        queued = em_core_generategraph._get_jobs_queued_list(self.events, \
+                                                             self.timeline, \
+                                                             self.begin, \
+                                                             sent, \
+                                                             begun)
+        assert queued == [1, 3, 2, 2, 2, 1]
+
+    def test_get_running_controller_list(self):
+
+        started = [self._at(-30), self._at(3)]
+        killed = [self._at(2)]
+        running = em_core_generategraph._get_running_controller_list(self.timeline, \
+                                                                     self.begin, \
+                                                                     started, \
+                                                                     killed)
+        assert running == [1, 1, 0, 1, 1, 1]
+
+class TestEvalTimeline:
+
+    def setup(self):
+        self.diffs = numpy.array([0, 1, 1, 4, 7, 9])
+
+    def test_default(self):
+
+        timeline = em_core_generategraph.EvalTimeline(10)
+        assert timeline.get_seconds() == range(10)
+        assert timeline.counts(self.diffs).tolist() == [1, 2, 0, 0, 1, 0, 0, 1, 0, 1]
+        assert timeline.levels(self.diffs).tolist() == [1, 3, 3, 3, 4, 4, 4, 5, 5, 6]
+
+    def test_resolution(self):
+
+        timeline = em_core_generategraph.EvalTimeline(10, 4)
+        assert timeline.get_seconds() == [0, 4, 8]
+        assert timeline.counts(self.diffs).tolist() == [3, 2, 1]
+        assert timeline.levels(self.diffs).tolist() == [3, 5, 6]
+        assert timeline.get_step_name() == "4 seconds"
+
+    def test_window(self):
+
+        timeline = em_core_generategraph.EvalTimeline(10, 2, 2, 8)
+        assert timeline.get_seconds() == [2, 4, 6]
+        assert timeline.counts(self.diffs).tolist() == [0, 1, 1]
+        # what happened before the window is where the levels start from
+        assert timeline.levels(self.diffs).tolist() == [3, 4, 5]
+
+        timeline = em_core_generategraph.EvalTimeline(10, 1, 5, 500)
+        assert timeline.get_seconds() == range(5, 10)
+
+        try:
+            em_core_generategraph.EvalTimeline(10, 1, 10)
+            raised = False
+        except InvalidInput:
+            raised = True
+        assert raised
+
+    def test_auto(self):
+
+        timeline = em_core_generategraph.EvalTimeline(600, "auto")
+        assert timeline.step == 1
+
+        week = 7 * 24 * 3600
+        timeline = em_core_generategraph.EvalTimeline(week, "auto")
+        assert timeline.step == 1800
+        assert timeline.get_step_name() == "30 minutes"
+        assert len(timeline.get_seconds()) <= em_core_generategraph.AUTO_MAX_POINTS
+
+        timeline = em_core_generategraph.EvalTimeline(10**9, "auto")
+        assert timeline.buckets <= em_core_generategraph.AUTO_MAX_POINTS
+
+    def test_xstep(self):
+
+        week = 7 * 24 * 3600
+        # without --graph-resolution or --graph-window the ticks stay as they were
+        timeline = em_core_generategraph.EvalTimeline(week)
+        assert em_core_generategraph._get_xstep(timeline, 100) == 100
+
+        timeline = em_core_generategraph.EvalTimeline(week, "auto")
+        xstep = em_core_generategraph._get_xstep(timeline, 100)
+        assert week / xstep <= em_core_generategraph.MAX_XTICKS
+        timeline = em_core_generategraph.EvalTimeline(week, 1, 0, week / 2)
+        xstep = em_core_generategraph._get_xstep(timeline, 100)
+        assert week / 2 / xstep <= em_core_generategraph.MAX_XTICKS
+
+        timeline = em_core_generategraph.EvalTimeline(2000, 10)
+        assert em_core_generategraph._get_xstep(timeline, 100) == 100
+
+class TestGraphNames:
+
+    def _params(self, graphname, processes=None, resolution=None, window=None):
+        class FakeOpts:
+            pass
+        opts = FakeOpts()
+        setattr(opts, "graphname", graphname)
+        setattr(opts, "graphtype", "png")
+        setattr(opts, "workloadtype", "amqp")
+        setattr(opts, "graph-processes", processes)
+        setattr(opts, "graph-resolution", resolution)
+        setattr(opts, "graph-window", window)
+        return DefaultParameters(None, opts)
+
+    def test_get_graphnames(self):
+
+        graphnames = em_core_generategraph._get_graphnames("all")
+        assert graphnames == list(em_core_generategraph.GRAPH_NAMES)
+
+        graphnames = em_core_generategraph._get_graphnames("job-rate")
+        assert graphnames == ["job-rate"]
+
+        graphnames = em_core_generategraph._get_graphnames("controller, job-rate,controller")
+        assert graphnames == ["controller", "job-rate"]
+
+    def test_validate(self):
+
+        em_core_generategraph.validate(self._params("stacked-vms,job-tts", "2"))
+
+        invalid = [("nosuchgraph", None),
+                   ("job-rate,", None),
+                   ("all", "0"),
+                   ("all", "many")]
+        for graphname, processes in invalid:
+            try:
+                em_core_generategraph.validate(self._params(graphname, processes))
+                raised = False
+            except InvalidInput:
+                raised = True
+            assert raised, (graphname, processes)
+
+    def test_get_graph_processes(self):
+
+        assert em_core_generategraph._get_graph_processes(self._params("all")) == 1
+        assert em_core_generategraph._get_graph_processes(self._params("all", "4")) == 4
+
+    def test_get_graph_resolution(self):
+
+        expected = [(None, 1), ("10", 10), ("10s", 10), ("1m", 60), ("2h", 7200),
+                    ("AUTO", "auto")]
+        for resolution, seconds in expected:
+            p = self._params("all", resolution=resolution)
+            assert em_core_generategraph._get_graph_resolution(p) == seconds
+
+        for resolution in ("0", "-1", "1w", "fast"):
+            try:
+                em_core_generategraph.validate(self._params("all", resolution=resolution))
+                raised = False
+            except InvalidInput:
+                raised = True
+            assert raised, resolution
+
+    def test_get_graph_window(self):
+
+        expected = [(None, (0, None)), ("100:200", (100, 200)), ("1h:", (3600, None)),
+                    (":90m", (0, 5400))]
+        for window, seconds in expected:
+            p = self._params("all", window=window)
+            assert em_core_generategraph._get_graph_window(p) == seconds
+
+        for window in ("100", "200:100", "a:b", "1:2:3"):
+            try:
+                em_core_generategraph.validate(self._params("all", window=window))
+                raised = False
+            except InvalidInput:
+                raised = True
+            assert raised, window
+
+class TestFigures:
+
+    def test_new_figure(self):
+
+        em_core_generategraph._load_matplotlib(FakeCommon())
+        fig = em_core_generategraph._new_figure()
+        assert fig.canvas.__class__.__name__ == "FigureCanvasAgg"
+        assert em_core_generategraph.props.get_size() == 10
@@ -0,0 +1,102 @@
+import os
+import shutil
+import datetime
+import tempfile
+import ConfigParser
+
+from epumgmt.defaults import DefaultParameters
+from epumgmt.main.em_core_graphcache import GraphEventCache, CachedEvents
+import epumgmt.main.em_core_graphcache as em_core_graphcache
+from mocks.common import FakeCommon
+
+class FakeEvents:
+
+    def __init__(self, p, c, event_times):
+        self.p = p
+        self.c = c
+        self.event_times = event_times
+        self.calls = []
+
+    def get_event_datetimes_dict(self, event):
+        self.calls.append(event)
+        return self.event_times[event]
+
+    def get_event_datetimes_list(self, event):
+        self.calls.append(event)
+        return self.event_times[event].values()
+
+class TestGraphEventCache:
+
+    def setup(self):
+        self.vardir = tempfile.mkdtemp()
+        self.run_name = "test-run"
+        self.rundir = os.path.join(self.vardir, "runlogs", self.run_name)
+        os.makedirs(os.path.join(self.rundir, "provisioner"))
+        self.log = os.path.join(self.rundir, "provisioner", "ioncontainer.log")
+        with open(self.log, "w") as log:
+            log.write("contents!\n")
+
+        self.config = ConfigParser.RawConfigParser()
+        self.config.add_section("events")
+        self.config.set("events", "runlogdir", "runlogs")
+        self.config.add_section("ecdirs")
+        self.config.set("ecdirs", "var", self.vardir)
+        self.p = DefaultParameters(self.config, None)
+        self.c = FakeCommon(self.p)
+
+        self.event_times = {
+            "job_end": {1: datetime.datetime(2011, 7, 7, 18, 4, 7, 532627),
+                        2: datetime.datetime(2011, 7, 7, 18, 4, 9, 1)},
+            "new_node": {u"i-1": datetime.datetime(2011, 7, 7, 18, 0, 0, 999999)},
+            "fetch_killed": {},
+        }
+
+    def teardown(self):
+        shutil.rmtree(self.vardir)
+
+    def _cached_events(self):
+        events = FakeEvents(self.p, self.c, self.event_times)
+        cache = GraphEventCache(self.p, self.c, self.run_name)
+        return events, cache, CachedEvents(events, cache, "amqp")
+
+    def test_epoch_round_trip(self):
+
+        datetimes = [datetime.datetime(2011, 7, 7, 18, 4, 7, 532627),
+                     datetime.datetime(1999, 12, 31, 23, 59, 59, 999999),
+                     datetime.datetime(2038, 1, 19, 3, 14, 8, 1)]
+        epochs = em_core_graphcache.datetimes_to_epoch(datetimes)
+        assert em_core_graphcache.epoch_to_datetimes(epochs) == datetimes
+
+    def test_cache_used_when_fresh(self):
+
+        events, cache, cached = self._cached_events()
+        for event in self.event_times.keys():
+            assert cached.get_event_datetimes_dict(event) == self.event_times[event]
+        assert sorted(cached.get_event_datetimes_list("job_end")) == sorted(self.event_times["job_end"].values())
+        cache.save()
+        assert os.path.exists(os.path.join(self.rundir, ".graph-events.npz"))
+
+        events, cache, cached = self._cached_events()
+        for event in self.event_times.keys():
+            assert cached.get_event_datetimes_dict(event) == self.event_times[event]
+        assert sorted(cached.get_event_datetimes_list("job_end")) == sorted(self.event_times["job_end"].values())
+        assert cached.get_event_count("job_end") == 2
+        assert events.calls == []
+
+        got = cached.get_event_datetimes_dict("new_node")
+        assert type(got.keys()[0]) == unicode
+        got = cached.get_event_datetimes_dict("job_end")
+        assert type(got.keys()[0]) == int
+
+    def test_cache_stale_when_logs_change(self):
+
+        events, cache, cached = self._cached_events()
+        cached.get_event_datetimes_dict("job_end")
+        cache.save()
+
+        with open(self.log, "a") as log:
+            log.write("more contents!\n")
+
+        events, cache, cached = self._cached_events()
+        cached.get_event_datetimes_dict("job_end")
+        assert events.calls == ["job_end"]
@@ -1,34 +1,54 @@
 import os
+import datetime
 import shutil
 import tempfile
 import ConfigParser
 
-from epumgmt.main.em_core_persistence import Persistence
+from nose.plugins.attrib import attr
+from nose.plugins.skip import SkipTest
+
+from sqlalchemy import select
+from cloudminer import vm_table, event_table, xtra_table
+from epumgmt.main.em_core_persistence import Persistence, vm_state_table, INDEXES
 from epumgmt.defaults import DefaultParameters, DefaultCommon
 from epumgmt.api.exceptions import InvalidConfig, ProgrammingError
 from epumgmt.api import RunVM
+from epumgmt.defaults.log_checkpoint import ManifestEntry
 
 from mocks.common import FakeCommon
 from cloudyvents.cyvents import CYvent
 
+# events of the synthetic run for the benchmark, it only runs when set
+BENCH_EVENTS = os.environ.get("EPUMGMT_BENCH_EVENTS")
+
+TUNED = {"sqlite_journal_mode": "WAL",
+         "sqlite_synchronous": "NORMAL",
+         "sqlite_mmap_size": "268435456",
+         "sqlite_cache_size": "-65536"}
+
 class TestPersistence:
 
     def setup(self):
         self.vardir = tempfile.mkdtemp()
+        self.persistence = self._persistence()
+
+    def _persistence(self, persistencefile="epumgmt.db", settings=None):
         persistencedir = "persistence"
-        persistencefile = "epumgmt.db"
-        os.mkdir(os.path.join(self.vardir, persistencedir))
+        if not os.path.isdir(os.path.join(self.vardir, persistencedir)):
+            os.mkdir(os.path.join(self.vardir, persistencedir))
         config = ConfigParser.RawConfigParser()
         config.add_section("persistence")
         config.set("persistence", "persistencedb", persistencefile)
         config.set("persistence", "persistencedir", persistencedir)
+        for key, value in (settings or {}).items():
+            config.set("persistence", key, value)
         config.add_section("ecdirs")
         config.set("ecdirs", "var", self.vardir)
 
         params = DefaultParameters(config, None)
         common = FakeCommon(params)
 
-        self.persistence = Persistence(params, common)
+        return Persistence(params, common)
 
     def teardown(self):
 
@@ -201,6 +221,81 @@ class TestPersistence:
         assert saved_iaas.events[0].name == event_name
 
 
+    def _count_calls(self, name):
+        calls = []
+        real = getattr(self.persistence.cdb, name)
+        def counting(*args):
+            calls.append(args)
+            return real(*args)
+        setattr(self.persistence.cdb, name, counting)
+        return calls
+
+    def test_store_run_vms_delta(self):
+
+        self.persistence.validate()
+
+        run_name = "testrun"
+
+        vm = RunVM()
+        vm.instanceid = "i-4h23ui4"
+        vm.nodeid = "hjk-hjk-hjk-hjk-hjk"
+        vm.events = [CYvent("src", "first", "key1", None, None)]
+        self.persistence.store_run_vms(run_name, [vm])
+
+        vm_calls = self._count_calls("add_cloudyvent_vm")
+        event_calls = self._count_calls("add_cloudyvent")
+
+        # Nothing changed, nothing is written
+        got_vms = self.persistence.get_run_vms_or_none(run_name)
+        self.persistence.store_run_vms(run_name, got_vms)
+        assert not vm_calls
+        assert not event_calls
+
+        # Only the new event
+        got_vms[0].events.append(CYvent("src", "second", "key2", None, None))
+        self.persistence.store_run_vms(run_name, got_vms)
+        assert not vm_calls
+        assert [args[-1].key for args in event_calls] == ["key2"]
+
+        # Only the VM row
+        got_vms[0].parent = "myparent"
+        self.persistence.store_run_vms(run_name, got_vms)
+        assert len(vm_calls) == 1
+        assert len(event_calls) == 1
+
+        cdb_iaas = self.persistence.cdb.get_iaas_by_runname(run_name)
+        assert cdb_iaas[0].parent == "myparent"
+        assert [e.unique_event_key for e in cdb_iaas[0].events] == ["key1", "key2"]
+
+    def test_store_run_vms_rollback(self):
+
+        self.persistence.validate()
+
+        run_name = "testrun"
+
+        vm = RunVM()
+        vm.instanceid = "i-4h23ui4"
+        vm.events = [CYvent("src", "first", "key1", None, None)]
+
+        def failing_commit():
+            raise Exception("disk full")
+        real_commit = self.persistence.cdb.commit
+        self.persistence.cdb.commit = failing_commit
+        try:
+            self.persistence.store_run_vms(run_name, [vm])
+            raised = False
+        except Exception:
+            raised = True
+        assert raised
+        assert not self.persistence.cdb.get_iaas_by_runname(run_name)
+
+        # Still seen as unstored, so the next store writes it all
+        assert not vm.is_stored()
+        self.persistence.cdb.commit = real_commit
+        self.persistence.store_run_vms(run_name, [vm])
+        cdb_iaas = self.persistence.cdb.get_iaas_by_runname(run_name)
+        assert [e.unique_event_key for e in cdb_iaas[0].events] == ["key1"]
+
     def test_find_instanceid_byservice(self):
         
         # Test when persistence not yet initialized
@@ -320,3 +415,426 @@ class TestPersistence:
         
         assert got_vms[0].instanceid == vm.instanceid
         assert got_vms[0].events[0].extra[extra_key] == extra_val
+
+    def test_get_run_vms_without_events(self):
+
+        self.persistence.validate()
+
+        run_name = "testrun"
+
+        vm = RunVM()
+        vm.instanceid = "i-4h23ui4"
+        vm.hostname = "fake.example.com"
+        vm.events = [CYvent("src", "first", "key1", None, {"a": "b"})]
+        self.persistence.store_run_vms(run_name, [vm])
+
+        got_vms = self.persistence.get_run_vms(run_name, with_events=False)
+        assert len(got_vms) == 1
+        assert got_vms[0].hostname == vm.hostname
+        assert got_vms[0].events == []
+
+        # events added to such a VM are stored along with the others
+        got_vms[0].events.append(CYvent("src", "second", "key2", None, None))
+        self.persistence.store_run_vms(run_name, got_vms)
+        got_vms = self.persistence.get_run_vms(run_name)
+        assert [e.key for e in got_vms[0].events] == ["key1", "key2"]
+
+    def _event_vm(self, instanceid, events):
+        vm = RunVM()
+        vm.instanceid = instanceid
+        vm.nodeid = "node-" + instanceid
+        vm.events = [CYvent("src", name, "%s-%d" % (instanceid, i),
+                            datetime.datetime(2011, 1, 1, 0, 0, seconds), {"state": state})
+                     for (i, (name, seconds, state)) in enumerate(events)]
+        return vm
+
+    def _summary(self, vms):
+        return [(vm.instanceid, vm.hostname, [e.key for e in vm.events]) for vm in vms]
+
+    def test_run_cache(self):
+
+        self.persistence.validate()
+        run_name = "testrun"
+        self.persistence.store_run_vms(run_name, [self._event_vm("i-a", [("a", 1, "x")])])
+
+        loads = []
+        real_load = self.persistence._load_run_vms
+        def counting_load(*args):
+            loads.append(args)
+            return real_load(*args)
+        self.persistence._load_run_vms = counting_load
+
+        vms = self.persistence.get_run_vms_or_none(run_name)
+        again = self.persistence.get_run_vms_or_none(run_name)
+        assert len(loads) == 1
+        assert self._summary(vms) == self._summary(again) == [("i-a", None, ["i-a-0"])]
+        assert vms[0] is not again[0]
+
+        # not stored, so not seen by the next caller
+        vms[0].events.append(CYvent("src", "b", "unstored", None, None))
+        vms[0].hostname = "unstored.example.com"
+        assert self._summary(self.persistence.get_run_vms(run_name)) == \
+               [("i-a", None, ["i-a-0"])]
+
+        # stored through a VM without its events, and a new VM
+        bare = self.persistence.get_run_vms(run_name, with_events=False)
+        assert len(loads) == 1
+        assert bare[0].events == []
+        bare[0].hostname = "a.example.com"
+        bare[0].events.append(CYvent("src", "c", "i-a-1", None, None))
+        self.persistence.store_run_vms(run_name, bare + [self._event_vm("i-b", [("a", 1, "x")])])
+
+        expected = [("i-a", "a.example.com", ["i-a-0", "i-a-1"]), ("i-b", None, ["i-b-0"])]
+        assert self._summary(self.persistence.get_run_vms(run_name)) == expected
+        assert self._summary(real_load(run_name, True)) == expected
+        assert len(loads) == 1
+
+        # cloudminer keeps the log directories a VM was first stored
+        # with, and so does the cache
+        bare = self.persistence.get_run_vms(run_name, with_events=False)
+        bare[0].runlogdir = "/elsewhere"
+        bare[0].parent = "controller"
+        self.persistence.store_run_vms(run_name, bare)
+        cached = self.persistence.get_run_vms(run_name)[0]
+        stored = real_load(run_name, False)[0]
+        assert (cached.runlogdir, cached.parent) == (stored.runlogdir, stored.parent) == \
+               (None, "controller")
+        assert len(loads) == 1
+
+        self.persistence.compact_events(run_name)
+        self.persistence.get_run_vms(run_name)
+        assert len(loads) == 2
+
+        self.persistence.clear_run_cache()
+        self.persistence.get_run_vms(run_name)
+        assert len(loads) == 3
+
+    def test_get_latest_events(self):
+
+        try:
+            self.persistence.get_latest_events("testrun", "iaas_state")
+            raised_programming_error = False
+        except ProgrammingError:
+            raised_programming_error = True
+        assert raised_programming_error
+
+        self.persistence.validate()
+        run_name = "testrun"
+
+        vm_a = self._event_vm("i-a", [("iaas_state", 1, "PENDING"),
+                                      ("iaas_state", 5, "RUNNING"),
+                                      ("iaas_state", 5, "TIED"),
+                                      ("de_state", 9, "STABLE")])
+        vm_b = self._event_vm("i-b", [("iaas_state", 3, "PENDING")])
+        vm_c = self._event_vm("i-c", [("de_state", 3, "STABLE")])
+        self.persistence.store_run_vms(run_name, [vm_a, vm_b, vm_c])
+        self.persistence.store_run_vms("otherrun", [self._event_vm("i-d", [("iaas_state", 1, "X")])])
+
+        latest = self.persistence.get_latest_events(run_name, "iaas_state")
+        assert sorted(latest.keys()) == ["i-a", "i-b"]
+        assert latest["i-a"].extra["state"] == "RUNNING"
+        assert latest["i-b"].extra["state"] == "PENDING"
+
+        latest = self.persistence.get_latest_events(run_name, "iaas_state", [vm_b])
+        assert latest.keys() == ["i-b"]
+
+        # events that are not stored yet count too
+        vm_b.events.append(CYvent("src", "iaas_state", "i-b-new",
+                                  datetime.datetime(2011, 1, 1, 0, 0, 4), {"state": "RUNNING"}))
+        latest = self.persistence.get_latest_events(run_name, "iaas_state", [vm_a, vm_b])
+        assert latest["i-a"].extra["state"] == "RUNNING"
+        assert latest["i-b"].extra["state"] == "RUNNING"
+
+        got_vms = self.persistence.get_run_vms(run_name, with_events=False)
+        latest = self.persistence.get_latest_events(run_name, "de_state", got_vms)
+        assert sorted(latest.keys()) == ["i-a", "i-c"]
+
+    def test_get_latest_events_by_source(self):
+
+        self.persistence.validate()
+        run_name = "testrun"
+
+        vm_a = self._event_vm("i-a", [("de_state", 1, "one"),
+                                      ("de_state", 5, "two"),
+                                      ("de_state", 3, "three"),
+                                      ("de_state", 5, "tied"),
+                                      ("iaas_state", 9, "RUNNING")])
+        vm_a.events[2].source = "other"
+        vm_b = self._event_vm("i-b", [("de_state", 2, "four")])
+        self.persistence.store_run_vms(run_name, [vm_a, vm_b])
+
+        latest = self.persistence.get_latest_events_by_source(run_name, "de_state")
+        assert sorted(latest.keys()) == [("i-a", "other"), ("i-a", "src"), ("i-b", "src")]
+        assert latest[("i-a", "src")].extra["state"] == "two"
+        assert latest[("i-a", "other")].extra["state"] == "three"
+
+        # events that are not stored yet count too
+        vm_b.events.append(CYvent("new", "de_state", "i-b-new",
+                                  datetime.datetime(2011, 1, 1, 0, 0, 1), {"state": "five"}))
+        latest = self.persistence.get_latest_events_by_source(run_name, "de_state", [vm_b])
+        assert sorted(latest.keys()) == [("i-b", "new"), ("i-b", "src")]
+        assert latest[("i-b", "new")].extra["state"] == "five"
+
+    def test_get_events_by_name(self):
+
+        self.persistence.validate()
+        run_name = "testrun"
+
+        vm_a = self._event_vm("i-a", [("deplist", 5, "a5"),
+                                      ("deplist", 1, "a1"),
+                                      ("other", 2, "x")])
+        vm_b = self._event_vm("i-b", [("deplist", 3, "b3")])
+        self.persistence.store_run_vms(run_name, [vm_a, vm_b])
+
+        found = self.persistence.get_events_by_name(run_name, "deplist")
+        assert [(iaasid, e.extra["state"]) for (iaasid, e) in found] == \
+               [("i-a", "a1"), ("i-b", "b3"), ("i-a", "a5")]
+
+        start = datetime.datetime(2011, 1, 1, 0, 0, 3)
+        end = datetime.datetime(2011, 1, 1, 0, 0, 5)
+        found = self.persistence.get_events_by_name(run_name, "deplist", start, end)
+        assert [e.extra["state"] for (iaasid, e) in found] == ["b3"]
+
+        vm_a.events.append(CYvent("src", "deplist", "i-a-new",
+                                  datetime.datetime(2011, 1, 1, 0, 0, 4), {"state": "a4"}))
+        found = self.persistence.get_events_by_name(run_name, "deplist", vms=[vm_a])
+        assert [e.extra["state"] for (iaasid, e) in found] == ["a1", "a4", "a5"]
+
+    def test_get_vm_states(self):
+
+        self.persistence.validate()
+        run_name = "testrun"
+
+        vm_a = self._event_vm("i-a", [("iaas_state", 1, "400-PENDING"),
+                                      ("iaas_state", 3, "600-RUNNING"),
+                                      ("heartbeat_state", 4, "OK"),
+                                      ("iaas_state", 2, "500-STARTED")])
+        vm_b = self._event_vm("i-b", [("other", 3, "x")])
+        self.persistence.store_run_vms(run_name, [vm_a, vm_b])
+
+        states = self.persistence.get_vm_states(run_name)
+        assert states.keys() == ["i-a"]
+        state = states["i-a"]
+        assert state.iaas_state == "600-RUNNING"
+        assert state.iaas_state_time == datetime.datetime(2011, 1, 1, 0, 0, 3)
+        assert state.heartbeat_state == "OK"
+        assert state.running_time == datetime.datetime(2011, 1, 1, 0, 0, 3)
+        assert state.terminated_time is None
+
+        # events that are not stored yet count too, but only once stored
+        # are they in the table
+        vm_a.events.append(CYvent("src", "iaas_state", "i-a-new",
+                                  datetime.datetime(2011, 1, 1, 0, 0, 9), {"state": "800-TERMINATED"}))
+        states = self.persistence.get_vm_states(run_name, [vm_a])
+        assert states["i-a"].iaas_state == "800-TERMINATED"
+        assert states["i-a"].terminated_time == datetime.datetime(2011, 1, 1, 0, 0, 9)
+        assert self.persistence.get_vm_states(run_name)["i-a"].iaas_state == "600-RUNNING"
+
+        self.persistence.store_run_vms(run_name, [vm_a])
+        states = self.persistence.get_vm_states(run_name)
+        assert states["i-a"].iaas_state == "800-TERMINATED"
+        assert states["i-a"].running_time == datetime.datetime(2011, 1, 1, 0, 0, 3)
+
+        # a database from before the state table gets it filled in, an
+        # old event without a state is skipped instead of failing validate()
+        session = self.persistence.cdb.session
+        vm_id = session.execute(select([vm_table.c.id], vm_table.c.iaasid == "i-a")).scalar()
+        session.execute(event_table.insert(), dict(source="src", name="heartbeat_state",
+                                                   unique_event_key="i-a-old",
+                                                   timestamp=datetime.datetime(2011, 1, 1),
+                                                   vm_id=vm_id))
+        session.commit()
+        session.close()
+        vm_state_table.drop(bind=self.persistence.cdb.engine)
+        self.persistence.c.log.transcript = []
+        self.persistence.validate()
+        rebuilt = self.persistence.get_vm_states(run_name)
+        assert rebuilt.keys() == ["i-a"]
+        assert rebuilt["i-a"].get_values() == states["i-a"].get_values()
+        warnings = [message for (level, message) in self.persistence.c.log.transcript
+                    if level == "WARNING"]
+        assert len(warnings) == 1
+
+    def test_compact_events(self):
+
+        self.persistence.validate()
+        run_name = "testrun"
+
+        vm_a = self._event_vm("i-a", [("heartbeat_state", 1, "OK"),
+                                      ("heartbeat_state", 2, "OK"),
+                                      ("iaas_state", 2, "600-RUNNING"),
+                                      ("heartbeat_state", 3, "MISSING"),
+                                      ("heartbeat_state", 4, "OK"),
+                                      ("heartbeat_state", 5, "OK"),
+                                      ("iaas_state", 6, "600-RUNNING"),
+                                      ("deplist", 7, "x"),
+                                      ("deplist", 8, "x")])
+        vm_b = self._event_vm("i-b", [("heartbeat_state", 1, "OK")])
+        self.persistence.store_run_vms(run_name, [vm_a, vm_b])
+
+        removed = self.persistence.compact_events(run_name)
+        assert removed == 3
+
+        got_vms = self.persistence.get_run_vms(run_name)
+        remaining = [(e.name, e.timestamp.second) for e in got_vms[0].events]
+        assert sorted(remaining) == [("deplist", 7), ("deplist", 8),
+                                     ("heartbeat_state", 1), ("heartbeat_state", 3),
+                                     ("heartbeat_state", 4), ("iaas_state", 2)]
+        assert len(got_vms[1].events) == 1
+
+        state = self.persistence.get_vm_states(run_name)["i-a"]
+        assert state.iaas_state_time == datetime.datetime(2011, 1, 1, 0, 0, 2)
+        assert state.heartbeat_state == "OK"
+
+        assert self.persistence.compact_events(run_name) == 0
+
+    def test_get_event_sources(self):
+
+        self.persistence.validate()
+        run_name = "testrun"
+
+        vm_a = self._event_vm("i-a", [("a", 1, "x"), ("b", 2, "y")])
+        vm_a.events[1].source = "controller"
+        vm_b = self._event_vm("i-b", [("a", 1, "x")])
+        self.persistence.store_run_vms(run_name, [vm_a, vm_b])
+
+        sources = self.persistence.get_event_sources(run_name)
+        assert sources == {"i-a": set(["src", "controller"]), "i-b": set(["src"])}
+
+        vm_b.events.append(CYvent("other", "c", "i-b-new", None, None))
+        sources = self.persistence.get_event_sources(run_name, [vm_b])
+        assert sources == {"i-b": set(["src", "other"])}
+
+    def _pragma(self, persistence, pragma):
+        return persistence.cdb.session.execute("PRAGMA %s" % pragma).scalar()
+
+    def test_event_manifest(self):
+
+        self.persistence.validate()
+        assert self.persistence.get_event_manifest("testrun") == {}
+
+        entries = [ManifestEntry("/logs/a.log", 12, 100, 1310061055.25, 90, "f" * 32),
+                   ManifestEntry("/logs/b.log", 13, 0, 1310061056.5, 0, "0" * 32)]
+        self.persistence.store_event_manifest("testrun", dict([(e.path, e) for e in entries]))
+        self.persistence.store_event_manifest("otherrun", {"/logs/a.log": entries[0]})
+
+        manifest = self.persistence.get_event_manifest("testrun")
+        assert sorted(manifest.keys()) == ["/logs/a.log", "/logs/b.log"]
+        entry = manifest["/logs/a.log"]
+        assert (entry.inode, entry.size, entry.mtime, entry.offset, entry.fingerprint) == \
+               (12, 100, 1310061055.25, 90, "f" * 32)
+
+        # replaced as a whole, other runs are left alone
+        self.persistence.store_event_manifest("testrun", {"/logs/b.log": entries[1]})
+        assert self.persistence.get_event_manifest("testrun").keys() == ["/logs/b.log"]
+        assert self.persistence.get_event_manifest("otherrun").keys() == ["/logs/a.log"]
+
+        # it lives in the database: a new one has none
+        persistence = self._persistence("new.db")
+        persistence.validate()
+        assert persistence.get_event_manifest("testrun") == {}
+
+    def test_sqlite_pragmas(self):
+
+        self.persistence.validate()
+        assert self._pragma(self.persistence, "journal_mode") == "delete"
+
+        persistence = self._persistence("tuned.db", TUNED)
+        persistence.validate()
+        assert self._pragma(persistence, "journal_mode") == "wal"
+        assert self._pragma(persistence, "synchronous") == 1
+        assert self._pragma(persistence, "cache_size") == -65536
+
+        # the next transactions run on the same connection, so the cache
+        # it filled is kept for the whole invocation
+        first = persistence.cdb.engine.raw_connection().connection
+        persistence.store_run_vms("testrun", [self._event_vm("i-a", [("a", 1, "x")])])
+        assert self._pragma(persistence, "journal_mode") == "wal"
+        assert self._pragma(persistence, "cache_size") == -65536
+        assert persistence.cdb.engine.raw_connection().connection is first
+        assert len(persistence.get_run_vms("testrun")[0].events) == 1
+
+        invalid = [{"sqlite_synchronous": "SOMETIMES"},
+                   {"sqlite_journal_mode": "WAL; DROP TABLE vms"},
+                   {"sqlite_mmap_size": "lots"}]
+        for settings in invalid:
+            persistence = self._persistence("invalid.db", settings)
+            try:
+                persistence.validate()
+                raised_invalid_config = False
+            except InvalidConfig:
+                raised_invalid_config = True
+            assert raised_invalid_config, settings
+
+    def test_indexes(self):
+
+        self.persistence.validate()
+        rows = self.persistence.cdb.session.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index'")
+        names = set([row[0] for row in rows])
+        for index in INDEXES:
+            assert index.name in names
+
+        # creating them again (the next invocation) is harmless
+        self.persistence._create_indexes()
+
+    def _fill_run(self, persistence, run_name, nevents):
+        """nevents events spread over one VM per thousand, written with
+        plain inserts so that filling takes a fraction of reading back
+        """
+        nvms = max(1, nevents / 1000)
+        conn = persistence.cdb.engine.connect()
+        trans = conn.begin()
+        conn.execute(vm_table.insert(), [dict(id=i + 1, runname=run_name,
+                                              iaasid="i-%d" % i, nodeid="n-%d" % i,
+                                              service_type="worker")
+                                         for i in range(nvms)])
+        base = datetime.datetime(2011, 1, 1)
+        events = []
+        extras = []
+        for eid in range(1, nevents + 1):
+            name = eid % 2 and "heartbeat_state" or "job_begin"
+            events.append(dict(id=eid, source="src", name=name,
+                               unique_event_key="k%d" % eid,
+                               timestamp=base + datetime.timedelta(seconds=eid),
+                               vm_id=(eid - 1) % nvms + 1))
+            extras.append(dict(id=eid, key="state", value="OK", event_id=eid))
+            if len(events) == 50000:
+                conn.execute(event_table.insert(), events)
+                conn.execute(xtra_table.insert(), extras)
+                events = []
+                extras = []
+        if events:
+            conn.execute(event_table.insert(), events)
+            conn.execute(xtra_table.insert(), extras)
+        trans.commit()
+        conn.close()
+
+    @attr("slow")
+    def test_benchmark_sqlite_settings(self):
+        """Reads back and then adds to a synthetic run of EPUMGMT_BENCH_EVENTS
+           events with the default SQLite settings and with the ones
+           suggested in internal.conf, and checks the results.  Skipped
+           unless that is set.
+        """
+        if not BENCH_EVENTS:
+            raise SkipTest("EPUMGMT_BENCH_EVENTS is not set")
+
+        nevents = int(BENCH_EVENTS)
+        run_name = "benchrun"
+        for label, settings in (("default", None), ("tuned", TUNED)):
+            persistence = self._persistence("%s.db" % label, settings)
+            persistence.validate()
+            self._fill_run(persistence, run_name, nevents)
+
+            vms = persistence.get_run_vms_or_none(run_name)
+            assert sum([len(vm.events) for vm in vms]) == nevents
+            assert vms[0].events[0].extra == {"state": "OK"}
+
+            # what status does: a new event for every VM, stored VM by VM
+            for vm in vms:
+                vm.events.append(CYvent("src", "job_end", "new-%s" % vm.instanceid,
+                                        datetime.datetime(2011, 2, 1), {"a": "b"}))
+            for vm in vms:
+                persistence.store_run_vms(run_name, [vm])
+            assert len(persistence.get_run_vms(run_name, with_events=False)) == len(vms)
@@ -2,6 +2,16 @@ import epumgmt.main.em_core_status
 import epumgmt.defaults.epustates as epustates
 import mocks.event
 
+def _run_update(update, common, modules, run_name, names, state_map, allvms):
+    """Call one of the _update functions like _find_latest_worker_status()
+    does, then store the VMs it changed.  Returns the changed list.
+    """
+    index = epumgmt.main.em_core_status.VMIndex(allvms)
+    changed = []
+    update(common, modules, run_name, names, state_map, allvms, index, changed)
+    epumgmt.main.em_core_status._store_changed(modules, run_name, changed)
+    return changed
+
 class TestStatus:
     import epumgmt.api
 
@@ -89,22 +99,27 @@ class TestStatus:
         self.allvms = [self.testvm0, self.testvm1, self.testvm2,
                        self.controller]
 
-    def test_get_vm_with_nodeid(self):
-        get_vm_with_nodeid = epumgmt.main.em_core_status._get_vm_with_nodeid
-        got_vm = get_vm_with_nodeid(self.testvm0_nodeid, self.allvms)
+    def test_vm_index(self):
+        index = epumgmt.main.em_core_status.VMIndex(self.allvms)
+
+        got_vm = index.get_by_nodeid(self.testvm0_nodeid)
         assert got_vm == self.testvm0
 
-        got_vm = get_vm_with_nodeid("fake", self.allvms)
+        got_vm = index.get_by_nodeid("fake")
         assert got_vm == None
 
-    def test_get_vm_with_instanceid(self):
-        get_vm_with_instanceid = epumgmt.main.em_core_status._get_vm_with_instanceid
-        got_vm = get_vm_with_instanceid(self.testvm1_instanceid, self.allvms)
+        got_vm = index.get_by_instanceid(self.testvm1_instanceid)
         assert got_vm == self.testvm1
 
-        got_vm = get_vm_with_instanceid("fake", self.allvms)
+        got_vm = index.get_by_instanceid("fake")
         assert got_vm == None
 
+        # the first one wins, like a scan of the list would
+        duplicate = epumgmt.api.RunVM()
+        duplicate.nodeid = self.testvm0_nodeid
+        index = epumgmt.main.em_core_status.VMIndex(self.allvms + [duplicate])
+        assert index.get_by_nodeid(self.testvm0_nodeid) == self.testvm0
+
     def test_filter_out_workers(self):
         filter_out_workers = epumgmt.main.em_core_status._filter_out_workers
         nonworkers = filter_out_workers(self.allvms)
@@ -123,45 +138,73 @@ class TestStatus:
 
 
     def test_find_state_from_events(self):
+        from mocks.modules import FakeModules
         find_state_from_events = epumgmt.main.em_core_status._find_state_from_events
+        m = FakeModules()
+        run_name = "testrun"
 
-        novm = find_state_from_events(None)
+        novm = find_state_from_events(m, run_name, None)
         assert novm == None
 
-        novm = find_state_from_events(self.vm_no_events)
+        novm = find_state_from_events(m, run_name, self.vm_no_events)
         assert novm == None
 
-        novm = find_state_from_events(self.vm_no_state_events)
+        novm = find_state_from_events(m, run_name, self.vm_no_state_events)
         assert novm == None
 
-        state = find_state_from_events(self.vm_one_state_event)
+        state = find_state_from_events(m, run_name, self.vm_one_state_event)
         assert state == self.vm_one_state_event_state
 
-        state = find_state_from_events(self.vm_two_state_events)
+        state = find_state_from_events(m, run_name, self.vm_two_state_events)
         assert state == self.vm_two_state_events_state1
 
+    def test_find_states(self):
+        from mocks.modules import FakeModules
+        find_states = epumgmt.main.em_core_status._find_states
+        m = FakeModules()
+        run_name = "testrun"
+        self.vm_one_state_event.instanceid = "i-one"
+        self.vm_two_state_events.instanceid = "i-two"
+        m.persistence.store_run_vms(run_name, [self.vm_no_state_events,
+                                               self.vm_one_state_event,
+                                               self.vm_two_state_events])
+
+        states = find_states(m, run_name, None)
+        assert states == {"i-one": self.vm_one_state_event_state,
+                          "i-two": self.vm_two_state_events_state1}
 
-    def test_get_vm_with_controller(self):
-        get_vm_with_controller = epumgmt.main.em_core_status._get_vm_with_controller
+        states = find_states(m, run_name, [self.vm_two_state_events, self.testvm2])
+        assert states == {"i-two": self.vm_two_state_events_state1,
+                          self.testvm2_instanceid: epustates.TERMINATED}
 
-        novm = get_vm_with_controller(None, [])
+
+    def test_vm_index_by_source(self):
+        from mocks.modules import FakeModules
+        m = FakeModules()
+        run_name = "testrun"
+
+        index = epumgmt.main.em_core_status.VMIndex([])
+        novm = index.get_by_source(m, run_name, None)
         assert novm == None
 
-        vm = get_vm_with_controller(self.controller_source, self.allvms)
+        index = epumgmt.main.em_core_status.VMIndex(self.allvms)
+        vm = index.get_by_source(m, run_name, self.controller_source)
         assert vm == self.controller
 
-
     def test_latest_controller_state(self):
         from epumgmt.main.em_core_status import _latest_controller_state
+        from mocks.modules import FakeModules
+        m = FakeModules()
+        run_name = "testrun"
 
-        nostate = _latest_controller_state(None)
+        nostate = _latest_controller_state(m, run_name, None)
         print nostate
         assert nostate == None
 
-        nostate = _latest_controller_state(self.vm_no_events)
+        nostate = _latest_controller_state(m, run_name, self.vm_no_events)
         assert nostate == None
 
-        state = _latest_controller_state(self.controller)
+        state = _latest_controller_state(m, run_name, self.controller)
         assert state == self.second_de_state
 
         extra_state = "okay"
@@ -170,7 +213,7 @@ class TestStatus:
                                   de_state=extra_state)
         self.controller.events.append(extra_event)
 
-        state = _latest_controller_state(self.controller)
+        state = _latest_controller_state(m, run_name, self.controller)
         assert state == extra_state
 
 
@@ -212,6 +255,19 @@ class TestStatus:
         assert test_vm.events[0].source == controller
         assert test_vm.events[0].name == "de_conf_report"
 
+        # Nothing is recorded when the controller reports what it did last
+        test_vm.events = []
+        test_state = State(de_state=de_state, de_conf_report=de_conf_report, capture_time=1)
+        last = {"de_state": de_state, "de_conf_report": de_conf_report}
+        got_event = _get_events_from_controller_state(test_state, test_vm, controller, True, common, last)
+        assert got_event == False
+        assert len(test_vm.events) == 0
+
+        last["de_state"] = "old_state"
+        got_event = _get_events_from_controller_state(test_state, test_vm, controller, True, common, last)
+        assert got_event == True
+        assert [e.name for e in test_vm.events] == ["de_state"]
+
 
     def test_get_events_from_wis(self):
         from epumgmt.main.em_core_status import _get_events_from_wis
@@ -254,6 +310,20 @@ class TestStatus:
         assert len(test_vm.events) == 1
         assert test_vm.events[0].name == "heartbeat_state"
 
+        # Only changes are recorded
+        from epumgmt.main.em_core_persistence import VMState
+        test_vm.events = []
+        last = VMState()
+        last.heartbeat_state = heartbeat_state
+        got_event = _get_events_from_wis(fake_wis, test_vm, controller, True, common, last)
+        assert got_event == False
+        assert len(test_vm.events) == 0
+
+        last.heartbeat_state = "missing"
+        got_event = _get_events_from_wis(fake_wis, test_vm, controller, True, common, last)
+        assert got_event == True
+        assert len(test_vm.events) == 1
+
 
     def test_find_latest_worker_status(self):
         from epumgmt.main.em_core_status import _find_latest_worker_status
@@ -353,6 +423,13 @@ class TestStatus:
 
         svc_adapter.fake_worker_state = {'epu_controller_sleeper1': controller_state}
 
+        stored = []
+        real_store_run_vms = modules.persistence.store_run_vms
+        def store_run_vms(run_name, vms):
+            stored.append(list(vms))
+            real_store_run_vms(run_name, vms)
+        modules.persistence.store_run_vms = store_run_vms
+
         _find_latest_worker_status(common, modules, "", None, allvms)
 
         # make sure at least one vm added to persistence
@@ -361,6 +438,21 @@ class TestStatus:
             for persisted_vm in modules.persistence.vm_store[run_name]:
                 assert persisted_vm.parent == controller_name
 
+        # all of them at once, each one once
+        assert stored == [[empty_vm_0, empty_vm_1, empty_vm_2]]
+
+        # nothing is stored when part of the pass fails
+        stored[:] = []
+        empty_vm_0.parent = "some_other_controller"
+        empty_vm_1.parent = None
+        try:
+            _find_latest_worker_status(common, modules, "", None, allvms)
+            raised_programming_error = False
+        except ProgrammingError:
+            raised_programming_error = True
+        assert raised_programming_error
+        assert stored == []
+
     def test_find_state_from_events_not_yet_started(self):
         """Test for problems when status is called before epu is booted
         """
@@ -426,7 +518,7 @@ class TestStatus:
         controller_state_map[controller_0] = controller_0_state
 
         # Test when there's WorkerInstance that doesn't appear in the list of VMs
-        _update_worker_parents(common, modules, run_name, controllers, controller_state_map, allvms)
+        _run_update(_update_worker_parents, common, modules, run_name, controllers, controller_state_map, allvms)
         warnings = [warning for warning in common.log.transcript if warning[0] == "WARNING"]
         assert len(warnings) > 0
         _, log_message = warnings[0]
@@ -435,7 +527,7 @@ class TestStatus:
 
         # Test the normal case
         allvms.append(worker_0_vm)
-        _update_worker_parents(common, modules, run_name, controllers, controller_state_map, allvms)
+        _run_update(_update_worker_parents, common, modules, run_name, controllers, controller_state_map, allvms)
 
         assert worker_0_vm.parent == controller_0
         assert modules.persistence.vm_store[run_name][0] == worker_0_vm
@@ -444,7 +536,7 @@ class TestStatus:
         # Test when the VM's parent isn't the controller that owns it
         worker_0_vm.parent = "some_other_controller"
         try:
-            _update_worker_parents(common, modules, run_name, controllers, controller_state_map, allvms)
+            _run_update(_update_worker_parents, common, modules, run_name, controllers, controller_state_map, allvms)
         except ProgrammingError:
             programming_error_raised = True
 
@@ -453,7 +545,7 @@ class TestStatus:
         # Test for controllers being present in the controller_map, but not the
         # controller state map
         common.log.transcript = []
-        _update_worker_parents(common, modules, run_name, controllers, {}, allvms)
+        _run_update(_update_worker_parents, common, modules, run_name, controllers, {}, allvms)
         warnings = [warning for warning in common.log.transcript if warning[0] == "WARNING"]
         _, warning = warnings[-1]
         assert warning.find("in list of controllers, but no state available.") != -1
@@ -494,7 +586,7 @@ class TestStatus:
 
 
         # Test when there's WorkerInstance that doesn't appear in the list of VMs
-        _update_worker_states(common, modules, run_name, controllers, controller_state_map, allvms)
+        _run_update(_update_worker_states, common, modules, run_name, controllers, controller_state_map, allvms)
         warnings = [warning for warning in common.log.transcript if warning[0] == "WARNING"]
         assert len(warnings) > 0
         _, log_message = warnings[0]
@@ -504,15 +596,20 @@ class TestStatus:
         allvms.append(worker_0_vm)
 
         # Test standard case where the worker has one new event. 
-        _update_worker_states(common, modules, run_name, controllers, controller_state_map, allvms)
+        _run_update(_update_worker_states, common, modules, run_name, controllers, controller_state_map, allvms)
 
         assert modules.persistence.vm_store[run_name][0] == worker_0_vm
         assert len(worker_0_vm.events) == 1
 
+        # The same state again is not a new event
+        changed = _run_update(_update_worker_states, common, modules, run_name, controllers, controller_state_map, allvms)
+        assert changed == []
+        assert len(worker_0_vm.events) == 1
+
         # Test for controllers being present in the controller_map, but not the
         # controller state map
         common.log.transcript = []
-        _update_worker_states(common, modules, run_name, controllers, {}, allvms)
+        _run_update(_update_worker_states, common, modules, run_name, controllers, {}, allvms)
         warnings = [warning for warning in common.log.transcript if warning[0] == "WARNING"]
         _, warning = warnings[-1]
         assert warning.find("in list of controllers, but no state available.") != -1
@@ -552,7 +649,7 @@ class TestStatus:
 
         # Test for vms being present in controller_map, but not allvms
         try:
-            _update_controller_states(common, modules, run_name, controller_map, controller_state_map, allvms)
+            _run_update(_update_controller_states, common, modules, run_name, controller_map, controller_state_map, allvms)
         except ProgrammingError:
             raised_programming_error = True
 
@@ -568,7 +665,7 @@ class TestStatus:
 
         controller_state_map[controller_0] = controller_0_state
 
-        _update_controller_states(common, modules, run_name, controller_map, controller_state_map, allvms)
+        _run_update(_update_controller_states, common, modules, run_name, controller_map, controller_state_map, allvms)
 
         assert modules.persistence.vm_store[run_name][0] == controller_0_vm
         assert len(controller_0_vm.events) == 1
@@ -576,16 +673,60 @@ class TestStatus:
         # Test for controllers being present in the controller_map, but not the
         # controller state map
         common.log.transcript = []
-        _update_controller_states(common, modules, run_name, controller_map, {}, allvms)
+        _run_update(_update_controller_states, common, modules, run_name, controller_map, {}, allvms)
         warnings = [warning for warning in common.log.transcript if warning[0] == "WARNING"]
         _, warning = warnings[-1]
         assert warning.find("in list of controllers, but no state available.") != -1
 
+    def test_update_controller_states_queries_once(self):
+        from epumgmt.main.em_core_status import _update_controller_states
+        from mocks.common import FakeCommon
+        from mocks.modules import FakeModules
+        from mocks.state import EPUControllerState
+
+        common = FakeCommon()
+        modules = FakeModules()
+        run_name = "test-run"
+
+        queried = []
+        real_get_latest = modules.persistence.get_latest_events_by_source
+        def counting_get_latest(run_name, event_name, vms=None):
+            queried.append(event_name)
+            return real_get_latest(run_name, event_name, vms)
+        modules.persistence.get_latest_events_by_source = counting_get_latest
+
+        controller_map = {}
+        controller_state_map = {}
+        allvms = []
+        for i in range(3):
+            vm = epumgmt.api.RunVM()
+            vm.instanceid = "i-controller%d" % i
+            allvms.append(vm)
+            controller_map[vm.instanceid] = []
+            for name in ("sleeper", "waker"):
+                controller = "epu_controller_%s%d" % (name, i)
+                controller_map[vm.instanceid].append(controller)
+                state = EPUControllerState()
+                state.de_state = "%s state" % name
+                state.capture_time = 42424242
+                controller_state_map[controller] = state
+
+        _run_update(_update_controller_states, common, modules, run_name, controller_map, controller_state_map, allvms)
+        assert sorted(queried) == ["de_conf_report", "de_state"]
+        assert [len(vm.events) for vm in allvms] == [2, 2, 2]
+
+        # each controller's own last value is compared, nothing is new
+        queried[:] = []
+        _run_update(_update_controller_states, common, modules, run_name, controller_map, controller_state_map, allvms)
+        assert len(queried) == 2
+        assert [len(vm.events) for vm in allvms] == [2, 2, 2]
+
 
     def test_get_running_terminate_timestamps(self):
+        from mocks.modules import FakeModules
         get_running_terminate_timestamps = epumgmt.main.em_core_status._get_running_terminate_timestamps
 
-        map = get_running_terminate_timestamps(self.allvms)
+        map = get_running_terminate_timestamps(FakeModules(), "testrun", self.allvms)
 
         vm2_running_time, vm2_terminated_time = map["i-jjjjjjjj"]
         assert vm2_running_time == self.testvm2_running_time